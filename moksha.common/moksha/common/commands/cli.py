@@ -5,12 +5,14 @@ import os
 import sys
 import signal
 import logging
-import pkg_resources
 
 from optparse import OptionParser
 from twisted.internet import protocol
 from twisted.internet import reactor
 
+from moksha.common.lib import entrypoints
+from moksha.common.lib.entrypoints import iter_entry_points
+
 log = logging.getLogger(__name__)
 
 pids = []
@@ -70,7 +72,7 @@ class MokshaCLI(object):
                         'producer', 'consumer')
         for entry in entry_points:
             print("[moksha.%s]" % entry)
-            for obj_entry in pkg_resources.iter_entry_points('moksha.' + entry):
+            for obj_entry in iter_entry_points('moksha.' + entry):
                 print(" * %s" % obj_entry.name)
             print()
 
@@ -114,7 +116,8 @@ def get_parser():
 def main():
     parser = get_parser()
     opts, args = parser.parse_args()
-    pkg_resources.working_set.add_entry(os.getcwd())
+    sys.path.insert(0, os.getcwd())
+    entrypoints.invalidate()
 
     moksha = MokshaCLI()
 
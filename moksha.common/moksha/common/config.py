@@ -7,62 +7,91 @@ class EnvironmentConfigParser(configparser.ConfigParser):
     """ConfigParser which is able to substitute environment variables.
     """
 
+    def __init__(self, *args, **kwargs):
+        configparser.ConfigParser.__init__(self, *args, **kwargs)
+        # A snapshot of the environment, taken once, rather than a fresh copy
+        # of os.environ for every value we look up.
+        self.environ = dict(os.environ)
+
     def get(self, section, option, raw=0, vars=None, **kwargs):
-        try:
-            val = configparser.ConfigParser.get(
-                self, section, option, raw=raw, vars=vars)
-        except Exception:
-            val = configparser.ConfigParser.get(
-                self, section, option, raw=1, vars=vars)
+        val = configparser.ConfigParser.get(
+            self, section, option, raw=1, vars=vars, **kwargs)
+
+        if raw:
+            return val
 
         return self._interpolate(section, option, val, vars)
 
-    def _interpolate(self, section, option, rawval, vars):
+    def items(self, section, raw=False, vars=None):
+        # Python 3's ConfigParser.items() interpolates values without going
+        # through get(), so route it through our own interpolation as well.
+        return [(option, self.get(section, option, raw=raw, vars=vars))
+                for option in self.options(section)]
+
+    def _lookup(self, section, key, vars):
+        if vars and key in vars:
+            return vars[key]
+        if self.has_option(section, key):
+            return configparser.ConfigParser.get(self, section, key, raw=1)
+        if key in self.environ:
+            return self.environ[key]
+        return None
+
+    def _interpolate(self, section, option, rawval, vars,
+                     depth=configparser.MAX_INTERPOLATION_DEPTH):
         """Adds the additional key-value pairs to the interpolation.
 
-        Also allows to use default values in %(KEY:-DEFAULT)s"""
-        if not vars:
-            vars = {}
-
-        for k, v in os.environ.items():
-            if k not in vars.keys():
-                vars[k] = v
-
-        value = rawval
-        depth = configparser.MAX_INTERPOLATION_DEPTH
-        while depth:                    # Loop through this until it's done
-            depth -= 1
-            start = value.find("%(")
-            if start > -1:
-                end = value.find(")s", start)
-                if end <= start:
-                    raise ValueError(
-                        "configparser: no \")s\" found "
-                        "after \"%(\" : " + rawval)
-
-                rawkey = value[start + 2:end]
-                default = None
-                key = rawkey
-                sep = rawkey.find(':-')
-                if sep > -1:
-                    default = rawkey[sep + 2:]
-                    key = key[:sep]
-
-                if key in vars:
-                    value = value.replace("%(" + rawkey + ")s", vars[key], 1)
-                elif rawkey in self.defaults():
-                    value = value.replace("%(" + rawkey + ")s",
-                                          self.defaults()[rawkey], 1)
-                else:
-                    if default:
-                        value = value.replace("%(" + rawkey + ")s", default, 1)
-                    else:
-                        raise ValueError(
-                            "configparser: Key %s not found in: %s" % (
-                                rawval, key))
-            else:
-                break
-        if value.find("%(") != -1:
+        Also allows to use default values in %(KEY:-DEFAULT)s
+
+        The value is tokenized in a single pass.  Substituted values are
+        interpolated themselves, up to MAX_INTERPOLATION_DEPTH levels deep.
+        """
+        if '%' not in rawval:
+            return rawval
+
+        if not depth:
             raise ValueError(
                 "configparser: Interpolation Depth error: %s" % rawval)
-        return value
+
+        parts = []
+        pos = 0
+        while True:
+            start = rawval.find('%', pos)
+            if start == -1:
+                parts.append(rawval[pos:])
+                break
+
+            parts.append(rawval[pos:start])
+            token = rawval[start + 1:start + 2]
+            if token == '%':
+                parts.append('%')
+                pos = start + 2
+                continue
+            elif token != '(':
+                # A lone '%' is just a percent sign.
+                parts.append('%')
+                pos = start + 1
+                continue
+
+            end = rawval.find(")s", start)
+            if end == -1:
+                raise ValueError(
+                    "configparser: no \")s\" found "
+                    "after \"%(\" : " + rawval)
+
+            rawkey = rawval[start + 2:end]
+            key, sep, default = rawkey.partition(':-')
+
+            value = self._lookup(section, key, vars)
+            if value is None:
+                if not sep:
+                    raise ValueError(
+                        "configparser: Key %s not found in: %s" % (
+                            rawval, key))
+                value = default
+
+            parts.append(self._interpolate(
+                section, option, value, vars, depth - 1))
+            pos = end + 2
+
+        return ''.join(parts)
@@ -27,3 +27,6 @@ class WidgetNotFound(MokshaException):
 class CacheBackendException(MokshaException):
     pass
 
+
+class SpoolFull(MokshaException):
+    """ A messaging backend cannot hold any more outgoing messages. """
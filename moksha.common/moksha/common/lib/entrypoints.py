@@ -0,0 +1,254 @@
+# This file is part of Moksha.
+# Copyright (C) 2008-2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+:mod:`moksha.common.lib.entrypoints` - Entry-point registry
+===========================================================
+
+A drop-in replacement for ``pkg_resources.iter_entry_points`` that the hub,
+the middleware and the command-line tools share.
+
+Importing ``pkg_resources`` scans every distribution on ``sys.path`` up front,
+which gets slow with a large site-packages.  Here the installed entry points
+are read once per process with ``importlib.metadata`` and kept in memory.
+Nothing is imported until :meth:`EntryPoint.load` is called, so consumer,
+producer and widget classes are only imported when they are about to be used.
+
+If the ``MOKSHA_ENTRY_POINTS_INDEX`` environment variable names a file, the
+scan is also stored there as JSON, together with a fingerprint of the
+installed distributions.  Later processes reuse the index for as long as the
+fingerprint still matches, and rebuild it when anything is installed, removed
+or upgraded.
+"""
+
+import hashlib
+import importlib
+import json
+import logging
+import os
+import sys
+import tempfile
+
+try:
+    import importlib.metadata as importlib_metadata
+except ImportError:
+    try:
+        import importlib_metadata
+    except ImportError:
+        importlib_metadata = None
+
+log = logging.getLogger(__name__)
+
+INDEX_ENVIRON = 'MOKSHA_ENTRY_POINTS_INDEX'
+INDEX_VERSION = 1
+
+_METADATA_SUFFIXES = ('.dist-info', '.egg-info', '.egg-link', '.egg', '.pth')
+
+# {group: [EntryPoint, ...]} for this process, filled in by _registry().
+_entry_points = None
+
+
+class Distribution(object):
+    """ The bits of a distribution that moksha looks at. """
+
+    __slots__ = ('project_name', 'location')
+
+    def __init__(self, project_name, location):
+        self.project_name = project_name
+        self.location = location
+
+    def __repr__(self):
+        return '<Distribution %s (%s)>' % (self.project_name, self.location)
+
+
+class EntryPoint(object):
+    """ A named reference to an object, imported on demand. """
+
+    def __init__(self, group, name, value, dist):
+        self.group = group
+        self.name = name
+        self.value = value
+        self.dist = dist
+        self._loaded = None
+
+    @property
+    def module_name(self):
+        return self.value.split(':', 1)[0].strip()
+
+    @property
+    def attrs(self):
+        module, sep, attrs = self.value.partition(':')
+        # Strip any "[extras]" off of the reference.
+        attrs = attrs.split('[', 1)[0].strip()
+        return tuple(attrs.split('.')) if attrs else ()
+
+    def load(self):
+        """ Import and return the object this entry point refers to. """
+        if self._loaded is None:
+            obj = importlib.import_module(self.module_name)
+            for attr in self.attrs:
+                obj = getattr(obj, attr)
+            self._loaded = obj
+        return self._loaded
+
+    def __repr__(self):
+        return '<EntryPoint %s = %s [%s]>' % (self.name, self.value, self.group)
+
+
+def iter_entry_points(group, name=None):
+    """ Return the entry points in ``group``, optionally only ``name``. """
+    return [ep for ep in _registry().get(group, [])
+            if name is None or ep.name == name]
+
+
+def invalidate():
+    """ Forget what was discovered, e.g. after changing ``sys.path``. """
+    global _entry_points
+    _entry_points = None
+
+
+def fingerprint(path=None):
+    """ Cheaply identify the set of installed distributions.
+
+    Only directory listings and ``stat`` calls are used, so this is much
+    cheaper than actually reading every distribution's metadata.
+    """
+    digest = hashlib.sha1()
+    for entry in (sys.path if path is None else path):
+        entry = os.path.abspath(entry or os.curdir)
+        digest.update(entry.encode('utf-8', 'replace'))
+        try:
+            st = os.stat(entry)
+        except OSError:
+            continue
+        digest.update(repr(st.st_mtime).encode('ascii'))
+        if not os.path.isdir(entry):
+            continue
+        try:
+            names = sorted(os.listdir(entry))
+        except OSError:
+            continue
+        for name in names:
+            if not name.endswith(_METADATA_SUFFIXES):
+                continue
+            metadata = os.path.join(entry, name)
+            stamp = metadata
+            if os.path.isdir(metadata):
+                # Editable installs rewrite entry_points.txt in place.
+                candidate = os.path.join(metadata, 'entry_points.txt')
+                if os.path.exists(candidate):
+                    stamp = candidate
+            try:
+                mtime = os.stat(stamp).st_mtime
+            except OSError:
+                continue
+            digest.update(('%s:%r' % (name, mtime)).encode('utf-8', 'replace'))
+    return digest.hexdigest()
+
+
+def _registry():
+    global _entry_points
+    if _entry_points is None:
+        index = os.environ.get(INDEX_ENVIRON)
+        if index:
+            _entry_points = _load_index(index)
+        else:
+            _entry_points = _build(_scan())
+    return _entry_points
+
+
+def _scan():
+    """ Read every installed entry point as ``(group, name, value, dist)``.
+
+    Only the metadata is read; nothing gets imported.
+    """
+    if importlib_metadata is None:
+        return _scan_pkg_resources()
+
+    found = []
+    seen = set()
+    for dist in importlib_metadata.distributions():
+        project_name = dist.metadata['Name']
+        if not project_name:
+            continue
+        # Like pkg_resources, the first distribution on sys.path wins.
+        key = project_name.lower().replace('_', '-')
+        if key in seen:
+            continue
+        seen.add(key)
+        location = os.path.abspath(str(dist.locate_file('')))
+        for ep in dist.entry_points:
+            found.append((ep.group, ep.name, ep.value,
+                          project_name, location))
+    return found
+
+
+def _scan_pkg_resources():
+    import pkg_resources
+    found = []
+    for dist in pkg_resources.working_set:
+        for group, entries in dist.get_entry_map().items():
+            for name, ep in entries.items():
+                value = ep.module_name
+                if ep.attrs:
+                    value += ':' + '.'.join(ep.attrs)
+                found.append((group, name, value,
+                              dist.project_name, dist.location))
+    return found
+
+
+def _build(found):
+    registry = {}
+    dists = {}
+    for group, name, value, project_name, location in found:
+        if (project_name, location) not in dists:
+            dists[(project_name, location)] = Distribution(
+                project_name, location)
+        registry.setdefault(group, []).append(EntryPoint(
+            group, name, value, dists[(project_name, location)]))
+    return registry
+
+
+def _load_index(path):
+    current = fingerprint()
+    try:
+        with open(path) as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION and \
+           index.get('fingerprint') == current:
+            return _build(index['entry_points'])
+        log.debug("Entry point index %r is stale." % path)
+    except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+        log.debug("Cannot read entry point index %r: %s" % (path, e))
+
+    found = _scan()
+    _write_index(path, current, found)
+    return _build(found)
+
+
+def _write_index(path, current, found):
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.entry-points-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'version': INDEX_VERSION,
+                'fingerprint': current,
+                'entry_points': [list(ep) for ep in found],
+            }, f)
+        # Swap it in atomically, so concurrent readers never see half of it.
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        log.warning("Cannot write entry point index %r: %s" % (path, e))
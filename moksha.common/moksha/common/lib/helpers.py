@@ -29,6 +29,10 @@ log = logging.getLogger(__name__)
 scrub_filter = re.compile('[^_a-zA-Z0-9-]')
 
 
+# {config file: (mtime, parsed app config)}
+_appconfigs = {}
+
+
 def get_moksha_config_path():
     """
     :returns: The path to Moksha's configuration file.
@@ -65,11 +69,31 @@ def get_moksha_appconfig():
 
 
 def appconfig(config_path):
-    """ Our own reimplementation of paste.deploy.appconfig """
+    """ Our own reimplementation of paste.deploy.appconfig
+
+    Parsed files are cached and only read again once their mtime changes.
+    Every call returns a fresh copy that the caller is free to modify.
+    """
 
     if config_path.startswith('config:'):
         config_path = config_path[7:]
 
+    try:
+        mtime = os.stat(config_path).st_mtime
+    except OSError:
+        mtime = None
+
+    cached = _appconfigs.get(config_path)
+    if cached and mtime is not None and cached[0] == mtime:
+        return dict(cached[1])
+
+    config = _load_appconfig(config_path)
+    if mtime is not None:
+        _appconfigs[config_path] = (mtime, config)
+    return dict(config)
+
+
+def _load_appconfig(config_path):
     here = os.path.abspath(os.path.dirname(config_path))
     parser = moksha.common.config.EnvironmentConfigParser({"here": here})
     parser.read(filenames=[config_path])
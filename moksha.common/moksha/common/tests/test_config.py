@@ -35,3 +35,27 @@ def test_default_config_value():
 def test_missing_config_variable():
     p = load_config('/test_config.ini')
     p.get('test_missing_variable', 'test')
+
+
+def test_nested_default_config_value():
+    p = load_config('/test_config.ini')
+    eq_(p.get('test_nested', 'path'), '/srv/fallback')
+    eq_(p.get('test_nested', 'indirect'), '/srv/fallback/data')
+
+
+def test_percent_config_value():
+    p = load_config('/test_config.ini')
+    eq_(p.get('test_percent', 'test'), '100% and %s.db')
+
+
+def test_items_interpolated():
+    os.environ['test_variable'] = 'from the environment'
+    p = load_config()
+    eq_(dict(p.items('test'))['test'], 'from the environment')
+
+
+def test_environment_snapshot():
+    os.environ['test_variable'] = 'before'
+    p = load_config()
+    os.environ['test_variable'] = 'after'
+    eq_(p.get('test', 'test'), 'before')
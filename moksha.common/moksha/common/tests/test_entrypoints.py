@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from nose.tools import eq_, ok_
+
+from moksha.common.lib import entrypoints
+
+
+ENTRY_POINTS = """
+[moksha.consumer]
+sample = moksha_sample_ep.consumers:SampleConsumer
+
+[moksha.widget]
+sample_widget = moksha_sample_ep:Widgets.sample
+"""
+
+
+class TestEntryPoints(object):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index = os.path.join(self.tmpdir, 'index.json')
+
+        site = os.path.join(self.tmpdir, 'site')
+        package = os.path.join(site, 'moksha_sample_ep')
+        info = os.path.join(site, 'moksha_sample_ep-1.0.dist-info')
+        os.makedirs(package)
+        os.makedirs(info)
+        with open(os.path.join(package, '__init__.py'), 'w') as f:
+            f.write('class Widgets(object):\n    sample = "a widget"\n')
+        with open(os.path.join(package, 'consumers.py'), 'w') as f:
+            f.write('class SampleConsumer(object):\n    pass\n')
+        with open(os.path.join(info, 'METADATA'), 'w') as f:
+            f.write('Metadata-Version: 2.1\nName: moksha-sample-ep\n'
+                    'Version: 1.0\n')
+        with open(os.path.join(info, 'entry_points.txt'), 'w') as f:
+            f.write(ENTRY_POINTS)
+
+        self.site = site
+        sys.path.insert(0, site)
+        entrypoints.invalidate()
+
+    def tearDown(self):
+        sys.path.remove(self.site)
+        for module in ('moksha_sample_ep', 'moksha_sample_ep.consumers'):
+            sys.modules.pop(module, None)
+        os.environ.pop(entrypoints.INDEX_ENVIRON, None)
+        entrypoints.invalidate()
+        shutil.rmtree(self.tmpdir)
+
+    def test_discovery(self):
+        eps = entrypoints.iter_entry_points('moksha.consumer')
+        eps = [ep for ep in eps if ep.dist.project_name == 'moksha-sample-ep']
+        eq_([ep.name for ep in eps], ['sample'])
+        eq_(eps[0].dist.location, self.site)
+        eq_(eps[0].module_name, 'moksha_sample_ep.consumers')
+
+    def test_by_name(self):
+        eps = entrypoints.iter_entry_points('moksha.widget', 'sample_widget')
+        eq_(len(eps), 1)
+        eq_(eps[0].load(), 'a widget')
+
+    def test_lazy_load(self):
+        eps = entrypoints.iter_entry_points('moksha.consumer', 'sample')
+        ok_('moksha_sample_ep.consumers' not in sys.modules)
+        eq_(eps[0].load().__name__, 'SampleConsumer')
+        ok_('moksha_sample_ep.consumers' in sys.modules)
+
+    def test_index_written_and_reused(self):
+        os.environ[entrypoints.INDEX_ENVIRON] = self.index
+        entrypoints.iter_entry_points('moksha.consumer')
+        with open(self.index) as f:
+            index = json.load(f)
+        eq_(index['fingerprint'], entrypoints.fingerprint())
+
+        # Doctor the index; a matching fingerprint means it is trusted.
+        for entry in index['entry_points']:
+            if entry[1] == 'sample':
+                entry[1] = 'from_index'
+        with open(self.index, 'w') as f:
+            json.dump(index, f)
+
+        entrypoints.invalidate()
+        names = [ep.name for ep in
+                 entrypoints.iter_entry_points('moksha.consumer')]
+        ok_('from_index' in names)
+        ok_('sample' not in names)
+
+    def test_stale_index_is_rebuilt(self):
+        os.environ[entrypoints.INDEX_ENVIRON] = self.index
+        with open(self.index, 'w') as f:
+            json.dump({'version': entrypoints.INDEX_VERSION,
+                       'fingerprint': 'stale',
+                       'entry_points': []}, f)
+
+        names = [ep.name for ep in
+                 entrypoints.iter_entry_points('moksha.consumer')]
+        ok_('sample' in names)
+        with open(self.index) as f:
+            eq_(json.load(f)['fingerprint'], entrypoints.fingerprint())
+
+    def test_fingerprint_tracks_installs(self):
+        before = entrypoints.fingerprint()
+        os.makedirs(os.path.join(self.site, 'other-2.0.dist-info'))
+        ok_(entrypoints.fingerprint() != before)
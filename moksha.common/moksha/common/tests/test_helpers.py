@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_
+
+from moksha.common.lib.helpers import appconfig, get_moksha_config_path
+
+
+class TestAppConfig(object):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.ini')
+        self.write('one')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, value, mtime=None):
+        with open(self.path, 'w') as f:
+            f.write('[app:main]\nvalue = %s\nhere_dir = %%(here)s\n' % value)
+        if mtime:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_appconfig(self):
+        config = appconfig('config:' + self.path)
+        eq_(config['value'], 'one')
+        eq_(config['here_dir'], self.tmpdir)
+
+    def test_appconfig_copies(self):
+        """ Callers may modify what they get without affecting the cache. """
+        config = appconfig('config:' + self.path)
+        config['value'] = 'modified'
+        eq_(appconfig('config:' + self.path)['value'], 'one')
+
+    def test_appconfig_reloads_on_mtime(self):
+        os.utime(self.path, (1000000000, 1000000000))
+        eq_(appconfig('config:' + self.path)['value'], 'one')
+        self.write('two', mtime=1000000000)
+        # Same mtime: the cached copy is used.
+        eq_(appconfig('config:' + self.path)['value'], 'one')
+        self.write('three', mtime=1000000010)
+        eq_(appconfig('config:' + self.path)['value'], 'three')
+
+
+class TestConfigPath(object):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = os.path.realpath(tempfile.mkdtemp())
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_production_ini_appearing_later(self):
+        open('development.ini', 'w').close()
+        eq_(get_moksha_config_path(),
+            os.path.join(self.tmpdir, 'development.ini'))
+        open('production.ini', 'w').close()
+        eq_(get_moksha_config_path(),
+            os.path.join(self.tmpdir, 'production.ini'))
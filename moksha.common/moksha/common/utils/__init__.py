@@ -35,7 +35,7 @@ def get_widget(name):
 
 def get_widgets():
     """ Return a dictionary of all widgets """
-    from pkg_resources import iter_entry_points
+    from moksha.common.lib.entrypoints import iter_entry_points
     return _widgets or [widget.load() for widget in iter_entry_points('moksha.widget')]
 
 def get_app(name):
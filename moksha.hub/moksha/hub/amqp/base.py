@@ -15,14 +15,125 @@
 #
 # Authors: Luke Macken <lmacken@redhat.com>
 
+import threading
+
 from moksha.hub.messaging import MessagingHubExtension
 
+
+def topic_matches(binding_key, routing_key):
+    """ Whether `routing_key` matches `binding_key` on an AMQP topic exchange.
+
+    Words are separated by dots; ``*`` matches exactly one word and ``#``
+    matches zero or more words.
+    """
+    pattern = binding_key.split('.') if binding_key else []
+    words = routing_key.split('.') if routing_key else []
+
+    # matches[j] is whether pattern[:i] matches words[:j]
+    matches = [True] + [False] * len(words)
+    for part in pattern:
+        if part == '#':
+            for j in range(1, len(words) + 1):
+                matches[j] = matches[j] or matches[j - 1]
+        else:
+            for j in range(len(words), 0, -1):
+                matches[j] = matches[j - 1] and part in ('*', words[j - 1])
+            matches[0] = False
+    return matches[-1]
+
+
+class Batch(object):
+    """ Collects items from any thread and hands them over in bulk.
+
+    `callback` gets the list of items collected so far every `size` items,
+    and whenever :meth:`flush` is called (say, from a timer or on shutdown).
+    """
+
+    def __init__(self, callback, size=100):
+        self.callback = callback
+        self.size = size
+        self.items = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        with self._lock:
+            self.items.append(item)
+            full = len(self.items) >= self.size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            items, self.items = self.items, []
+        if items:
+            self.callback(items)
+
+
+class TopicMatcher(object):
+    """ Maps AMQP binding keys to the callbacks subscribed to them.
+
+    This lets a single server queue, bound to every key, stand in for one
+    queue per subscription: messages are dispatched to the right callbacks
+    locally instead.  :meth:`add` and :meth:`remove` report which binding
+    keys appeared or disappeared, so that the bindings on the broker can be
+    kept in step one key at a time.
+    """
+
+    def __init__(self):
+        self.callbacks = {}
+        # {routing key: callbacks}, cleared whenever a callback comes or goes
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.callbacks)
+
+    def add(self, binding_key, callback):
+        """ Subscribe callback, and return whether binding_key is new. """
+        with self._lock:
+            new = binding_key not in self.callbacks
+            self.callbacks.setdefault(binding_key, []).append(callback)
+            self._cache = {}
+        return new
+
+    def remove(self, callback):
+        """ Unsubscribe callback, and return the keys nobody wants anymore.
+        """
+        unused = []
+        with self._lock:
+            for key, callbacks in list(self.callbacks.items()):
+                if callback in callbacks:
+                    callbacks.remove(callback)
+                    if not callbacks:
+                        del self.callbacks[key]
+                        unused.append(key)
+            self._cache = {}
+        return unused
+
+    def match(self, routing_key):
+        """ Return the callbacks of every key that routing_key matches. """
+        cache = self._cache
+        callbacks = cache.get(routing_key)
+        if callbacks is None:
+            with self._lock:
+                callbacks = []
+                for key, subscribed in self.callbacks.items():
+                    if topic_matches(key, routing_key):
+                        callbacks.extend(subscribed)
+                if len(cache) < 10000:
+                    cache[routing_key] = callbacks
+        return callbacks
+
 class BaseAMQPHubExtension(MessagingHubExtension):
     """
     A skeleton class for what we expect from an AMQP implementation.
     This allows us to bounce between different AMQP modules without too much
     pain and suffering.
     """
+    name = 'amqp'
     conn = None
 
     def __init__(self):
@@ -0,0 +1,364 @@
+# This file is part of Moksha.
+# Copyright (C) 2008-2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An AMQP 0-9-1 hub extension for RabbitMQ and other 0-9-1 brokers, built on
+pika's Twisted adapter.
+
+Publishes are handed to the reactor and spread over a pool of channels in
+confirm mode.  Every channel keeps up to ``amqp_max_unconfirmed`` messages in
+flight, so confirms are pipelined instead of waited for one at a time (and
+the broker usually confirms a whole run of them at once).  Messages that the
+broker rejects, or that were still unconfirmed when the connection went away,
+are published again.
+
+Subscriptions share a single exclusive queue per hub, bound to every
+subscribed key and consumed with a ``basic.qos`` prefetch of
+``amqp_prefetch``.  A delivery is acknowledged once every consumer is done
+with it.
+"""
+
+import collections
+import functools
+import logging
+import threading
+
+import six
+
+try:
+    import pika
+    from pika.adapters.twisted_connection import TwistedProtocolConnection
+except ImportError:
+    pika = None
+
+from twisted.internet.protocol import ClientCreator
+
+from moksha.common.exc import SpoolFull
+from moksha.hub.amqp.base import BaseAMQPHubExtension, TopicMatcher
+from moksha.hub.messaging import Acknowledgement
+from moksha.hub.reactor import reactor, Handoff
+
+log = logging.getLogger('moksha.hub')
+
+
+class AMQPMessage(object):
+    """ A message delivered by the broker, as handed to subscribers. """
+    ack = None
+
+    def __init__(self, topic, body, headers=None):
+        self.topic = topic
+        self.body = body
+        self.headers = headers or {}
+
+    def __json__(self):
+        return {'topic': self.topic, 'body': self.body}
+
+    def __repr__(self):
+        return "<AMQPMessage; topic: %r, body: %r>" % (self.topic, self.body)
+
+
+class Publisher(object):
+    """ A channel in confirm mode, and the messages it has in flight. """
+
+    def __init__(self, extension, channel):
+        self.extension = extension
+        self.channel = channel
+        # {serial: (topic, body, headers)}, in the order they were published
+        self.unconfirmed = collections.OrderedDict()
+        self._serial = 0
+
+    @property
+    def room(self):
+        return len(self.unconfirmed) < self.extension.max_unconfirmed
+
+    def publish(self, message):
+        topic, body, headers = message
+        self._serial += 1
+        serial = self._serial
+        self.unconfirmed[serial] = message
+        d = self.channel.basic_publish(
+            exchange=headers.get('exchange', 'amq.topic'),
+            routing_key=topic,
+            body=body,
+            properties=self.extension.properties(headers),
+        )
+        d.addCallbacks(self.confirmed, self.rejected,
+                       callbackArgs=(serial,), errbackArgs=(serial,))
+
+    def confirmed(self, result, serial):
+        self.unconfirmed.pop(serial, None)
+        self.extension.flush()
+
+    def rejected(self, failure, serial):
+        message = self.unconfirmed.pop(serial, None)
+        if message is None:
+            return
+        log.warning("Broker did not take a message to %r, retrying: %s" % (
+            message[0], failure.getErrorMessage()))
+        self.extension.requeue([message])
+
+
+class PikaAMQPHubExtension(BaseAMQPHubExtension):
+    """
+    Talk to an AMQP 0-9-1 broker, given as ``amqp_broker`` in the form
+    ``amqp[s]://user:password@host[:port][/vhost]``.
+    """
+    carries_headers = True
+
+    def __init__(self, hub, config):
+        self.hub = hub
+        self.config = config
+        self.settings = settings = hub.settings
+        self.url = settings.amqp_broker
+        self.prefetch = settings.amqp_prefetch
+        self.channels = settings.amqp_channels
+        self.max_unconfirmed = settings.amqp_max_unconfirmed
+
+        self.matcher = TopicMatcher()
+        self.connection = None
+        self.consumer = None
+        self.queue = None
+        self.publishers = []
+
+        # Messages that are waiting for room on one of the channels.
+        self._pending = collections.deque()
+        # Publishes and acknowledgements may come from consumer threads; the
+        # channels belong to the reactor.
+        self._outgoing = Handoff(self.publish_all)
+        self._acks = Handoff(self.acknowledge_all)
+        self._reading = None
+        self._closing = False
+
+        self.start()
+        super(PikaAMQPHubExtension, self).__init__()
+
+    def connect(self):
+        """ Return a Deferred that fires with a ready pika connection. """
+        if pika is None:
+            raise ImportError("The AMQP 0-9-1 extension requires pika")
+
+        params = pika.URLParameters(self.url)
+        creator = ClientCreator(reactor, _Connection, params)
+        if params.ssl_options:
+            # Check the broker's certificate against its host name.
+            from twisted.internet import ssl
+            d = creator.connectSSL(
+                params.host, params.port,
+                ssl.optionsForClientTLS(six.text_type(params.host)))
+        else:
+            d = creator.connectTCP(params.host, params.port)
+
+        def ready(connection):
+            connection.extension = self
+            return connection.ready.addCallback(lambda _: connection)
+
+        return d.addCallback(ready)
+
+    def properties(self, headers):
+        headers = dict((k, v) for k, v in headers.items() if k != 'exchange')
+        return pika.BasicProperties(headers=headers or None)
+
+    def start(self):
+        d = self.connect()
+        d.addCallback(self.connected)
+        d.addErrback(self.connection_failed)
+
+    def connected(self, connection):
+        log.info("Connected to AMQP broker %s" % self.url)
+        self.connection = connection
+        connection.channel().addCallback(self.setup_consumer)
+        for i in range(self.channels):
+            connection.channel().addCallback(self.setup_publisher)
+
+    def setup_publisher(self, channel):
+        def confirming(result):
+            self.publishers.append(Publisher(self, channel))
+            self.flush()
+        return channel.confirm_delivery().addCallback(confirming)
+
+    def setup_consumer(self, channel):
+        def declare(result):
+            return channel.queue_declare(
+                queue='', exclusive=True, auto_delete=True)
+
+        def bind(frame):
+            self.consumer = channel
+            self.queue = frame.method.queue
+            for topic in list(self.matcher.callbacks):
+                self.exchange_bind(self.queue, binding_key=topic)
+            return channel.basic_consume(queue=self.queue, auto_ack=False)
+
+        def consume(result):
+            queue, consumer_tag = result
+            self.consume(queue)
+
+        d = channel.basic_qos(prefetch_count=self.prefetch)
+        return d.addCallback(declare).addCallback(bind).addCallback(consume)
+
+    def connection_failed(self, failure):
+        log.warning("Could not connect to AMQP broker %s: %s" % (
+            self.url, failure.getErrorMessage()))
+        self.reconnect()
+
+    def connection_lost(self, connection, reason):
+        if connection is not self.connection:
+            return
+        log.warning("Lost connection to AMQP broker %s: %s" % (
+            self.url, reason.getErrorMessage()))
+        self.connection = self.consumer = self.queue = None
+
+        # Whatever the broker did not confirm goes out again.
+        unconfirmed = []
+        for publisher in self.publishers:
+            unconfirmed.extend(publisher.unconfirmed.values())
+            publisher.unconfirmed.clear()
+        self.publishers = []
+        self._pending.extendleft(reversed(unconfirmed))
+        self.reconnect()
+
+    def reconnect(self):
+        if not self._closing:
+            reactor.callLater(self.settings.amqp_reconnect_delay, self.start)
+
+    def exchange_bind(self, queue, exchange='amq.topic', binding_key=None):
+        return self.consumer.queue_bind(
+            queue=queue, exchange=exchange, routing_key=binding_key)
+
+    def exchange_unbind(self, queue, exchange='amq.topic', binding_key=None):
+        return self.consumer.queue_unbind(
+            queue=queue, exchange=exchange, routing_key=binding_key)
+
+    def check_backlog(self):
+        if len(self._pending) + len(self._outgoing) >= \
+           self.settings.amqp_backlog:
+            raise SpoolFull("%i AMQP messages are waiting for the broker" %
+                            len(self._pending))
+
+    def send_message(self, topic, message, **headers):
+        self.check_backlog()
+        self._outgoing.put((topic, message, headers))
+
+        super(PikaAMQPHubExtension, self).send_message(
+            topic, message, **headers)
+
+    def send_messages(self, messages):
+        self.check_backlog()
+        self._outgoing.extend(messages)
+
+    def publish_all(self, messages):
+        """ Publish what worker threads handed to the reactor. """
+        self._pending.extend(messages)
+        self.flush()
+
+    def requeue(self, messages):
+        self._pending.extendleft(reversed(messages))
+        self.flush()
+
+    def flush(self):
+        """ Publish as much as the channels have room for. """
+        self._outgoing.drain()
+
+        ready = [p for p in self.publishers if p.room]
+        while self._pending and ready:
+            for publisher in list(ready):
+                if not self._pending:
+                    break
+                publisher.publish(self._pending.popleft())
+                if not publisher.room:
+                    ready.remove(publisher)
+
+    def subscribe(self, topic, callback):
+        if self.matcher.add(topic, callback) and self.consumer:
+            self.exchange_bind(self.queue, binding_key=topic)
+        super(PikaAMQPHubExtension, self).subscribe(topic, callback)
+
+    def unsubscribe(self, callback):
+        for topic in self.matcher.remove(callback):
+            if self.consumer:
+                self.exchange_unbind(self.queue, binding_key=topic)
+        super(PikaAMQPHubExtension, self).unsubscribe(callback)
+
+    def consume(self, queue):
+        def again(result):
+            self.consume(queue)
+
+        def stopped(failure):
+            log.debug("Stopped consuming from %r: %s" % (
+                self.queue, failure.getErrorMessage()))
+
+        d = queue.get()
+        d.addCallback(self.deliver)
+        d.addCallbacks(again, stopped)
+
+    def deliver(self, delivery):
+        channel, method, properties, body = delivery
+        topic = method.routing_key
+        message = AMQPMessage(
+            topic, body, getattr(properties, 'headers', None))
+        if self.hub.echo(message.headers):
+            # Delivered to local subscribers when it was sent.
+            self.acknowledge_all([(channel, method.delivery_tag, True)])
+            return
+        message.ack = Acknowledgement(functools.partial(
+            self.acknowledge, channel, method.delivery_tag))
+
+        self._reading = threading.current_thread()
+        handled = True
+        try:
+            for callback in self.matcher.match(topic):
+                try:
+                    if callback(message) is False:
+                        handled = False
+                except Exception:
+                    log.exception("%r failed on a message to %s" % (
+                        callback, topic))
+                    handled = False
+            message.ack.release(handled)
+        finally:
+            self._reading = None
+
+    def acknowledge(self, channel, delivery_tag, handled):
+        if threading.current_thread() is not self._reading:
+            # A worker thread finished the message.
+            self._acks.put((channel, delivery_tag, handled))
+        else:
+            self.acknowledge_all([(channel, delivery_tag, handled)])
+
+    def acknowledge_all(self, acks):
+        for channel, delivery_tag, handled in acks:
+            if channel is not self.consumer:
+                # The broker redelivers everything we had not acknowledged
+                # when the channel went away.
+                continue
+            if handled:
+                channel.basic_ack(delivery_tag=delivery_tag)
+            else:
+                channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+
+    def close(self):
+        self._closing = True
+        if self.connection:
+            self.connection.close()
+
+
+if pika is not None:
+    class _Connection(TwistedProtocolConnection):
+        """ Tells its extension when the connection goes away. """
+        extension = None
+
+        def connectionLost(self, reason):
+            TwistedProtocolConnection.connectionLost(self, reason)
+            if self.extension:
+                self.extension.connection_lost(self, reason)
@@ -21,8 +21,9 @@ from qpid.util import connect, URL, ssl
 from qpid.datatypes import Message, uuid4, RangedSet
 from qpid.connection import Connection
 from qpid.session import SessionClosed
+from twisted.internet.task import LoopingCall
 
-from moksha.hub.amqp.base import BaseAMQPHubExtension
+from moksha.hub.amqp.base import Batch, BaseAMQPHubExtension, TopicMatcher
 
 log = logging.getLogger('moksha.hub')
 
@@ -34,10 +35,16 @@ class QpidAMQPHubExtension(BaseAMQPHubExtension):
     `broker`
         [amqps://][<user>[/<password>]@]<host>[:<port>]
 
+    With ``amqp_shared_queue`` enabled, the hub declares a single server
+    queue and binds it to every key it subscribes to, instead of declaring a
+    queue (and starting a listener thread) per subscription.  Incoming
+    messages are then handed to the matching callbacks locally.
+
     """
 
     def __init__(self, hub, config):
         self.config = config
+        self.shared = hub.settings.amqp_shared_queue
         self.set_broker(self.config.get('amqp_broker'))
         self.socket = connect(self.host, self.port)
         if self.url.scheme == URL.AMQPS:
@@ -48,7 +55,25 @@ class QpidAMQPHubExtension(BaseAMQPHubExtension):
         self.connection.start()
         log.info("Connected to AMQP Broker %s" % self.host)
         self.session = self.connection.session(str(uuid4()))
+
+        # Accept messages in bulk, every amqp_accept_batch messages or
+        # amqp_accept_interval seconds, whichever comes first.
+        self.accepts = Batch(self.accept_ids, hub.settings.amqp_accept_batch)
+        self._accept_timer = None
+        if self.accepts.size > 1:
+            self._accept_timer = LoopingCall(self.accepts.flush)
+            self._accept_timer.start(
+                hub.settings.amqp_accept_interval, now=False)
+
         self.local_queues = []
+        if self.shared:
+            self.matcher = TopicMatcher()
+            self.shared_queue = '_'.join(["moksha_hub", self.session.name])
+            self.queue_declare(queue=self.shared_queue, exclusive=True,
+                               auto_delete=True)
+            self.local_queues.append(self.subscribe_queue(
+                self.shared_queue, self.shared_queue))
+            self.local_queues[-1].listen(self.dispatch)
         super(QpidAMQPHubExtension, self).__init__()
 
     def set_broker(self, broker):
@@ -92,18 +117,45 @@ class QpidAMQPHubExtension(BaseAMQPHubExtension):
         self.session.exchange_bind(exchange=exchange, queue=queue,
                                    binding_key=binding_key)
 
+    def exchange_unbind(self, queue, exchange='amq.topic', binding_key=None):
+        self.session.exchange_unbind(exchange=exchange, queue=queue,
+                                     binding_key=binding_key)
+
     def message_subscribe(self, queue, destination):
         return self.session.message_subscribe(queue=queue,
                                               destination=destination)
 
     def message_accept(self, message):
+        self.accepts.add(message.id)
+
+    def accept_ids(self, ids):
         try:
-            self.session.message_accept(RangedSet(message.id))
+            self.session.message_accept(RangedSet(*ids))
         except SessionClosed:
-            log.debug("Accepted message on closed session: %s" % message.id)
-            pass
+            log.debug("Accepted %i messages on closed session" % len(ids))
+
+    def dispatch(self, message):
+        """ Hand a message from the shared queue to its subscribers. """
+        try:
+            topic = message.get('delivery_properties').routing_key
+        except AttributeError:
+            log.debug("Got AMQP message without a routing key: %r" % message)
+            return
+
+        for callback in self.matcher.match(topic):
+            try:
+                callback(message)
+            except Exception:
+                log.exception("%r failed on a message to %s" % (
+                    callback, topic))
 
     def subscribe(self, topic, callback):
+        if self.shared:
+            if self.matcher.add(topic, callback):
+                self.exchange_bind(self.shared_queue, binding_key=topic)
+            super(QpidAMQPHubExtension, self).subscribe(topic, callback)
+            return
+
         queue_name = '_'.join([
             "moksha_consumer", self.session.name, str(uuid4()),
         ])
@@ -123,7 +175,16 @@ class QpidAMQPHubExtension(BaseAMQPHubExtension):
 
         super(QpidAMQPHubExtension, self).subscribe(topic, callback)
 
+    def unsubscribe(self, callback):
+        if self.shared:
+            for topic in self.matcher.remove(callback):
+                self.exchange_unbind(self.shared_queue, binding_key=topic)
+        super(QpidAMQPHubExtension, self).unsubscribe(callback)
+
     def close(self):
+        if self._accept_timer and self._accept_timer.running:
+            self._accept_timer.stop()
+        self.accepts.flush()
         self.session.close(timeout=2)
         self.connection.close(timeout=2)
         self.socket.close()
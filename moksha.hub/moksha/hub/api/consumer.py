@@ -26,7 +26,6 @@ loaded, and receives each message for the specified topic through the
 .. moduleauthor:: Ralph Bean <rbean@redhat.com>
 """
 
-import json
 import threading
 import time
 import logging
@@ -38,6 +37,7 @@ from collections import deque
 from kitchen.iterutils import iterate
 from moksha.common.lib.helpers import create_app_engine
 from moksha.common.lib.converters import asbool
+from moksha.hub.messaging import Envelope
 import moksha.hub.reactor
 
 
@@ -48,6 +48,15 @@ class Consumer(object):
     # Automatically decode JSON data
     jsonify = True
 
+    # Consumers that share a group name split the messages on their topics
+    # between every hub that runs them, rather than each receiving them all.
+    group = None
+
+    # Define ``partition_key(message)`` to keep messages in order per key when
+    # running several workers.  Messages that share a key are always handled
+    # by the same worker thread, one after the other.
+    partition_key = None
+
     # Internal use only
     _initialized = False
     _exception_count = 0
@@ -69,7 +78,10 @@ class Consumer(object):
 
         for topic in iterate(self.topic):
             log.debug('Subscribing to consumer topic %s' % topic)
-            self.hub.subscribe(topic, callback)
+            if self.group:
+                self.hub.subscribe_group(self.group, topic, callback)
+            else:
+                self.hub.subscribe(topic, callback)
 
         # If the consumer specifies an 'app', then setup `self.engine` to
         # be a SQLAlchemy engine, along with a configured DBSession
@@ -90,14 +102,22 @@ class Consumer(object):
             log.info("Blocking mode false for %r.  "
                      "Messages to be queued and distributed to %r threads." % (
                          self, self.N))
+
+            # With a partition key, every worker gets a queue of its own.
+            self._queues = [self.incoming]
+            if self.partition_key and self.N > 1:
+                self._queues.extend(queue.Queue() for i in range(self.N - 1))
+
             for i in range(self.N):
-                moksha.hub.reactor.reactor.callInThread(self._work_loop)
+                moksha.hub.reactor.reactor.callInThread(
+                    self._work_loop, self._queues[i % len(self._queues)])
 
         self._initialized = True
 
     def __json__(self):
         if self._initialized:
-            backlog = self.incoming.qsize()
+            backlog = sum(q.qsize() for q in getattr(
+                self, '_queues', [self.incoming]))
             headcount_out = self.headcount_out
             headcount_in = self.headcount_in
             times = list(self._times)
@@ -139,11 +159,6 @@ class Consumer(object):
         because the current AMQP.js bindings do not allow the client to change them.
         Thus, we need to throw any topic/queue details into the JSON body itself.
         """
-        try:
-            body = json.loads(message.body)
-        except:
-            log.debug("Unable to decode message body to JSON: %r" % message.body)
-            body = message.body
         topic = None
 
         # Try some stuff for AMQP:
@@ -152,7 +167,7 @@ class Consumer(object):
         except TypeError:
             # We didn't get a JSON dictionary
             pass
-        except AttributeError:
+        except (AttributeError, KeyError, IndexError):
             # We didn't get headers or a routing key?
             pass
 
@@ -164,22 +179,50 @@ class Consumer(object):
                 # Weird.  I have no idea...
                 pass
 
-        message_as_dict = {'body': body, 'topic': topic}
+        if getattr(message, 'decoded', False):
+            # Published in this process; there is nothing to decode.
+            message_as_dict = Envelope(body=message.body, topic=topic)
+        else:
+            message_as_dict = self.hub.envelope(
+                topic, message.body, getattr(message, 'headers', None))
+        message_as_dict.ack = getattr(message, 'ack', None)
         return self._consume(message_as_dict)
 
     def _consume(self, message):
         self.headcount_in += 1
+
+        # Let the extension know that we're not done with this message
+        # until a worker has actually consumed it.
+        if getattr(message, 'ack', None):
+            message.ack.hold()
+
         if self.blocking_mode:
             # Do the work right now
             return self._do_work(message)
         else:
             # Otherwise, put the message in a queue for other threads to handle
-            self.incoming.put(message)
+            self._queue_for(message).put(message)
+
+    def _queue_for(self, message):
+        """ Pick the worker queue for `message` by its partition key. """
+        if len(self._queues) == 1:
+            return self.incoming
+
+        try:
+            index = hash(self.partition_key(message))
+        except Exception:
+            log.exception("Failed to compute partition key of %r" % message)
+            index = hash(None)
+
+        return self._queues[index % len(self._queues)]
+
+    def _work_loop(self, incoming=None):
+        if incoming is None:
+            incoming = self.incoming
 
-    def _work_loop(self):
         while True:
             # This is a blocking call.  It waits until a message is available.
-            message = self.incoming.get()
+            message = incoming.get()
             # Then we are being asked to quit
             if message is StopIteration:
                 break
@@ -187,6 +230,15 @@ class Consumer(object):
         self.debug("Worker thread exiting.")
 
     def _do_work(self, message):
+        handled = False
+        try:
+            handled = self._handle(message)
+            return handled
+        finally:
+            if getattr(message, 'ack', None):
+                message.ack.release(handled)
+
+    def _handle(self, message):
         self.headcount_out += 1
         start = time.time()
         handled = True
@@ -241,9 +293,16 @@ class Consumer(object):
         except Exception as e:
             log.error('Cannot send message: %s' % e)
 
+    def send_messages(self, messages):
+        try:
+            self.hub.send_messages(messages)
+        except Exception as e:
+            log.error('Cannot send messages: %s' % e)
+
     def stop(self):
+        queues = getattr(self, '_queues', None)
         for i in range(getattr(self, 'N', 0)):
-            self.incoming.put(StopIteration)
+            queues[i % len(queues)].put(StopIteration)
 
         if hasattr(self, 'hub'):
             self.hub.close()
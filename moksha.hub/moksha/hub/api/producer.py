@@ -66,6 +66,12 @@ class Producer(object):
         except Exception as e:
             log.error('Cannot send message: %s' % e)
 
+    def send_messages(self, messages):
+        try:
+            self.hub.send_messages(messages)
+        except Exception as e:
+            log.error('Cannot send messages: %s' % e)
+
     def stop(self):
         if hasattr(self, 'hub') and self.hub:
             self.hub.close()
@@ -0,0 +1,240 @@
+# This file is part of Moksha.
+# Copyright (C) 2008-2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+:mod:`moksha.hub.bridge` - Forwarding messages between brokers
+==============================================================
+
+A hub connected to several brokers can forward messages from one to the
+others.  Every rule in ``moksha.bridge`` names a source, one or more
+destinations separated by ``+``, and a topic::
+
+    moksha.bridge = stomp:zmq:/topic/org.fedoraproject.>,
+                    zmq:stomp+amqp:org.fedoraproject.prod.bodhi.update
+
+The topic is subscribed to on the source broker as it is, so it may use that
+broker's own wildcards.  Browsers publishing through the websocket server
+(``websocket`` as a source) are matched against the topic with shell-style
+wildcards instead.
+
+Forwarded messages carry the number of hops they have made, the hub they
+entered the bridge on, and an id.  A hub drops messages that have made
+``moksha.bridge.max_hops`` hops, and messages it has already forwarded, so
+that bridges between the same brokers on several hubs don't loop.  Brokers
+that cannot carry headers (zeromq, qpid) are deduplicated by a hash of the
+topic and body, but only for ``moksha.bridge.dedupe_ttl`` seconds, long
+enough to catch a message coming back around a loop, so that messages which
+are legitimately sent again (heartbeats, say) still get through.
+
+Each destination has its own bounded queue and writer thread, so a slow broker
+never holds up the others; when its queue is full, messages for it are
+dropped and counted.
+"""
+
+import collections
+import fnmatch
+import hashlib
+import json as JSON
+import logging
+import threading
+import time
+import uuid
+
+import six
+
+from moksha.hub.messaging import Outbox
+from moksha.hub.compression import CONTENT_ENCODING
+from moksha.hub.serialization import CONTENT_TYPE, decoders
+
+log = logging.getLogger('moksha.hub')
+
+HOPS = 'moksha-bridge-hops'
+ORIGIN = 'moksha-bridge-origin'
+MESSAGE_ID = 'moksha-bridge-id'
+
+
+class Rule(object):
+    """ Forward messages on `topic` from `source` to `destinations`. """
+
+    def __init__(self, source, destinations, topic):
+        self.source = source
+        self.destinations = destinations
+        self.topic = topic
+
+    @classmethod
+    def parse(cls, spec):
+        try:
+            source, destinations, topic = spec.split(':', 2)
+        except ValueError:
+            raise ValueError("Bad bridge rule %r, expected "
+                             "source:destination[+destination]:topic" % spec)
+        destinations = [d.strip() for d in destinations.split('+')]
+        return cls(source.strip(), [d for d in destinations if d],
+                   topic.strip())
+
+    def __repr__(self):
+        return '<Rule %s -> %s on %r>' % (
+            self.source, '+'.join(self.destinations), self.topic)
+
+
+def unpack(message):
+    """ Return the topic, raw body and headers of a received message. """
+    if isinstance(message, dict):
+        # The envelope of a STOMP message, whose body is decoded already.
+        headers = message.get('headers') or {}
+        if message.raw is not None:
+            return message['topic'], message.raw, headers
+
+        # The body is encoded afresh, so whatever the headers said about
+        # the original no longer holds.
+        headers = dict((key, value) for key, value in headers.items()
+                       if key not in (CONTENT_TYPE, CONTENT_ENCODING))
+        body = message['body']
+        if not isinstance(body, (six.text_type, six.binary_type)):
+            body = JSON.dumps(body)
+        return message['topic'], body, headers
+
+    topic = getattr(message, 'topic', None)
+    if topic is None:
+        # qpid
+        topic = message.get('delivery_properties').routing_key
+    return topic, message.body, getattr(message, 'headers', None) or {}
+
+
+class Bridge(object):
+    """ Forwards messages between the extensions of a hub. """
+
+    def __init__(self, hub, rules, max_hops=4, queue_size=10000,
+                 dedupe_size=10000, dedupe_ttl=5.0):
+        self.hub = hub
+        self.rules = [Rule.parse(r) if isinstance(r, six.string_types) else r
+                      for r in rules]
+        self.max_hops = max_hops
+        self.dedupe_size = dedupe_size
+        self.dedupe_ttl = dedupe_ttl
+        self.origin = uuid.uuid4().hex
+        self.looped = self.duplicates = 0
+
+        self.extensions = dict(
+            (ext.name, ext) for ext in hub.extensions if ext.name)
+
+        # {id: when it was forwarded, or None if the id came with it}, for
+        # the messages forwarded most recently.
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self.outlets = {}
+        for rule in self.rules:
+            for name in [rule.source] + rule.destinations:
+                if name != 'websocket' and name not in self.extensions:
+                    raise ValueError("Bridge rule %r names %r, which is not "
+                                     "enabled on this hub" % (rule, name))
+            for name in rule.destinations:
+                if name == 'websocket':
+                    raise ValueError("Browsers already receive messages from "
+                                     "every broker; %r cannot bridge to "
+                                     "websocket" % rule)
+                if name not in self.outlets:
+                    self.outlets[name] = Outbox(
+                        'bridge-%s' % name, self.extensions[name], queue_size)
+
+            if rule.source != 'websocket':
+                self.listen(rule)
+
+    def listen(self, rule):
+        extension = self.extensions[rule.source]
+
+        def receive(message):
+            self.receive(rule, message)
+
+        if rule.source == 'stomp':
+            # STOMP messages are dispatched by the hub.
+            self.hub.topics[rule.topic].append(receive)
+        extension.subscribe(rule.topic, receive)
+
+    @property
+    def sources(self):
+        return set(rule.source for rule in self.rules)
+
+    def receive(self, rule, message):
+        try:
+            topic, body, headers = unpack(message)
+        except Exception:
+            log.exception("Cannot bridge %r" % message)
+            return
+        self.forward(rule.source, topic, body, headers, rules=[rule])
+
+    def forward(self, source, topic, body, headers=None, rules=None):
+        """ Forward a message from `source` along the rules that match it.
+        """
+        headers = headers or {}
+        if rules is None:
+            rules = [r for r in self.rules if r.source == source and
+                     fnmatch.fnmatch(topic, r.topic)]
+
+        destinations = set()
+        for rule in rules:
+            destinations.update(rule.destinations)
+        destinations.discard(source)
+        if not destinations:
+            return
+
+        hops = int(headers.get(HOPS, 0))
+        origin = headers.get(ORIGIN, self.origin)
+        if hops >= self.max_hops or (hops and origin == self.origin):
+            self.looped += 1
+            return
+
+        now = None
+        message_id = headers.get(MESSAGE_ID)
+        if not message_id:
+            now = time.time()
+            data = body if isinstance(body, six.binary_type) else \
+                body.encode('utf-8')
+            topic_data = topic if isinstance(topic, six.binary_type) else \
+                topic.encode('utf-8')
+            message_id = hashlib.sha1(topic_data + b'\0' + data).hexdigest()
+
+        with self._lock:
+            seen = self._seen.pop(message_id, False)
+            if seen is None or (
+                    seen and now is not None and now - seen < self.dedupe_ttl):
+                self._seen[message_id] = seen
+                self.duplicates += 1
+                return
+            self._seen[message_id] = now
+            if len(self._seen) > self.dedupe_size:
+                self._seen.popitem(last=False)
+
+        marks = dict((key, headers[key]) for key in (
+            CONTENT_TYPE, CONTENT_ENCODING) if headers.get(key))
+        if marks.get(CONTENT_TYPE, '').split(';')[0] not in decoders:
+            # Like STOMP's text/plain, which says nothing about the format.
+            marks.pop(CONTENT_TYPE, None)
+        headers = {HOPS: hops + 1, ORIGIN: origin, MESSAGE_ID: message_id}
+        headers.update(marks)
+        for name in destinations:
+            self.outlets[name].put(topic, body, headers)
+
+    def __json__(self):
+        return {
+            'looped': self.looped,
+            'duplicates': self.duplicates,
+            'outlets': [outlet.__json__() for outlet in self.outlets.values()],
+        }
+
+    def close(self):
+        for outlet in self.outlets.values():
+            outlet.close()
@@ -0,0 +1,170 @@
+# This file is part of Moksha.
+# Copyright (C) 2008-2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+:mod:`moksha.hub.claimcheck` - Publishing large bodies by reference
+===================================================================
+
+With ``moksha.claimcheck.store`` set, bodies of at least
+``moksha.claimcheck.threshold`` bytes (after compression) are written to a
+store that every hub can reach, and only a small reference is published::
+
+    moksha.claimcheck.store = file:///srv/moksha/claims
+    moksha.claimcheck.threshold = 1048576
+    moksha.claimcheck.summary = msg_id, timestamp, user
+
+The reference carries the fields of the message named by
+``moksha.claimcheck.summary``, which consumers find under ``summary`` in the
+envelope.  The body itself is only fetched from the store when a consumer
+first looks at it.
+
+Bodies are stored under their SHA-256, so publishing the same body twice
+stores it once.  ``file://`` stores keep them in a directory, typically on a
+shared filesystem.  Other stores are looked up by URL scheme among the
+``moksha.claimcheck.store`` entry points.  Each one is a class taking the
+URL, with ``put(data)`` returning a key and ``get(key)`` returning the data.
+Nothing is ever deleted from a store; that is left to whoever runs it.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+
+import six
+
+from moksha.common.lib.entrypoints import iter_entry_points
+from moksha.hub.compression import CONTENT_ENCODING
+from moksha.hub.serialization import CONTENT_TYPE, decode
+
+CLAIM_CONTENT_TYPE = 'application/vnd.moksha.claim+json'
+
+
+class DirectoryStore(object):
+    """ Keeps every body in a file named by its hash, under `path`. """
+
+    _key = re.compile('^[0-9a-f]{64}$')
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def filename(self, key):
+        if not self._key.match(key):
+            raise ValueError("Bad claim check %r" % key)
+        return os.path.join(self.path, key[:2], key)
+
+    def put(self, data):
+        key = hashlib.sha256(data).hexdigest()
+        filename = self.filename(key)
+        if os.path.exists(filename):
+            return key
+
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another hub got there first.
+                if not os.path.isdir(directory):
+                    raise
+
+        # Readers never see a half-written file.
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, filename)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        return key
+
+    def get(self, key):
+        with open(self.filename(key), 'rb') as f:
+            return f.read()
+
+
+stores = {'file': DirectoryStore}
+
+
+def open_store(url):
+    """ Return the store at `url`; a plain path is a directory. """
+    scheme, sep, rest = url.partition('://')
+    if not sep:
+        return DirectoryStore(url)
+    if scheme == 'file':
+        return DirectoryStore(rest)
+
+    if scheme not in stores:
+        for entry_point in iter_entry_points('moksha.claimcheck.store'):
+            if entry_point.name == scheme:
+                stores[scheme] = entry_point.load()
+                break
+        else:
+            raise ValueError("No claim check store for %r" % url)
+    return stores[scheme](url)
+
+
+class ClaimCheck(object):
+    """ Swaps large bodies for references to a copy in `store`. """
+
+    def __init__(self, store, threshold=1048576, summary=(), cache_size=16):
+        self.store = store
+        self.threshold = threshold
+        self.summary = summary
+        self.cache_size = cache_size
+        # Bodies fetched most recently, since every consumer of a message
+        # asks for it.
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, message, body, headers):
+        """ Return the reference to publish instead of `body`, or None if
+        `body` is small enough to publish as it is.
+        """
+        if not self.store or len(body) < self.threshold:
+            return None
+
+        if isinstance(body, six.text_type):
+            body = body.encode('utf-8')
+        reference = dict(headers)
+        reference['claim'] = self.store.put(body)
+        reference['size'] = len(body)
+        if isinstance(message, dict) and self.summary:
+            reference['summary'] = dict(
+                (key, message[key]) for key in self.summary if key in message)
+        return json.dumps(reference)
+
+    def fetch(self, reference, decompress):
+        """ Return the decoded body that `reference` stands for. """
+        key = reference['claim']
+        with self._lock:
+            data = self._cache.pop(key, None)
+            if data is not None:
+                self._cache[key] = data
+        if data is None:
+            data = self.store.get(key)
+            with self._lock:
+                self._cache[key] = data
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        return decode(data, reference.get(CONTENT_TYPE),
+                      reference.get(CONTENT_ENCODING), decompress)
@@ -0,0 +1,184 @@
+# This file is part of Moksha.
+# Copyright (C) 2008-2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+:mod:`moksha.hub.compression` - Compressing large message bodies
+================================================================
+
+With ``moksha.compression`` set, the hub compresses every encoded body of
+at least ``moksha.compression.threshold`` bytes, and names the codec in a
+``content-encoding`` header (or in front of the body, on brokers without
+headers)::
+
+    moksha.compression = zlib
+    moksha.compression.threshold = 16384
+
+``zlib`` is always available; ``zstd`` and ``lz4`` are when the
+``zstandard`` and ``lz4`` modules are installed.  Receivers only decompress a
+body when somebody first looks at it.
+"""
+
+import threading
+import time
+import zlib
+
+import six
+
+CONTENT_ENCODING = 'content-encoding'
+
+try:
+    _cpu_time = time.thread_time
+except AttributeError:
+    _cpu_time = time.time
+
+
+class Codec(object):
+    """ Compresses bodies, named `encoding` in the content-encoding header.
+    """
+
+    def __init__(self, name, encoding, compress, decompress):
+        self.name = name
+        self.encoding = encoding
+        self.compress = compress
+        self.decompress = decompress
+
+    def __repr__(self):
+        return '<Codec %s (%s)>' % (self.name, self.encoding)
+
+
+# {name: Codec}
+codecs = {}
+# {content encoding: Codec}
+encodings = {}
+
+
+def register(codec):
+    codecs[codec.name] = codec
+    encodings[codec.encoding] = codec
+
+
+def get(name):
+    try:
+        return codecs[name]
+    except KeyError:
+        raise ValueError("Unknown compression %r, expected one of %r" % (
+            name, sorted(codecs)))
+
+
+register(Codec('zlib', 'deflate', zlib.compress, zlib.decompress))
+
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    register(Codec(
+        'zstd', 'zstd',
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data)))
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    register(Codec('lz4', 'lz4', lz4.frame.compress, lz4.frame.decompress))
+
+
+def decompress(data, encoding):
+    try:
+        codec = encodings[encoding]
+    except KeyError:
+        raise ValueError("Unknown content encoding %r" % encoding)
+    return codec.decompress(data)
+
+
+class TopicStats(object):
+    """ How much compression saved on one topic, and what it cost. """
+
+    def __init__(self):
+        self.compressed = self.decompressed = 0
+        self.bytes_in = self.bytes_out = 0
+        self.compress_time = self.decompress_time = 0.0
+
+    def __json__(self):
+        return {
+            "compressed": self.compressed,
+            "decompressed": self.decompressed,
+            "ratio": self.bytes_out and float(self.bytes_in) / self.bytes_out,
+            "compress_time": self.compress_time,
+            "decompress_time": self.decompress_time,
+        }
+
+
+class Compression(object):
+    """ Compresses the bodies a hub sends, and decompresses those it gets,
+    keeping per-topic stats of both.
+
+    Without a `codec`, nothing is compressed, but whatever arrives compressed
+    is still decompressed.
+    """
+
+    def __init__(self, codec=None, threshold=16384):
+        self.codec = get(codec) if codec else None
+        self.threshold = threshold
+        # {topic: TopicStats}
+        self.topics = {}
+        self._lock = threading.Lock()
+
+    def stats(self, topic):
+        if isinstance(topic, six.binary_type):
+            topic = topic.decode('utf-8')
+        try:
+            return self.topics[topic]
+        except KeyError:
+            with self._lock:
+                return self.topics.setdefault(topic, TopicStats())
+
+    def compress(self, topic, body):
+        """ Return `body`, compressed if it is worth it, and its encoding.
+        """
+        if not self.codec or len(body) < self.threshold:
+            return body, None
+        if isinstance(body, six.text_type):
+            body = body.encode('utf-8')
+
+        start = _cpu_time()
+        compressed = self.codec.compress(body)
+        elapsed = _cpu_time() - start
+
+        stats = self.stats(topic)
+        stats.compressed += 1
+        stats.bytes_in += len(body)
+        stats.bytes_out += len(compressed)
+        stats.compress_time += elapsed
+        return compressed, self.codec.encoding
+
+    def decompress(self, topic, data, encoding):
+        start = _cpu_time()
+        data = decompress(data, encoding)
+        elapsed = _cpu_time() - start
+
+        stats = self.stats(topic)
+        stats.decompressed += 1
+        stats.decompress_time += elapsed
+        return data
+
+    def __json__(self):
+        with self._lock:
+            topics, self.topics = self.topics, {}
+        # Start the counters over once read, like consumers do.
+        return dict((topic, stats.__json__())
+                    for topic, stats in topics.items())
@@ -18,40 +18,54 @@
 
 
 import fnmatch
+import functools
 import os
 import six
 import sys
+import uuid
 import json as JSON
 from collections import defaultdict
 
-try:
-    from collections import OrderedDict
-except ImportError:
-    from ordereddict import OrderedDict
-
 from kitchen.iterutils import iterate
+from moksha.common.exc import SpoolFull
+from moksha.common.lib.converters import asbool, asint
 from moksha.common.lib.helpers import appconfig
+from moksha.common.lib.entrypoints import iter_entry_points
 
 # Look in the current directory for egg-info
 if os.getcwd() not in sys.path:
     sys.path.insert(0, os.getcwd())
 
-import pkg_resources
 import logging
 
 from twisted.internet import protocol
 from txws import WebSocketFactory
 from moksha.common.lib.helpers import get_moksha_config_path
-from moksha.common.lib.converters import asbool
+from moksha.hub.bridge import Bridge
+from moksha.hub.inproc import ORIGIN, InprocHubExtension
+from moksha.hub.messaging import Envelope, Outbox
+from moksha.hub.claimcheck import CLAIM_CONTENT_TYPE, ClaimCheck, open_store
+from moksha.hub.compression import CONTENT_ENCODING, Compression
+from moksha.hub.serialization import (
+    CONTENT_TYPE, Serializers, content_type_of, decode, inline, peek)
+from moksha.hub.settings import Settings
+from moksha.hub.shm import ShmHubExtension
+from moksha.hub.sqlite import SQLiteHubExtension
 
 AMQPHubExtension, StompHubExtension, ZMQHubExtension = None, None, None
+MultiStompHubExtension = PikaAMQPHubExtension = None
 try:
     from moksha.hub.amqp import AMQPHubExtension
 except ImportError:
     pass
 
 try:
-    from moksha.hub.stomp import StompHubExtension
+    from moksha.hub.amqp.pika091 import PikaAMQPHubExtension
+except ImportError:
+    pass
+
+try:
+    from moksha.hub.stomp import StompHubExtension, MultiStompHubExtension
 except ImportError:
     pass
 
@@ -75,8 +89,21 @@ def find_hub_extensions(config):
         'stomp_broker': StompHubExtension,
         'stomp_uri': StompHubExtension,
         'zmq_enabled': ZMQHubExtension,
+        'moksha.sqlite': SQLiteHubExtension,
     }
 
+    # AMQP 0-9-1 brokers, like RabbitMQ, are spoken to with pika.
+    if config.get('amqp_protocol') == '0-9-1':
+        possible_bases['amqp_broker'] = PikaAMQPHubExtension
+
+    # Delivering to subscribers in this process.
+    if asbool(config.get('moksha.inproc', False)):
+        possible_bases['moksha.inproc'] = InprocHubExtension
+
+    # Sharing memory with the other hubs on this host.
+    if asbool(config.get('moksha.shm', False)):
+        possible_bases['moksha.shm'] = ShmHubExtension
+
     broker_vals = [config.get(k, None) for k in possible_bases.keys()]
 
     # If we're running outside of middleware and hub, load config
@@ -93,18 +120,28 @@ def find_hub_extensions(config):
     if not any(broker_vals):
         raise ValueError("No messaging methods defined.")
 
-    if len(list(filter(None, broker_vals))) > 1:
+    if len(list(filter(None, broker_vals))) > 1 and \
+       not config.get('moksha.bridge'):
         log.warning("Running with multiple brokers.  "
-                    "This mode is experimental and may or may not work")
+                    "This mode is experimental and may or may not work; "
+                    "see moksha.bridge to forward messages between them")
 
     extensions = set([
         b for k, b in possible_bases.items() if config.get(k, None) and b
     ])
+
+    # Keep several connections to the STOMP broker(s) open at once.
+    if StompHubExtension in extensions and \
+       asint(config.get('stomp_connections', 1)) > 1:
+        extensions.remove(StompHubExtension)
+        extensions.add(MultiStompHubExtension)
+
     return extensions
 
 
 class MokshaHub(object):
     topics = None  # {topic_name: [callback,]}
+    bridge = None  # <Bridge>
 
     def __init__(self, config, topics=None):
         self.config = config
@@ -122,38 +159,192 @@ class MokshaHub(object):
             for callback in callbacks:
                 self.topics[topic].append(callback)
 
-        self.extensions = [
-            ext(self, config) for ext in find_hub_extensions(config)
-        ]
+        extensions = find_hub_extensions(config)
+
+        # Validate and convert the configuration once, up front.  Hot paths
+        # read these attributes rather than re-parsing config strings.
+        self.settings = Settings(config)
+        self.serializers = Serializers(self.settings.moksha_serializers,
+                                       self.settings.moksha_serializer)
+        self.compression = Compression(
+            self.settings.moksha_compression,
+            self.settings.moksha_compression_threshold)
+        self.claims = None
+        if self.settings.moksha_claimcheck_store:
+            self.claims = ClaimCheck(
+                open_store(self.settings.moksha_claimcheck_store),
+                self.settings.moksha_claimcheck_threshold,
+                self.settings.moksha_claimcheck_summary,
+                self.settings.moksha_claimcheck_cache_size)
+
+        self.extensions = [ext(self, config) for ext in extensions]
+        self.loopbacks = [ext for ext in self.extensions if ext.in_process]
+        self.brokers = [ext for ext in self.extensions if not ext.in_process]
+
+        # Local subscribers already have what this hub sends, so the copies
+        # that come back from the brokers are marked to be dropped.
+        self.origin = None
+        if self.loopbacks and self.brokers:
+            self.origin = uuid.uuid4().hex
+
+        # With moksha.outbox.size set, every broker is sent to from a queue
+        # and thread of its own.
+        self.outboxes = []
+        if self.settings.moksha_outbox_size:
+            self.outboxes = [
+                Outbox(ext.name or type(ext).__name__, ext,
+                       self.settings.moksha_outbox_size)
+                for ext in self.brokers]
+
+    def encode(self, codec, topic, message):
+        """ Return `message` serialized with `codec` and the headers that
+        say how.  Large bodies are compressed, and the largest are swapped
+        for a claim check, as configured.
+        """
+        body = codec.encode(message)
+        headers = {CONTENT_TYPE: codec.content_type}
+        body, encoding = self.compression.compress(topic, body)
+        if encoding:
+            headers[CONTENT_ENCODING] = encoding
+        if self.claims:
+            reference = self.claims.check(message, body, headers)
+            if reference is not None:
+                return reference, {CONTENT_TYPE: CLAIM_CONTENT_TYPE}
+        return body, headers
 
     def send_message(self, topic, message, jsonify=True):
         """ Send a message to a specific topic.
 
         :topic: A topic or list of topics to send the message to.
         :message: The message body.  Can be a string, list, or dict.
-        :jsonify: To automatically encode non-strings to JSON
+        :jsonify: To automatically encode non-strings, with the serializer
+            configured for each topic (JSON unless ``moksha.serializers``
+            says otherwise)
 
+        Raises :class:`moksha.common.exc.SpoolFull` if a broker could not take
+        the message, once every other broker has been given it.
         """
 
-        if jsonify:
-            message = JSON.dumps(message)
-
         if not isinstance(topic, list):
             topics = [topic]
         else:
             topics = topic
 
+        # Topics that share a serializer share the encoded body.
+        encoded = {}
+        full = None
         for topic in topics:
+            # Local subscribers get the message as it is.
+            for ext in self.loopbacks:
+                if jsonify:
+                    ext.send_objects([(topic, message, {})])
+                else:
+                    ext.send_message(topic, message)
+            if not self.brokers:
+                continue
+
+            headers = {}
+            body = message
+            if jsonify:
+                codec = self.serializers.for_topic(topic)
+                if codec not in encoded:
+                    encoded[codec] = self.encode(codec, topic, message)
+                body, headers = encoded[codec]
+
             if isinstance(topic, six.text_type):
                 # txzmq isn't smart enough to handle unicode yet.
                 # Try removing this and sending a unicode topic in the future
                 # to see if it works.
                 topic = topic.encode('utf-8')
 
-            for ext in self.extensions:
-                ext.send_message(topic, message)
+            if self.origin:
+                headers = dict(headers, **{ORIGIN: self.origin})
+            if self.outboxes:
+                for outbox in self.outboxes:
+                    outbox.put(topic, body, headers)
+            else:
+                for ext in self.brokers:
+                    try:
+                        if ext.carries_headers:
+                            ext.send_message(topic, body, **headers)
+                        else:
+                            ext.send_message(topic, inline(body, headers))
+                    except SpoolFull as e:
+                        # The other brokers still get it.
+                        full = full or e
+
+        if full:
+            raise full
+
+    def send_messages(self, messages, jsonify=True):
+        """ Send a batch of messages.
+
+        :messages: An iterable of ``(topic, message, headers)`` tuples, where
+            ``headers`` may be left off or None.  Only brokers that carry
+            headers are given them.
+        :jsonify: To automatically encode non-strings, as with
+            :meth:`send_message`
+
+        Each broker gets the whole batch at once, so it can write it in one
+        go rather than a message at a time.  As with :meth:`send_message`,
+        :class:`moksha.common.exc.SpoolFull` is raised once every broker has
+        been given the batch.
+        """
+
+        batch, objects = [], []
+        for item in messages:
+            topic, message = item[0], item[1]
+            headers = dict(item[2] or {}) if len(item) > 2 else {}
+            if self.loopbacks:
+                objects.append((topic, message, dict(headers)))
+            if not self.brokers:
+                continue
+            if jsonify:
+                codec = self.serializers.for_topic(topic)
+                message, marks = self.encode(codec, topic, message)
+                headers.update(marks)
+            if self.origin:
+                headers[ORIGIN] = self.origin
+            if isinstance(topic, six.text_type):
+                topic = topic.encode('utf-8')
+            batch.append((topic, message, headers))
+
+        for ext in self.loopbacks:
+            if jsonify:
+                ext.send_objects(objects)
+            else:
+                ext.send_messages(objects)
+
+        if not batch:
+            return
+
+        if self.outboxes:
+            for outbox in self.outboxes:
+                for topic, message, headers in batch:
+                    outbox.put(topic, message, headers)
+            return
+
+        bare, full = None, None
+        for ext in self.brokers:
+            try:
+                if ext.carries_headers:
+                    ext.send_messages(batch)
+                else:
+                    if bare is None:
+                        bare = [(topic, inline(message, headers), {})
+                                for topic, message, headers in batch]
+                    ext.send_messages(bare)
+            except SpoolFull as e:
+                full = full or e
+
+        if full:
+            raise full
 
     def close(self):
+        if self.bridge:
+            self.bridge.close()
+        for outbox in self.outboxes:
+            outbox.close()
         try:
             for ext in self.extensions:
                 if hasattr(ext, 'close'):
@@ -177,6 +368,16 @@ class MokshaHub(object):
         for ext in self.extensions:
             ext.subscribe(topic, callback)
 
+    def subscribe_group(self, group, topic, callback):
+        """
+        Like :meth:`subscribe`, but `callback` shares the messages on `topic`
+        with the subscribers of the same `group` on every other hub, so that
+        each message is handled only once.
+        """
+
+        for ext in self.extensions:
+            ext.subscribe_group(group, topic, callback)
+
     def consume_amqp_message(self, message):
         self.message_accept(message)
         try:
@@ -186,14 +387,62 @@ class MokshaHub(object):
             # proxy it to STOMP
             return
 
-        # TODO -- this isn't extensible.  how should forwarding work if there
-        # are three broker types enabled?
-        for ext in self.extensions:
-            if StompHubExtension and isinstance(ext, StompHubExtension):
-                ext.send_message(self, topic.encode('utf8'),
-                                 message.body.encode('utf8'))
+        # Forwarding to other brokers is up to the moksha.bridge rules.
+        if self.bridge:
+            self.bridge.forward('amqp', topic, message.body)
+
+    def envelope(self, topic, raw, message_headers=None, fallback=None,
+                 **items):
+        """ Return the :class:`Envelope` of a body received on `topic`.
+
+        Plain bodies are decoded right away.  Compressed bodies are only
+        decompressed, and claim-checked ones fetched, when somebody first
+        looks at them.  A body that cannot be decoded is passed on as
+        ``fallback()``, or as it came.
+        """
+        content_type, encoding = peek(raw, message_headers)
+        decompress = functools.partial(self.compression.decompress, topic)
+
+        reference = None
+        if content_type == CLAIM_CONTENT_TYPE:
+            try:
+                reference = decode(raw)
+            except Exception as e:
+                log.warning('Cannot decode claim check: %s -> %r' % (e, raw))
 
-    def consume_stomp_message(self, message):
+        def load():
+            try:
+                if reference is not None:
+                    if not self.claims:
+                        raise ValueError("no moksha.claimcheck.store to "
+                                         "fetch %s from" % reference['claim'])
+                    return self.claims.fetch(reference, decompress)
+                return decode(raw, content_type, encoding, decompress)
+            except Exception as e:
+                log.debug('Cannot decode body: %s -> %r' % (e, raw))
+                return fallback() if fallback else raw
+
+        if reference is not None:
+            # Consumers can get by on the summary without the body.
+            return Envelope.lazy(load, topic=topic,
+                                 summary=reference.get('summary'), **items)
+        elif encoding:
+            return Envelope.lazy(load, topic=topic, **items)
+        return Envelope(body=load(), topic=topic, **items)
+
+    def echo(self, headers):
+        """ Whether a received message is one this hub sent, and has
+        delivered to its local subscribers already.
+        """
+        return bool(self.origin) and isinstance(headers, dict) and \
+            headers.get(ORIGIN) == self.origin
+
+    def consume_stomp_message(self, message, ack=None):
+        """ Feed a STOMP frame to the consumers of its topic.
+
+        If `ack` is given, it is attached to the envelope, so that consumers
+        which defer their work can hold it until they are done.
+        """
         from moksha.hub.reactor import reactor
 
         headers = message['headers']
@@ -209,31 +458,23 @@ class MokshaHub(object):
             log.debug("Got message without a topic: %r" % message)
             return
 
-        # https://stomp.github.io/stomp-specification-1.2.html#Value_Encoding
-        if asbool(self.config.get('stomp_unescape_headers', True)):
-            replacements = OrderedDict([
-                ('\\r', '\r'),
-                ('\\n', '\n'),
-                ('\c', ':'),
-                ('\\\\', '\\'),
-            ])
-            for key in headers:
-                for old, new in replacements.items():
-                    headers[key] = headers[key].replace(old, new)
+        if self.echo(headers):
+            return True
 
-        # FIXME: only do this if the consumer wants it `jsonified`
-        try:
-            if message['body']:
-                body = JSON.loads(message['body'])
-            else:
-                body = {}
-        except Exception as e:
-            log.warning('Cannot decode body from JSON: %s -> %r' % (e, message))
-            #body = {}
-            body = message['body']
+        # Binary formats need the body before it is decoded as text.
+        raw = getattr(message, 'raw_body', None)
+        if raw is None:
+            raw = message['body']
 
-        # feed all of our consumers
-        envelope = {'body': body, 'topic': topic, 'headers': headers}
+        # FIXME: only do this if the consumer wants it `jsonified`
+        if raw:
+            envelope = self.envelope(topic, raw, headers,
+                                     fallback=lambda: message['body'],
+                                     headers=headers)
+        else:
+            envelope = Envelope(body={}, topic=topic, headers=headers)
+        envelope.ack = ack
+        envelope.raw = raw
 
         handled = True
 
@@ -269,6 +510,14 @@ class CentralMokshaHub(MokshaHub):
 
         super(CentralMokshaHub, self).__init__(config)
 
+        if self.settings.moksha_bridge:
+            self.bridge = Bridge(
+                self, self.settings.moksha_bridge,
+                max_hops=self.settings.moksha_bridge_max_hops,
+                queue_size=self.settings.moksha_bridge_queue_size,
+                dedupe_size=self.settings.moksha_bridge_dedupe_size,
+                dedupe_ttl=self.settings.moksha_bridge_dedupe_ttl)
+
         # FIXME -- this needs to be reworked.
         # TODO -- consider moving this to the AMQP specific modules
         for ext in self.extensions:
@@ -282,25 +531,28 @@ class CentralMokshaHub(MokshaHub):
     def __init_websocket_server(self):
         from moksha.hub.reactor import reactor
 
-        if self.config.get('moksha.livesocket.backend', 'amqp') != 'websocket':
+        if self.settings.moksha_livesocket_backend != 'websocket':
             return
         log.info("Enabling websocket server")
 
-        port = int(self.config.get('moksha.livesocket.websocket.port', 0))
+        port = self.settings.moksha_livesocket_websocket_port
         if not port:
             raise ValueError("websocket is backend, but no port set")
 
-        interface = self.config.get('moksha.livesocket.websocket.interface')
-        interface = interface or ''
+        interface = self.settings.moksha_livesocket_websocket_interface
 
         class RelayProtocol(protocol.Protocol):
             moksha_hub = self
 
             def send_to_ws(self, zmq_message):
                 """ Callback.  Sends a message to the browser """
+                body = zmq_message.body
+                if not getattr(zmq_message, 'decoded', False):
+                    body = decode(body, *content_type_of(
+                        getattr(zmq_message, 'headers', None)))
                 msg = JSON.dumps({
                     'topic': zmq_message.topic,
-                    'body': JSON.loads(zmq_message.body),
+                    'body': body,
                 })
                 self.transport.write(msg)
 
@@ -333,8 +585,13 @@ class CentralMokshaHub(MokshaHub):
                         #   https://fedorahosted.org/moksha/ticket/245
                         #   https://github.com/gregjurman/zmqfirewall
 
-                        key = 'moksha.livesocket.websocket.client2server'
-                        if asbool(self.moksha_hub.config.get(key, False)):
+                        settings = self.moksha_hub.settings
+                        bridge = self.moksha_hub.bridge
+                        if bridge and 'websocket' in bridge.sources:
+                            # Only where the bridge rules allow.
+                            bridge.forward('websocket', json['topic'],
+                                           JSON.dumps(json['body']))
+                        elif settings.moksha_livesocket_websocket_client2server:
                             # Simply forward on the message through the hub.
                             self.moksha_hub.send_message(
                                 json['topic'],
@@ -392,7 +649,7 @@ class CentralMokshaHub(MokshaHub):
         if self._consumers is None:
             log.debug("Loading from entry-points.")
             self._consumers = []
-            for consumer in pkg_resources.iter_entry_points('moksha.consumer'):
+            for consumer in iter_entry_points('moksha.consumer'):
                 try:
                     c = consumer.load()
                     try:
@@ -434,7 +691,7 @@ class CentralMokshaHub(MokshaHub):
             log.debug("Loading from entry-points.")
             self._producers = []
             for producer in sum([
-                list(pkg_resources.iter_entry_points(epoint))
+                list(iter_entry_points(epoint))
                 for epoint in ('moksha.producer', 'moksha.stream')
             ], []):
                 try:
@@ -0,0 +1,140 @@
+# This file is part of Moksha.
+# Copyright (C) 2008-2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An in-process hub extension, enabled with ``moksha.inproc = True``.
+
+Messages published by the hub are handed to its own subscribers as they
+are, without being encoded, copied or sent anywhere.  Subscribers share the
+published object, so they must not change it.  Topics are matched with
+shell-style wildcards, as in ``hub.topics``.
+
+On its own, it makes a hub that needs no broker at all.  Next to zeromq,
+STOMP or AMQP, local subscribers get local messages straight away, while the
+brokers still carry them to every other hub.  Messages that come back from
+the brokers carry a ``moksha-origin`` header naming the hub that sent them,
+and the hub drops its own.  zeromq has no headers, so the hub's own publish
+endpoint should be left out of its ``zmq_subscribe_endpoints``.
+"""
+
+import collections
+import fnmatch
+import logging
+
+import six
+
+from twisted.python.threadable import isInIOThread
+
+from moksha.hub.messaging import MessagingHubExtension
+from moksha.hub.reactor import reactor, Handoff
+
+log = logging.getLogger('moksha.hub')
+
+ORIGIN = 'moksha-origin'
+
+
+class InprocMessage(object):
+    """ A message published in this process.
+
+    When `decoded` is set, `body` is the object that was published rather
+    than its encoding.
+    """
+    ack = None
+
+    def __init__(self, topic, body, headers=None, decoded=False):
+        self.topic = topic
+        self.body = body
+        self.headers = headers or {}
+        self.decoded = decoded
+
+    def __json__(self):
+        return {'topic': self.topic, 'body': self.body}
+
+    def __repr__(self):
+        return "<InprocMessage; topic: %r, body: %r>" % (self.topic, self.body)
+
+
+class InprocHubExtension(MessagingHubExtension):
+    name = 'inproc'
+    carries_headers = True
+    in_process = True
+
+    def __init__(self, hub, config):
+        self.hub = hub
+        self.config = config
+        # {topic pattern: [callback,]}
+        self.callbacks = collections.defaultdict(list)
+        # {topic: [callback,]}, worked out once per topic
+        self._matches = {}
+        # Subscribers are called in the reactor thread, like those of every
+        # other extension.
+        self._outgoing = Handoff(self.deliver)
+        super(InprocHubExtension, self).__init__()
+
+    def send_message(self, topic, message, **headers):
+        self.send_messages([(topic, message, headers)])
+
+    def send_messages(self, messages, decoded=False):
+        messages = [
+            InprocMessage(topic.decode('utf-8')
+                          if isinstance(topic, six.binary_type) else topic,
+                          body, headers, decoded)
+            for topic, body, headers in messages]
+        if reactor.running and not isInIOThread():
+            self._outgoing.extend(messages)
+        else:
+            self.deliver(messages)
+
+    def send_objects(self, messages):
+        """ Deliver ``(topic, object, headers)`` tuples without encoding. """
+        self.send_messages(messages, decoded=True)
+
+    def match(self, topic):
+        try:
+            return self._matches[topic]
+        except KeyError:
+            pass
+        callbacks = []
+        for pattern, subscribed in list(self.callbacks.items()):
+            if pattern == topic or fnmatch.fnmatch(topic, pattern):
+                callbacks.extend(subscribed)
+        self._matches[topic] = callbacks
+        return callbacks
+
+    def deliver(self, messages):
+        for message in messages:
+            for callback in self.match(message.topic):
+                try:
+                    callback(message)
+                except Exception:
+                    log.exception("%r failed on a message to %s" % (
+                        callback, message.topic))
+
+    def subscribe(self, topic, callback):
+        self.callbacks[topic].append(callback)
+        self._matches.clear()
+        super(InprocHubExtension, self).subscribe(topic, callback)
+
+    def unsubscribe(self, callback):
+        for topic, callbacks in list(self.callbacks.items()):
+            while callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                del self.callbacks[topic]
+        self._matches.clear()
+        super(InprocHubExtension, self).unsubscribe(callback)
+
+    def close(self):
+        self._outgoing.drain()
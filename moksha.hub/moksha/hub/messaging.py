@@ -15,6 +15,207 @@
 #
 # Authors: Luke Macken <lmacken@redhat.com>
 
+import logging
+import threading
+import time
+from collections import deque
+
+from six.moves import queue
+
+from moksha.hub.serialization import inline
+
+log = logging.getLogger('moksha.hub')
+
+
+class Acknowledgement(object):
+    """
+    Tracks the outstanding work on a single incoming message.
+
+    The extension that received the message holds the first reference and
+    releases it once it has handed the message to every subscriber.  Anyone
+    who defers the real work (like a :class:`Consumer` queueing the message
+    for a worker thread) calls :meth:`hold` first and :meth:`release` when it
+    is done.  `callback` is called exactly once, with whether every party
+    handled the message, when the last reference is released.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.handled = True
+        self._pending = 1
+        self._lock = threading.Lock()
+
+    def hold(self):
+        with self._lock:
+            self._pending += 1
+
+    def release(self, handled=True):
+        with self._lock:
+            self._pending -= 1
+            self.handled = self.handled and handled is not False
+            done = self._pending == 0
+
+        if done:
+            self.callback(self.handled)
+
+
+class Envelope(dict):
+    """ The dictionary form of a message, as handed to consumers.
+
+    It behaves exactly like a plain dict, but can also carry the
+    :class:`Acknowledgement` of the message it was built from, and the body
+    as it came off the wire (`raw`).
+
+    The body of an envelope made with :meth:`lazy` is only worked out (say,
+    decompressed) the first time somebody looks at it, and only once.
+    """
+    ack = None
+    raw = None
+    _load = None
+
+    @classmethod
+    def lazy(cls, load, **items):
+        envelope = cls(**items)
+        envelope._load = load
+        envelope._loading = threading.Lock()
+        return envelope
+
+    def _body(self):
+        if self._load is not None:
+            with self._loading:
+                if self._load is not None:
+                    dict.__setitem__(self, 'body', self._load())
+                    self._load = None
+
+    def __missing__(self, key):
+        if key == 'body' and self._load is not None:
+            self._body()
+            return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if key == 'body' and self._load is not None:
+            return True
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        self._body()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._body()
+        return dict.__len__(self)
+
+    def __eq__(self, other):
+        self._body()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        self._body()
+        return dict.__repr__(self)
+
+    def get(self, key, default=None):
+        if key == 'body':
+            self._body()
+        return dict.get(self, key, default)
+
+    def keys(self):
+        self._body()
+        return dict.keys(self)
+
+    def values(self):
+        self._body()
+        return dict.values(self)
+
+    def items(self):
+        self._body()
+        return dict.items(self)
+
+    def copy(self):
+        self._body()
+        return dict(self)
+
+
+class Outbox(object):
+    """ A bounded queue of outgoing messages for one extension, and the
+    thread that sends them.
+
+    Whoever publishes only pays for putting the message on the queue, so an
+    extension that blocks (a stalled transport, a slow broker) only holds up
+    its own messages.  When the queue is full, new messages are dropped and
+    counted rather than blocking the publisher.
+    """
+
+    def __init__(self, name, extension, size=10000):
+        self.name = name
+        self.extension = extension
+        self.queue = queue.Queue(size)
+        self.sent = self.dropped = self.errors = 0
+        # How long recent messages took from the queue to the extension.
+        self._times = deque(maxlen=1024)
+        self.thread = threading.Thread(
+            target=self.run, name='moksha-outbox-%s' % name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, topic, message, headers=None):
+        try:
+            self.queue.put_nowait((time.time(), topic, message, headers))
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                log.warning("Outbox for %s is full, %i messages dropped so "
+                            "far" % (self.name, self.dropped))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is StopIteration:
+                break
+            queued, topic, message, headers = item
+            if not headers:
+                headers = {}
+            elif not self.extension.carries_headers:
+                message = inline(message, headers)
+                headers = {}
+            try:
+                self.extension.send_message(topic, message, **headers)
+                self.sent += 1
+            except Exception:
+                self.errors += 1
+                log.exception("Failed to send a message to %r through %s" % (
+                    topic, self.name))
+            self._times.append(time.time() - queued)
+
+    def close(self, timeout=1):
+        """ Send what is queued already, for up to `timeout` seconds. """
+        try:
+            self.queue.put(StopIteration, timeout=timeout)
+        except queue.Full:
+            # The extension is stuck; let it go down with the process.
+            return
+        self.thread.join(timeout)
+
+    def __json__(self):
+        results = {
+            "name": self.name,
+            "backlog": self.queue.qsize(),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "times": list(self._times),
+        }
+        # Reset these counters before returning, like consumers do.
+        self.sent = self.dropped = self.errors = 0
+        self._times.clear()
+        return results
+
+
 class MessagingHubExtension(object):
     """
     A generic messaging hub.
@@ -22,14 +223,46 @@ class MessagingHubExtension(object):
     This class represents the base functionality of the protocol-level hubs.
     """
 
+    # What the bridge calls this kind of broker, whether it can send
+    # arbitrary message headers, and whether it is given messages before
+    # they are encoded (see :meth:`send_objects`).
+    name = None
+    carries_headers = False
+    in_process = False
+
     def __init__(self):
         pass
 
     def send_message(self, topic, message, **headers):
         pass
 
+    def send_messages(self, messages):
+        """ Send a batch of ``(topic, message, headers)`` tuples.
+
+        Extensions that can hand a whole batch to their broker at once
+        override this; the default sends the messages one at a time.
+        """
+        for topic, message, headers in messages:
+            self.send_message(topic, message, **headers)
+
+    def send_objects(self, messages):
+        """ Send ``(topic, object, headers)`` tuples that were never encoded.
+
+        Only extensions that set :attr:`in_process` are asked to.
+        """
+        raise NotImplementedError
+
     def subscribe(self, topic, callback):
         pass
 
+    def subscribe_group(self, group, topic, callback):
+        """
+        Subscribe `callback` to `topic` on behalf of a consumer group.
+
+        Extensions that cannot share work between hubs fall back to a plain
+        subscription, so every member of the group sees every message.
+        """
+        self.subscribe(topic, callback)
+
     def unsubscribe(self, callback):
         pass
@@ -70,7 +70,11 @@ class MonitoringProducer(PollingProducer):
         data = {
             "consumers": self.serialize(self.hub.consumers),
             "producers": self.serialize(self.hub.producers),
+            "outboxes": self.serialize(self.hub.outboxes),
+            "compression": self.serialize(self.hub.compression),
         }
+        if self.hub.bridge:
+            data["bridge"] = self.serialize(self.hub.bridge)
         if self.socket:
             self.socket.send_string(json.dumps(data))
 
@@ -19,6 +19,7 @@
 Choses the best platform-specific Twisted reactor
 """
 
+import collections
 import sys
 
 try:
@@ -35,3 +36,48 @@ except (ImportError, AssertionError): # reactor already installed
     pass
 
 from twisted.internet import reactor
+
+
+class Handoff(object):
+    """ Passes items from any thread to `callback` in the reactor thread.
+
+    Twisted transports (and zeromq sockets) may only be used from the
+    reactor thread, but consumers and producers publish and acknowledge from
+    worker threads.  Those threads :meth:`put` items on a deque, which needs
+    no lock, and only the first item since the last :meth:`drain` wakes the
+    reactor up.  `callback` then gets everything queued up by that time as
+    one list.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.items = collections.deque()
+        self._scheduled = False
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        self.items.append(item)
+        if not self._scheduled:
+            self._scheduled = True
+            reactor.callFromThread(self.drain)
+
+    def extend(self, items):
+        """ Like :meth:`put`, for several items and a single wakeup. """
+        self.items.extend(items)
+        if self.items and not self._scheduled:
+            self._scheduled = True
+            reactor.callFromThread(self.drain)
+
+    def drain(self):
+        self._scheduled = False
+        items = []
+        popleft = self.items.popleft
+        try:
+            while True:
+                items.append(popleft())
+        except IndexError:
+            pass
+        if items:
+            self.callback(items)
@@ -0,0 +1,250 @@
+# This file is part of Moksha.
+# Copyright (C) 2008-2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+:mod:`moksha.hub.serialization` - Encoding message bodies
+=========================================================
+
+The hub encodes the messages it sends with a codec chosen by topic, and names
+the codec's content type in a ``content-type`` header.  ``json`` (the
+standard library) is always available, as are ``orjson``, ``ujson`` and
+``msgpack`` when they are installed::
+
+    moksha.serializer = json
+    moksha.serializers = org.fedoraproject.prod.buildsys.*:msgpack,
+                         org.fedoraproject.prod.*:orjson
+
+The first pattern that matches a topic wins, and ``moksha.serializer`` covers
+the rest.  Every JSON codec writes the same content type, and receivers
+decode it with the fastest one installed.
+
+Brokers that cannot carry headers (zeromq, qpid) get JSON bodies exactly as
+before.  Bodies in any other format are prefixed with a NUL byte and their
+content type, which no JSON body starts with.  Hubs that predate this module
+only understand JSON, so a topic should only be switched to another format
+once everything subscribed to it has been upgraded.
+"""
+
+import fnmatch
+import json
+import threading
+
+import six
+
+from moksha.hub import compression
+from moksha.hub.compression import CONTENT_ENCODING
+
+CONTENT_TYPE = 'content-type'
+JSON_CONTENT_TYPE = 'application/json'
+
+_MARK = b'\x00'
+
+
+class Codec(object):
+    """ Turns message bodies into bytes or text of `content_type`, and back.
+
+    `binary` codecs produce bytes that are not valid UTF-8 text.
+    """
+
+    def __init__(self, name, content_type, dumps, loads, binary=False):
+        self.name = name
+        self.content_type = content_type
+        self.encode = dumps
+        self.decode = loads
+        self.binary = binary
+
+    def __repr__(self):
+        return '<Codec %s (%s)>' % (self.name, self.content_type)
+
+
+# {name: Codec}
+codecs = {}
+# {content type: Codec}, the codec to decode each content type with
+decoders = {}
+
+
+def register(codec, decoder=False):
+    """ Make `codec` available by name.
+
+    It decodes its content type if nothing else does yet, or if `decoder`
+    is set.
+    """
+    codecs[codec.name] = codec
+    if decoder or codec.content_type not in decoders:
+        decoders[codec.content_type] = codec
+
+
+def get(name):
+    try:
+        return codecs[name]
+    except KeyError:
+        raise ValueError("Unknown serializer %r, expected one of %r" % (
+            name, sorted(codecs)))
+
+
+register(Codec('json', JSON_CONTENT_TYPE, json.dumps, json.loads))
+
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    register(Codec('ujson', JSON_CONTENT_TYPE, ujson.dumps, ujson.loads),
+             decoder=True)
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    register(Codec('orjson', JSON_CONTENT_TYPE, orjson.dumps, orjson.loads),
+             decoder=True)
+
+try:
+    import msgpack
+except ImportError:
+    pass
+else:
+    register(Codec(
+        'msgpack', 'application/msgpack',
+        lambda obj: msgpack.packb(obj, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False),
+        binary=True))
+
+
+class Serializers(object):
+    """ Picks the codec for each topic from ``pattern:codec`` rules. """
+
+    def __init__(self, rules=(), default='json'):
+        self.default = get(default)
+        self.rules = []
+        for rule in rules:
+            try:
+                pattern, name = rule.rsplit(':', 1)
+            except ValueError:
+                raise ValueError("Bad serializer rule %r, expected "
+                                 "topic:serializer" % rule)
+            self.rules.append((pattern.strip(), get(name.strip())))
+
+        # {topic: Codec}, since the same topics come up over and over.
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def for_topic(self, topic):
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+
+        name = topic
+        if isinstance(name, six.binary_type):
+            name = name.decode('utf-8')
+        codec = self.default
+        for pattern, candidate in self.rules:
+            if fnmatch.fnmatch(name, pattern):
+                codec = candidate
+                break
+
+        with self._lock:
+            if len(self._cache) > 10000:
+                self._cache.clear()
+            self._cache[topic] = codec
+        return codec
+
+
+def framed(data):
+    """ Whether `data` carries its content type in front of the body. """
+    return isinstance(data, six.binary_type) and data[:1] == _MARK
+
+
+def inline(body, headers):
+    """ Return `body` as it goes to a broker that cannot carry `headers`. """
+    headers = headers or {}
+    content_type = headers.get(CONTENT_TYPE) or JSON_CONTENT_TYPE
+    content_encoding = headers.get(CONTENT_ENCODING)
+    if content_type == JSON_CONTENT_TYPE and not content_encoding:
+        return body
+    if isinstance(body, six.text_type):
+        body = body.encode('utf-8')
+    if content_encoding:
+        content_type += ' ' + content_encoding
+    return _MARK + content_type.encode('ascii') + _MARK + body
+
+
+def content_type_of(headers):
+    """ The content type and encoding named in message `headers`. """
+    if isinstance(headers, dict):
+        return headers.get(CONTENT_TYPE), headers.get(CONTENT_ENCODING)
+    return None, None
+
+
+def peek(data, headers=None):
+    """ The content type and encoding of a body, whether they are in front
+    of it or in its `headers`.
+    """
+    if framed(data):
+        label = data[1:data.index(_MARK, 1)].decode('ascii').split(' ')
+        return label[0], label[1] if len(label) > 1 else None
+    content_type, content_encoding = content_type_of(headers)
+    if content_type:
+        content_type = content_type.split(';', 1)[0].strip()
+    return content_type, content_encoding
+
+
+def compressed(data, headers=None):
+    """ Whether a body needs decompressing before it can be decoded. """
+    return bool(peek(data, headers)[1])
+
+
+def as_text(body, headers=None):
+    """ `body` as text, if it is some, for bodies received as bytes.
+
+    Plain JSON bodies are handed to consumers as text, as zeromq and STOMP
+    do, while binary and compressed ones stay bytes.
+    """
+    content_type, content_encoding = peek(body, headers)
+    codec = decoders.get(content_type)
+    if content_encoding or (codec and codec.binary) or framed(body):
+        return body
+    try:
+        return body.decode('utf-8')
+    except UnicodeDecodeError:
+        return body
+
+
+def decode(data, content_type=None, content_encoding=None,
+           decompress=compression.decompress):
+    """ Decode a message body of `content_type`, or of JSON if not given.
+
+    Bodies with a `content_encoding` go through ``decompress(data,
+    content_encoding)`` first.  Raises ValueError (or the codec's own error)
+    for bodies that are not what they claim to be.
+    """
+    if framed(data):
+        end = data.index(_MARK, 1)
+        label = data[1:end].decode('ascii').split(' ')
+        content_type = label[0]
+        content_encoding = label[1] if len(label) > 1 else None
+        data = data[end + 1:]
+    elif content_type:
+        content_type = content_type.split(';', 1)[0].strip()
+
+    if content_encoding:
+        data = decompress(data, content_encoding)
+
+    codec = decoders.get(content_type) or decoders[JSON_CONTENT_TYPE]
+    if codec.binary and isinstance(data, six.text_type):
+        raise ValueError("%s body was decoded as text" % codec.content_type)
+    return codec.decode(data)
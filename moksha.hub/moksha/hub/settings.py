@@ -0,0 +1,215 @@
+# This file is part of Moksha.
+# Copyright (C) 2008-2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+:mod:`moksha.hub.settings` - Typed hub settings
+===============================================
+
+The hub's configuration is a flat dictionary of strings (or whatever a caller
+passed in).  :class:`Settings` converts and validates every option the hub
+knows about once, when the hub starts, so that invalid values fail right away
+and hot paths can read plain attributes instead of re-parsing strings for
+every message.
+
+Each option is available as an attribute named after its key, with dots
+replaced by underscores: ``moksha.blocking_mode`` becomes
+``settings.moksha_blocking_mode``.
+"""
+
+from moksha.common.lib.converters import asbool, asint, aslist
+
+
+def asfloat(obj):
+    try:
+        return float(obj)
+    except (TypeError, ValueError):
+        raise ValueError("Bad float value: %r" % obj)
+
+
+def ascsv(obj):
+    return [item for item in aslist(obj, ',') if item]
+
+
+def asoctal(obj):
+    if isinstance(obj, int):
+        return obj
+    try:
+        return int(obj, 8)
+    except (TypeError, ValueError):
+        raise ValueError("Bad octal value: %r" % obj)
+
+
+def asstr(obj):
+    return obj
+
+
+def aslower(obj):
+    return obj.lower()
+
+
+class Setting(object):
+    """ A single configuration option, its type and its default. """
+
+    def __init__(self, key, convert=asstr, default=None, choices=None):
+        self.key = key
+        self.name = key.replace('.', '_')
+        self.convert = convert
+        self.default = default
+        self.choices = choices
+
+    def parse(self, config):
+        value = config.get(self.key, None)
+        if value is None or value == '':
+            return self.default
+
+        value = self.convert(value)
+        if self.choices and value not in self.choices:
+            raise ValueError("%r is not one of %r" % (value, self.choices))
+        return value
+
+
+class Settings(object):
+    """ A validated, typed snapshot of the hub configuration. """
+
+    schema = [
+        # The hub itself
+        Setting('moksha.blocking_mode', asbool, False),
+        Setting('moksha.workers_per_consumer', asint, 1),
+        Setting('moksha.threadpool_size', asint),
+        Setting('moksha.outbox.size', asint, 0),
+        Setting('moksha.inproc', asbool, False),
+        Setting('moksha.shm', asbool, False),
+        Setting('moksha.shm.path', default='/dev/shm/moksha'),
+        Setting('moksha.shm.size', asint, 8388608),
+        Setting('moksha.shm.poll_interval', asfloat, 0.001),
+        Setting('moksha.shm.idle_interval', asfloat, 0.05),
+        Setting('moksha.sqlite'),
+        Setting('moksha.sqlite.synchronous', default='NORMAL',
+                choices=('OFF', 'NORMAL', 'FULL')),
+        Setting('moksha.sqlite.batch_size', asint, 1000),
+        Setting('moksha.sqlite.backlog', asint, 100000),
+        Setting('moksha.sqlite.prefetch', asint, 1000),
+        Setting('moksha.sqlite.poll_interval', asfloat, 0.01),
+        Setting('moksha.sqlite.idle_interval', asfloat, 0.5),
+        Setting('moksha.sqlite.retention', asint, 86400),
+        Setting('moksha.sqlite.max_messages', asint, 0),
+        Setting('moksha.sqlite.compact_interval', asfloat, 60.0),
+        Setting('moksha.serializer', default='json'),
+        Setting('moksha.serializers', ascsv, []),
+        Setting('moksha.compression'),
+        Setting('moksha.compression.threshold', asint, 16384),
+        Setting('moksha.claimcheck.store'),
+        Setting('moksha.claimcheck.threshold', asint, 1048576),
+        Setting('moksha.claimcheck.summary', ascsv, []),
+        Setting('moksha.claimcheck.cache_size', asint, 16),
+        Setting('moksha.monitoring.socket'),
+        Setting('moksha.monitoring.socket.mode', asoctal),
+        Setting('moksha.livesocket', asbool, False),
+        Setting('moksha.livesocket.backend', aslower, 'amqp',
+                choices=('amqp', 'stomp', 'websocket')),
+        Setting('moksha.livesocket.websocket.port', asint, 0),
+        Setting('moksha.livesocket.websocket.interface', default=''),
+        Setting('moksha.livesocket.websocket.client2server', asbool, False),
+
+        # Bridging between brokers
+        Setting('moksha.bridge', ascsv, []),
+        Setting('moksha.bridge.max_hops', asint, 4),
+        Setting('moksha.bridge.queue_size', asint, 10000),
+        Setting('moksha.bridge.dedupe_size', asint, 10000),
+        Setting('moksha.bridge.dedupe_ttl', asfloat, 5.0),
+
+        # zeromq
+        Setting('zmq_enabled', asbool, False),
+        Setting('zmq_strict', asbool, False),
+        Setting('zmq_publish_endpoints', ascsv, []),
+        Setting('zmq_subscribe_endpoints', ascsv, []),
+        Setting('zmq_subscribe_method', default='connect',
+                choices=('connect', 'bind')),
+        Setting('high_water_mark', asint, 0),
+        Setting('zmq_tcp_keepalive', asint, 0),
+        Setting('zmq_tcp_keepalive_cnt', asint, 0),
+        Setting('zmq_tcp_keepalive_idle', asint, 0),
+        Setting('zmq_tcp_keepalive_intvl', asint, 0),
+        Setting('zmq_reconnect_ivl', asint, 100),
+        Setting('zmq_reconnect_ivl_max', asint, 100),
+        Setting('zmq_group_bind_endpoint'),
+        Setting('zmq_group_endpoint'),
+        Setting('zmq_group_credit', asint, 1),
+        Setting('zmq_group_heartbeat', asfloat, 5.0),
+        Setting('zmq_group_backlog', asint, 1000),
+
+        # STOMP
+        Setting('stomp_uri'),
+        Setting('stomp_broker'),
+        Setting('stomp_port', asint, 61613),
+        Setting('stomp_connections', asint, 1),
+        Setting('stomp_delay', asfloat, 0.1),
+        Setting('stomp_user', default='guest'),
+        Setting('stomp_pass', default='guest'),
+        Setting('stomp_ssl_key'),
+        Setting('stomp_ssl_crt'),
+        Setting('stomp_heartbeat', asint, 0),
+        Setting('stomp_heartbeat_grace', asfloat, 2.0),
+        Setting('stomp_connect_stagger', asfloat, 0.25),
+        Setting('stomp_queue'),
+        Setting('stomp_ack_mode', default='auto',
+                choices=('auto', 'client', 'client-individual')),
+        Setting('stomp_send_explicit_nacks', asbool, True),
+        Setting('stomp_cumulative_ack', asbool, False),
+        Setting('stomp_prefetch', asint, 0),
+        Setting('stomp_prefetch_header', default='activemq.prefetchSize'),
+        Setting('stomp_unescape_headers', asbool, True),
+        Setting('stomp_spool_size', asint, 10000),
+        Setting('stomp_spool_path'),
+        Setting('stomp_spool_max_bytes', asint, 104857600),
+        Setting('stomp_spool_replay_rate', asint, 1000),
+
+        # AMQP
+        Setting('amqp_broker'),
+        Setting('amqp_broker_host'),
+        Setting('amqp_broker_port', asint),
+        Setting('amqp_broker_user'),
+        Setting('amqp_broker_pass'),
+        Setting('amqp_broker_username', default='guest'),
+        Setting('amqp_broker_password', default='guest'),
+        Setting('amqp_broker_ssl', asbool, False),
+        Setting('amqp_broker_threaded', asbool, False),
+        Setting('amqp_shared_queue', asbool, False),
+        Setting('amqp_accept_batch', asint, 100),
+        Setting('amqp_accept_interval', asfloat, 0.05),
+        Setting('amqp_protocol', default='0-10', choices=('0-10', '0-9-1')),
+        Setting('amqp_prefetch', asint, 100),
+        Setting('amqp_channels', asint, 4),
+        Setting('amqp_max_unconfirmed', asint, 1000),
+        Setting('amqp_backlog', asint, 10000),
+        Setting('amqp_reconnect_delay', asfloat, 5.0),
+    ]
+
+    def __init__(self, config):
+        errors = []
+        for setting in self.schema:
+            try:
+                value = setting.parse(config)
+            except ValueError as e:
+                errors.append("%s: %s" % (setting.key, e))
+                value = setting.default
+            setattr(self, setting.name, value)
+
+        if errors:
+            raise ValueError("Invalid configuration.  " + "  ".join(errors))
+
+    def __repr__(self):
+        return "<Settings %r>" % dict(
+            (s.key, getattr(self, s.name)) for s in self.schema)
@@ -0,0 +1,449 @@
+# This file is part of Moksha.
+# Copyright (C) 2008-2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+:mod:`moksha.hub.shm` - Passing messages between hubs on one host
+=================================================================
+
+With ``moksha.shm = True``, hubs on the same host exchange messages through
+shared memory instead of a socket::
+
+    moksha.shm = True
+    moksha.shm.path = /dev/shm/moksha
+    moksha.shm.size = 8388608
+
+Each hub writes to a ring buffer of its own, a file of ``moksha.shm.size``
+bytes under ``moksha.shm.path`` mapped into memory, and reads the rings of
+every hub there, its own included.  Publishing copies the message into the
+ring once; each reader copies it out once.  Nothing passes through the
+kernel.
+
+Readers poll the rings from the reactor every ``moksha.shm.poll_interval``
+seconds while messages come in, backing off to ``moksha.shm.idle_interval``
+when there are none.  A writer never waits for its readers: a reader that
+falls a whole ring behind skips ahead to where the writer is, and logs how
+much it missed, so rings should be sized for the bursts expected.  Rings
+left behind by hubs that died are removed by the others.  Ring files are
+only readable by their owner, so every hub on the host must run as the same
+user.
+
+Topics are matched with shell-style wildcards, like ``hub.topics``.
+"""
+
+import errno
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+import uuid
+import zlib
+
+import six
+
+from twisted.python.threadable import isInIOThread
+
+from moksha.hub.inproc import InprocHubExtension, InprocMessage
+from moksha.hub.reactor import reactor, Handoff
+from moksha.hub.serialization import as_text
+
+log = logging.getLogger('moksha.hub')
+
+MAGIC = b'MOKSHARB'
+VERSION = 2
+
+# magic, version, writer pid, capacity, reserved up to, written up to
+HEADER = struct.Struct('<8sIIQQQ')
+RESERVED = 24
+WRITTEN = 32
+DATA = 64
+POSITION = struct.Struct('<Q')
+
+# length (0 to wrap around), topic length, headers length, checksum of the
+# rest, and where in the ring the record was written
+RECORD = struct.Struct('<IIIIQ')
+
+# Records read from one ring per poll, so other rings get a turn.
+BATCH = 1024
+# Seconds between looking for rings that came and went.
+SCAN_INTERVAL = 1.0
+
+
+def aligned(length):
+    return (length + 7) & ~7
+
+
+def checksum(topic, headers, body):
+    return zlib.crc32(body, zlib.crc32(headers, zlib.crc32(topic))) \
+        & 0xffffffff
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class Ring(object):
+    """ A ring buffer of ``(topic, headers, body)`` records in a memory
+    mapped file, written by one process and read by any.
+
+    Positions count bytes written since the ring was created, so they only
+    ever grow.  The writer bumps the reserved position before it overwrites
+    anything, and the written position once records are complete.  Readers
+    look at the first to tell whether what they copied out was overwritten
+    meanwhile, and at the second to know how far they may read.
+
+    Other processes may see the writer's stores in any order, unless the
+    CPU keeps them in order the way x86 does.  So every record starts with
+    its own position and a checksum of its contents, written last, and
+    readers go no further than the first record that does not match both.
+    """
+
+    def __init__(self, filename, buf, capacity, pid):
+        self.filename = filename
+        self.buf = buf
+        self.capacity = capacity
+        self.pid = pid
+
+    @classmethod
+    def create(cls, directory, size):
+        capacity = (size - DATA) & ~7
+        if capacity < RECORD.size * 2:
+            raise ValueError("moksha.shm.size of %r is too small" % size)
+
+        # Readers only see the ring once it is all set up.
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            os.ftruncate(fd, DATA + capacity)
+            buf = mmap.mmap(fd, DATA + capacity)
+            HEADER.pack_into(buf, 0, MAGIC, VERSION, os.getpid(),
+                             capacity, 0, 0)
+            filename = os.path.join(directory, '%i-%s.ring' % (
+                os.getpid(), uuid.uuid4().hex[:8]))
+            os.rename(tmp, filename)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        finally:
+            os.close(fd)
+        return cls(filename, buf, capacity, os.getpid())
+
+    @classmethod
+    def open(cls, filename):
+        with open(filename, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buf) < DATA:
+            buf.close()
+            raise ValueError("%s is not a ring" % filename)
+        magic, version, pid, capacity, _, _ = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION or \
+           len(buf) < DATA + capacity:
+            buf.close()
+            raise ValueError("%s is not a version %i ring" % (
+                filename, VERSION))
+        return cls(filename, buf, capacity, pid)
+
+    @property
+    def reserved(self):
+        return POSITION.unpack_from(self.buf, RESERVED)[0]
+
+    @property
+    def written(self):
+        return POSITION.unpack_from(self.buf, WRITTEN)[0]
+
+    def fits(self, topic, headers, body):
+        return aligned(RECORD.size + len(topic) + len(headers) + len(body)) \
+            <= self.capacity
+
+    def write(self, records):
+        """ Append ``(topic, headers, body)`` byte strings. """
+        buf, capacity = self.buf, self.capacity
+        position = self.written
+        for topic, headers, body in records:
+            length = RECORD.size + len(topic) + len(headers) + len(body)
+            size = aligned(length)
+            offset = position % capacity
+            if capacity - offset < size:
+                # Wrap around, leaving a mark if there is room for one.
+                end = position + capacity - offset
+                POSITION.pack_into(buf, RESERVED, end + size)
+                if capacity - offset >= RECORD.size:
+                    RECORD.pack_into(buf, DATA + offset, 0, 0, 0, 0, position)
+                position, offset = end, 0
+            else:
+                POSITION.pack_into(buf, RESERVED, position + size)
+
+            start = DATA + offset + RECORD.size
+            buf[start:start + len(topic)] = topic
+            start += len(topic)
+            buf[start:start + len(headers)] = headers
+            start += len(headers)
+            buf[start:start + len(body)] = body
+            RECORD.pack_into(buf, DATA + offset, length, len(topic),
+                             len(headers), checksum(topic, headers, body),
+                             position)
+            position += size
+
+        POSITION.pack_into(buf, WRITTEN, position)
+
+    def close(self):
+        self.buf.close()
+
+
+class Cursor(object):
+    """ Where one reader is up to in a :class:`Ring`.
+
+    New cursors start after whatever the ring holds already.
+    """
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.position = ring.written
+        # Bytes skipped since last asked, because the writer lapped us.
+        self.lost = 0
+
+    def read(self, limit=BATCH):
+        """ Return up to `limit` ``(topic, headers, body)`` records. """
+        buf, capacity = self.ring.buf, self.ring.capacity
+        written = self.ring.written
+        position = self.position
+        if written - position > capacity:
+            self.lost += written - position
+            position = written
+        first = position
+
+        records = []
+        while position < written and len(records) < limit:
+            offset = position % capacity
+            if capacity - offset < RECORD.size:
+                position += capacity - offset
+                continue
+            start = DATA + offset
+            length, topic_length, headers_length, crc, stamp = \
+                RECORD.unpack_from(buf, start)
+            if stamp != position:
+                # Not all there yet, as far as we can see.
+                break
+            if not length:
+                position += capacity - offset
+                continue
+
+            end = start + length
+            start += RECORD.size
+            body_start = start + topic_length + headers_length
+            record = (buf[start:start + topic_length],
+                      buf[start + topic_length:body_start],
+                      buf[body_start:end])
+            if checksum(*record) != crc:
+                break
+            records.append(record)
+            position += aligned(length)
+
+        # What we started on may have been overwritten while we copied it,
+        # and then nothing after it can be trusted either.
+        if position > first or position < written:
+            if first < self.ring.reserved - capacity:
+                self.lost += written - first
+                records = []
+                position = written
+
+        self.position = position
+        return records
+
+    def close(self):
+        self.ring.close()
+
+
+class ShmMessage(InprocMessage):
+
+    def __repr__(self):
+        return "<ShmMessage; topic: %r, body: %r>" % (self.topic, self.body)
+
+
+class ShmHubExtension(InprocHubExtension):
+    """ Sends messages to every hub on the host through shared memory.
+
+    Subscriptions work as in :class:`InprocHubExtension`; only the way
+    messages get to them differs.
+    """
+    name = 'shm'
+    in_process = False
+
+    def __init__(self, hub, config):
+        super(ShmHubExtension, self).__init__(hub, config)
+        self.settings = settings = hub.settings
+        self.path = settings.moksha_shm_path
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # Another hub got there first.
+                if not os.path.isdir(self.path):
+                    raise
+
+        # Only the reactor thread writes to the ring.
+        self.ring = Ring.create(self.path, settings.moksha_shm_size)
+        self._outgoing = Handoff(self.ring.write)
+        log.info("Publishing to %s" % self.ring.filename)
+
+        # {filename: Cursor}
+        self.cursors = {}
+        # Files that turned out not to be rings, so they are skipped.
+        self._ignored = set()
+        self._scanned = 0
+        self._poll = None
+        self._delay = settings.moksha_shm_poll_interval
+        # {headers: encoded}, since most messages carry the same ones.
+        self._headers = {}
+
+    def encode_headers(self, headers):
+        if not headers:
+            return b''
+        key = tuple(sorted(headers.items()))
+        try:
+            return self._headers[key]
+        except KeyError:
+            encoded = json.dumps(headers).encode('utf-8')
+            if len(self._headers) < 64:
+                self._headers[key] = encoded
+            return encoded
+
+    def send_message(self, topic, message, **headers):
+        self.send_messages([(topic, message, headers)])
+
+    def send_messages(self, messages):
+        records = []
+        for topic, message, headers in messages:
+            if isinstance(topic, six.text_type):
+                topic = topic.encode('utf-8')
+            if isinstance(message, six.text_type):
+                message = message.encode('utf-8')
+            record = (topic, self.encode_headers(headers), message)
+            if not self.ring.fits(*record):
+                raise ValueError(
+                    "%i byte message to %r does not fit in moksha.shm.size" %
+                    (len(message), topic))
+            records.append(record)
+        if reactor.running and not isInIOThread():
+            self._outgoing.extend(records)
+        else:
+            self.ring.write(records)
+
+    def subscribe(self, topic, callback):
+        super(ShmHubExtension, self).subscribe(topic, callback)
+        if self._poll is None:
+            self._poll = reactor.callLater(0, self.poll)
+
+    def scan(self):
+        """ Start reading rings that appeared, and stop reading those that
+        went away.
+        """
+        self._scanned = time.time()
+        filenames = set(
+            os.path.join(self.path, name) for name in os.listdir(self.path)
+            if name.endswith('.ring'))
+
+        for filename in set(self.cursors) - filenames:
+            self.cursors.pop(filename).close()
+
+        for filename in filenames - set(self.cursors) - self._ignored:
+            try:
+                ring = Ring.open(filename)
+            except (IOError, OSError):
+                # Removed under our feet.
+                continue
+            except ValueError as e:
+                log.warning("Ignoring %s: %s" % (filename, e))
+                self._ignored.add(filename)
+                continue
+            self.cursors[filename] = Cursor(ring)
+
+        for filename, cursor in list(self.cursors.items()):
+            if cursor.ring.pid == os.getpid() or alive(cursor.ring.pid):
+                continue
+            # Whatever it wrote has been read; nobody will write any more.
+            if cursor.position >= cursor.ring.written:
+                log.info("Removing %s, left behind by process %i" % (
+                    filename, cursor.ring.pid))
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+                self.cursors.pop(filename).close()
+
+    def receive(self):
+        """ Deliver what every ring has for our subscribers.  Returns how
+        many records were read, and whether any ring has more left.
+        """
+        received, more = 0, False
+        for filename, cursor in list(self.cursors.items()):
+            records = cursor.read(BATCH)
+            if cursor.lost:
+                log.warning("Fell behind on %s and lost %i bytes of "
+                            "messages" % (filename, cursor.lost))
+                cursor.lost = 0
+            received += len(records)
+            more = more or len(records) == BATCH
+
+            messages = []
+            for topic, headers, body in records:
+                headers = json.loads(headers.decode('utf-8')) \
+                    if headers else {}
+                if self.hub.echo(headers):
+                    continue
+                messages.append(ShmMessage(
+                    topic.decode('utf-8'), as_text(body, headers), headers))
+            self.deliver(messages)
+        return received, more
+
+    def poll(self):
+        self._poll = None
+        received = more = None
+        try:
+            if time.time() - self._scanned >= SCAN_INTERVAL:
+                self.scan()
+            received, more = self.receive()
+        except Exception:
+            log.exception("Failed to read from %s" % self.path)
+
+        if more:
+            delay = 0
+        elif received:
+            delay = self._delay = self.settings.moksha_shm_poll_interval
+        else:
+            # Back off for as long as nothing comes in.
+            delay = self._delay
+            self._delay = min(self._delay * 2,
+                              self.settings.moksha_shm_idle_interval)
+        self._poll = reactor.callLater(delay, self.poll)
+
+    def close(self):
+        if self._poll is not None and self._poll.active():
+            self._poll.cancel()
+        self._poll = None
+        self._outgoing.drain()
+        for cursor in self.cursors.values():
+            cursor.close()
+        self.cursors = {}
+        try:
+            os.unlink(self.ring.filename)
+        except OSError:
+            pass
+        self.ring.close()
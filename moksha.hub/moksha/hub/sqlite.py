@@ -0,0 +1,434 @@
+# This file is part of Moksha.
+# Copyright (C) 2008-2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+:mod:`moksha.hub.sqlite` - Durable messaging without a broker
+=============================================================
+
+With ``moksha.sqlite`` set to a file, the hub keeps the messages it sends in
+an SQLite database, and delivers them to its consumers from there::
+
+    moksha.sqlite = /var/lib/moksha/messages.db
+    moksha.sqlite.retention = 86400
+
+Sending only puts the message on a queue.  A thread of its own writes
+whatever has queued up in one transaction, so it pays for one sync of the
+write-ahead log per batch rather than per message.
+
+Every :class:`moksha.hub.api.Consumer` reads the database through a cursor
+of its own, named after the consumer and topic and saved in the database.  A
+cursor only moves past a message once the consumer is done with it, so a hub
+that stops halfway through resumes where it left off, and messages are handed
+out at least once.  A consumer subscribing for the first time starts with the
+next message sent.  Other subscribers, like the websocket clients of the hub,
+get a cursor that starts with the next message and is never saved.
+
+Messages are deleted once they are ``moksha.sqlite.retention`` seconds
+old, whether every cursor got to them or not, and the oldest beyond
+``moksha.sqlite.max_messages`` go too.  Topics are matched with shell-style
+wildcards, like ``hub.topics``.
+"""
+
+import functools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import six
+from six.moves import queue
+
+from moksha.common.exc import SpoolFull
+from moksha.hub.inproc import InprocMessage
+from moksha.hub.messaging import Acknowledgement, MessagingHubExtension
+from moksha.hub.reactor import reactor, Handoff
+from moksha.hub.serialization import as_text
+
+log = logging.getLogger('moksha.hub')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic TEXT NOT NULL,
+    headers TEXT,
+    body BLOB NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_created ON messages (created);
+CREATE TABLE IF NOT EXISTS cursors (
+    name TEXT PRIMARY KEY,
+    position INTEGER NOT NULL
+);
+"""
+
+
+def connect(filename, synchronous='NORMAL'):
+    db = sqlite3.connect(filename, timeout=30, isolation_level=None)
+    db.execute('PRAGMA synchronous = %s' % synchronous)
+    return db
+
+
+def cursor_name(callback, topic):
+    """ What the cursor of `callback` on `topic` is saved as, or None if
+    `callback` does not belong to a consumer.
+    """
+    from moksha.hub.api.consumer import Consumer
+
+    owner = getattr(callback, '__self__', None)
+    if not isinstance(owner, Consumer):
+        return None
+    cls = type(owner)
+    return '%s.%s:%s' % (cls.__module__, cls.__name__, topic)
+
+
+class SQLiteMessage(InprocMessage):
+
+    def __repr__(self):
+        return "<SQLiteMessage; topic: %r, body: %r>" % (self.topic,
+                                                        self.body)
+
+
+class Subscription(object):
+    """ One callback's cursor over the messages on a topic.
+
+    Messages up to `fetched` have been handed out, and `pending` holds those
+    the consumer has not finished yet.  Everything before the first pending
+    one is done, and that is how far the saved cursor goes.
+
+    When the consumer has as many pending as it may, `wake` is called once
+    it finishes one, from whichever thread it finished it on.
+    """
+
+    def __init__(self, name, topic, callback, position, wake=None):
+        self.name = name
+        self.topic = topic
+        self.callback = callback
+        self.fetched = self.saved = position
+        self.pending = set()
+        self.wake = wake
+        self._full = False
+        self._lock = threading.Lock()
+
+    def room(self, prefetch):
+        """ How many more messages the consumer may have pending. """
+        with self._lock:
+            room = prefetch - len(self.pending)
+            self._full = room <= 0
+            return room
+
+    def handed_out(self, id):
+        with self._lock:
+            self.pending.add(id)
+
+    def finished(self, id, handled):
+        # Consumers that failed on a message have logged it; it is not
+        # tried again, as with the AMQP broker.
+        with self._lock:
+            self.pending.discard(id)
+            full, self._full = self._full, False
+        if full and self.wake:
+            self.wake(self)
+
+    @property
+    def position(self):
+        with self._lock:
+            if self.pending:
+                return min(self.pending) - 1
+            return self.fetched
+
+
+class SQLiteHubExtension(MessagingHubExtension):
+    """ Keeps messages in an SQLite database, for consumers of this hub. """
+    name = 'sqlite'
+    carries_headers = True
+
+    def __init__(self, hub, config):
+        self.hub = hub
+        self.config = config
+        self.settings = settings = hub.settings
+        self.filename = settings.moksha_sqlite
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Reads happen in the reactor thread.  With the write-ahead log,
+        # they never wait for the writer, nor the writer for them.
+        self.db = connect(self.filename, settings.moksha_sqlite_synchronous)
+        self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(SCHEMA)
+
+        self.subscriptions = []
+        self._poll = None
+        self._delay = settings.moksha_sqlite_poll_interval
+        # Consumers that were at their prefetch and finished a message,
+        # from worker threads.
+        self._room = Handoff(self.wake)
+        # {headers: encoded}, since most messages carry the same ones.
+        self._headers = {}
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='moksha-sqlite')
+        self.thread.daemon = True
+        self.thread.start()
+
+        super(SQLiteHubExtension, self).__init__()
+
+    def encode_headers(self, headers):
+        if not headers:
+            return None
+        key = tuple(sorted(headers.items()))
+        try:
+            return self._headers[key]
+        except KeyError:
+            encoded = json.dumps(headers)
+            if len(self._headers) < 64:
+                self._headers[key] = encoded
+            return encoded
+
+    def check_backlog(self, count=1):
+        if self.queue.qsize() + count > self.settings.moksha_sqlite_backlog:
+            raise SpoolFull("%i messages are waiting to be written to %s" % (
+                self.queue.qsize(), self.filename))
+
+    def send_message(self, topic, message, **headers):
+        self.send_messages([(topic, message, headers)])
+
+    def send_messages(self, messages):
+        self.check_backlog(len(messages))
+        now = time.time()
+        for topic, message, headers in messages:
+            if isinstance(topic, six.binary_type):
+                topic = topic.decode('utf-8')
+            if isinstance(message, six.text_type):
+                message = message.encode('utf-8')
+            self.queue.put(('message', (
+                topic, self.encode_headers(headers),
+                sqlite3.Binary(message), now)))
+
+    def run(self):
+        """ Write what is queued, as much as a batch at a time, and compact
+        the database every so often.
+        """
+        db = connect(self.filename, self.settings.moksha_sqlite_synchronous)
+        interval = self.settings.moksha_sqlite_compact_interval
+        compacted = time.time()
+        stopping = False
+        while not stopping:
+            timeout = max(compacted + interval - time.time(), 0)
+            items = []
+            try:
+                items.append(self.queue.get(timeout=timeout))
+                while len(items) < self.settings.moksha_sqlite_batch_size:
+                    items.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            messages, cursors = [], {}
+            for kind, item in items:
+                if kind == 'message':
+                    messages.append(item)
+                elif kind == 'cursor':
+                    cursors[item[0]] = item[1]
+                else:
+                    stopping = True
+
+            try:
+                if messages or cursors:
+                    self.write(db, messages, cursors)
+                if time.time() - compacted >= interval or stopping:
+                    compacted = time.time()
+                    self.compact(db)
+            except Exception:
+                log.exception("Failed to write to %s" % self.filename)
+            finally:
+                for item in items:
+                    self.queue.task_done()
+        db.close()
+
+    def write(self, db, messages, cursors):
+        db.execute('BEGIN')
+        try:
+            db.executemany(
+                'INSERT INTO messages (topic, headers, body, created) '
+                'VALUES (?, ?, ?, ?)', messages)
+            db.executemany(
+                'INSERT OR REPLACE INTO cursors (name, position) '
+                'VALUES (?, ?)', cursors.items())
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def compact(self, db):
+        """ Delete messages past the retention policy, and give the space
+        back to the filesystem.
+        """
+        db.execute('BEGIN')
+        try:
+            expired = db.execute(
+                'DELETE FROM messages WHERE created < ?',
+                (time.time() - self.settings.moksha_sqlite_retention,)
+            ).rowcount
+            limit = self.settings.moksha_sqlite_max_messages
+            if limit:
+                expired += db.execute(
+                    'DELETE FROM messages WHERE id <= '
+                    '(SELECT MAX(id) FROM messages) - ?', (limit,)).rowcount
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+        if expired:
+            log.info("Deleted %i old messages from %s" % (
+                expired, self.filename))
+            db.execute('PRAGMA incremental_vacuum')
+        db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def flush(self):
+        """ Wait for everything queued so far to be written. """
+        self.queue.join()
+
+    def subscribe(self, topic, callback):
+        name = cursor_name(callback, topic)
+        if name:
+            # Several consumers of one class each keep a cursor of their own.
+            taken = set(s.name for s in self.subscriptions)
+            unique, i = name, 1
+            while unique in taken:
+                i += 1
+                unique = '%s#%i' % (name, i)
+            name = unique
+            row = self.db.execute(
+                'SELECT position FROM cursors WHERE name = ?',
+                (name,)).fetchone()
+        else:
+            row = None
+
+        if row:
+            position = row[0]
+        else:
+            row = self.db.execute("SELECT seq FROM sqlite_sequence "
+                                  "WHERE name = 'messages'").fetchone()
+            position = row[0] if row else 0
+            if name:
+                self.queue.put(('cursor', (name, position)))
+
+        self.subscriptions.append(Subscription(
+            name, topic, callback, position, wake=self._room.put))
+        if self._poll is None:
+            self._poll = reactor.callLater(0, self.poll)
+        super(SQLiteHubExtension, self).subscribe(topic, callback)
+
+    def unsubscribe(self, callback):
+        self.subscriptions = [subscription
+                              for subscription in self.subscriptions
+                              if subscription.callback != callback]
+        super(SQLiteHubExtension, self).unsubscribe(callback)
+
+    def deliver(self, subscription):
+        """ Hand the next messages on its topic to `subscription`.  Returns
+        how many there were, and whether there are more.
+        """
+        room = subscription.room(self.settings.moksha_sqlite_prefetch)
+        if room <= 0:
+            return 0, False
+
+        last = self.db.execute('SELECT MAX(id) FROM messages').fetchone()[0]
+        if not last or last <= subscription.fetched:
+            return 0, False
+        rows = self.db.execute(
+            'SELECT id, topic, headers, body FROM messages '
+            'WHERE id > ? AND id <= ? AND topic GLOB ? ORDER BY id LIMIT ?',
+            (subscription.fetched, last, subscription.topic, room)).fetchall()
+        more = len(rows) == room
+
+        for id, topic, headers, body in rows:
+            headers = json.loads(headers) if headers else {}
+            subscription.fetched = id
+            if self.hub.echo(headers):
+                continue
+
+            message = SQLiteMessage(
+                topic, as_text(bytes(body), headers), headers)
+            subscription.handed_out(id)
+            message.ack = Acknowledgement(
+                functools.partial(subscription.finished, id))
+            handled = True
+            try:
+                if subscription.callback(message) is False:
+                    handled = False
+            except Exception:
+                log.exception("%r failed on a message to %s" % (
+                    subscription.callback, topic))
+                handled = False
+            message.ack.release(handled)
+
+        if not more:
+            # Nothing else up to `last` is on this topic.
+            subscription.fetched = last
+        return len(rows), more
+
+    def save_cursors(self):
+        for subscription in self.subscriptions:
+            if not subscription.name:
+                continue
+            position = subscription.position
+            if position != subscription.saved:
+                subscription.saved = position
+                self.queue.put(('cursor', (subscription.name, position)))
+
+    def poll(self):
+        self._poll = None
+        received, more = 0, False
+        try:
+            for subscription in list(self.subscriptions):
+                count, left = self.deliver(subscription)
+                received += count
+                more = more or left
+            self.save_cursors()
+        except Exception:
+            log.exception("Failed to read from %s" % self.filename)
+
+        if more:
+            delay = 0
+        elif received:
+            delay = self._delay = self.settings.moksha_sqlite_poll_interval
+        else:
+            # Back off for as long as nothing comes in.
+            delay = self._delay
+            self._delay = min(self._delay * 2,
+                              self.settings.moksha_sqlite_idle_interval)
+        self._poll = reactor.callLater(delay, self.poll)
+
+    def wake(self, subscriptions):
+        """ Poll again straight away, for consumers that have room for more
+        messages again, instead of whenever the back-off says. """
+        self._delay = self.settings.moksha_sqlite_poll_interval
+        if self._poll is not None and self._poll.active():
+            self._poll.cancel()
+            self._poll = reactor.callLater(0, self.poll)
+
+    def close(self):
+        if self._poll is not None and self._poll.active():
+            self._poll.cancel()
+        self._poll = None
+        self.save_cursors()
+        self.queue.put(('stop', None))
+        self.thread.join()
+        self.db.close()
@@ -14,3 +14,4 @@
 # limitations under the License.
 
 from moksha.hub.stomp.stomp import StompHubExtension
+from moksha.hub.stomp.multi import MultiStompHubExtension
@@ -0,0 +1,267 @@
+# This file is part of Moksha.
+# Copyright (C) 2008-2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An incremental parser for STOMP 1.0, 1.1 and 1.2 frames, and an encoder for
+the SEND frames we publish.
+
+The parser works on the raw bytes read off of the socket, so a multibyte
+character split across two reads is never decoded half-way.  Bodies are
+delimited by their ``content-length`` header when there is one (so they may
+contain NUL bytes) and by the first NUL otherwise.  Bodies are only decoded
+when somebody asks for them.
+"""
+
+import re
+
+import six
+
+NUL = b'\x00'
+EOL = b'\n'
+
+# https://stomp.github.io/stomp-specification-1.2.html#Value_Encoding
+_escapes = {'\\r': '\r', '\\n': '\n', '\\c': ':', '\\\\': '\\'}
+_escaped = re.compile(r'\\.')
+_encodings = dict((v, k) for k, v in _escapes.items())
+_special = re.compile(r'[\r\n:\\]')
+
+
+def unescape(value):
+    """ Undo STOMP header value encoding in a single pass. """
+    if '\\' not in value:
+        return value
+    return _escaped.sub(
+        lambda match: _escapes.get(match.group(0), match.group(0)), value)
+
+
+def escape(value):
+    """ Apply STOMP header value encoding in a single pass. """
+    return _special.sub(lambda match: _encodings[match.group(0)], value)
+
+
+class FrameError(Exception):
+    """ The broker sent something that is not a STOMP frame. """
+
+
+class Frame(object):
+    """ A received STOMP frame.
+
+    For compatibility with code written against stomper, frames can also be
+    indexed like the dicts it produces: ``frame['cmd']``, ``frame['headers']``
+    and ``frame['body']``.
+    """
+
+    __slots__ = ('cmd', 'headers', 'raw_body', '_body')
+
+    def __init__(self, cmd, headers, raw_body=b''):
+        self.cmd = cmd
+        self.headers = headers
+        self.raw_body = raw_body
+        self._body = None
+
+    @property
+    def body(self):
+        """ The body decoded as UTF-8, on first access. """
+        if self._body is None:
+            self._body = self.raw_body.decode('utf-8', 'replace')
+        return self._body
+
+    def __getitem__(self, key):
+        if key == 'cmd':
+            return self.cmd
+        elif key == 'headers':
+            return self.headers
+        elif key == 'body':
+            return self.body
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return '<Frame %s %r (%i bytes)>' % (
+            self.cmd, self.headers, len(self.raw_body))
+
+
+class FrameParser(object):
+    """ Turns a stream of bytes into :class:`Frame` objects. """
+
+    def __init__(self, unescape_headers=True):
+        self.unescape_headers = unescape_headers
+        self.buffer = bytearray()
+        # Headers of a frame whose body has not fully arrived yet, so that
+        # they are not parsed again on every read.
+        self._pending = None
+        # Where to resume looking for the NUL of a body without a length.
+        self._scanned = 0
+        # Heart-beats (bare EOLs) seen between frames.
+        self.heartbeats = 0
+
+    def feed(self, data):
+        """ Add data and return the list of frames completed by it. """
+        self.buffer.extend(data)
+        frames = []
+        pos = 0
+        while True:
+            frame, pos = self._parse(pos)
+            if frame is None:
+                break
+            frames.append(frame)
+
+        if pos:
+            # Drop everything that has been consumed in one go.
+            del self.buffer[:pos]
+            self._scanned = max(0, self._scanned - pos)
+            if self._pending is not None:
+                cmd, headers, body_start = self._pending
+                self._pending = (cmd, headers, body_start - pos)
+        return frames
+
+    def _parse(self, pos):
+        """ Return the next frame (or None) and how far the buffer was read.
+        """
+        buf = self.buffer
+
+        if self._pending is None:
+            # Skip heart-beats.
+            while pos < len(buf) and buf[pos] in (0x0a, 0x0d):
+                if buf[pos] == 0x0a:
+                    self.heartbeats += 1
+                pos += 1
+            if pos == len(buf):
+                return None, pos
+
+            end = self._header_end(pos)
+            if end is None:
+                return None, pos
+            header_end, body_start = end
+            cmd, headers = self._headers(pos, header_end)
+            self._pending = (cmd, headers, body_start)
+            self._scanned = body_start
+
+        cmd, headers, body_start = self._pending
+        length = headers.get('content-length')
+        if length is not None:
+            try:
+                length = int(length)
+            except ValueError:
+                raise FrameError("Bad content-length %r" % length)
+            body_end = body_start + length
+            if len(buf) <= body_end:
+                return None, body_start
+            if buf[body_end] != 0:
+                raise FrameError("%s frame body is longer than its "
+                                 "content-length of %i" % (cmd, length))
+        else:
+            body_end = buf.find(NUL, self._scanned)
+            if body_end == -1:
+                self._scanned = len(buf)
+                return None, body_start
+
+        self._pending = None
+        frame = Frame(cmd, headers, bytes(buf[body_start:body_end]))
+        return frame, body_end + 1
+
+    def _header_end(self, pos):
+        """ Find the blank line that ends the headers starting at pos. """
+        buf = self.buffer
+        while True:
+            eol = buf.find(EOL, pos)
+            if eol == -1:
+                return None
+            nxt = eol + 1
+            if buf[nxt:nxt + 1] == EOL:
+                return eol, nxt + 1
+            if buf[nxt:nxt + 2] == b'\r\n':
+                return eol, nxt + 2
+            if nxt >= len(buf) - 1:
+                # We can't tell yet whether a blank line follows.
+                return None
+            pos = nxt
+
+    def _headers(self, start, end):
+        lines = bytes(self.buffer[start:end]).decode('utf-8').split('\n')
+        cmd = lines[0].rstrip('\r').strip()
+        if not cmd:
+            raise FrameError("Frame without a command")
+
+        # CONNECT and CONNECTED frames are never escaped, for 1.0 brokers.
+        unescape_values = self.unescape_headers and \
+            cmd not in ('CONNECT', 'CONNECTED')
+
+        headers = {}
+        for line in lines[1:]:
+            line = line.rstrip('\r')
+            key, sep, value = line.partition(':')
+            if not sep:
+                continue
+            if unescape_values:
+                key, value = unescape(key), unescape(value)
+            # If a header is repeated, the first value wins.
+            if key not in headers:
+                headers[key] = value
+        return cmd, headers
+
+
+class SendEncoder(object):
+    """ Encodes SEND frames straight to bytes.
+
+    The command and destination lines are the same for every message to a
+    destination, so they are built once and cached.  Messages get
+    `content_type` unless their headers name one of their own.
+    """
+
+    def __init__(self, content_type='text/plain', escape_headers=True,
+                 cache_size=1024):
+        self.content_type = content_type
+        self.escape_headers = escape_headers
+        self.cache_size = cache_size
+        self._prefixes = {}
+        self._content_type = self._header(u'content-type', content_type)
+
+    def _header(self, key, value):
+        if self.escape_headers:
+            key, value = escape(key), escape(value)
+        return (u'%s:%s\n' % (key, value)).encode('utf-8')
+
+    def prefix(self, destination):
+        prefix = self._prefixes.get(destination)
+        if prefix is None:
+            if len(self._prefixes) >= self.cache_size:
+                self._prefixes.clear()
+            name = destination
+            if isinstance(name, six.binary_type):
+                name = name.decode('utf-8')
+            prefix = b'SEND\n' + self._header(u'destination', name)
+            self._prefixes[destination] = prefix
+        return prefix
+
+    def encode(self, destination, body, headers=None):
+        """ Return the whole SEND frame for ``body`` as bytes. """
+        if isinstance(body, six.text_type):
+            body = body.encode('utf-8')
+        parts = [self.prefix(destination)]
+        if headers:
+            for key, value in headers.items():
+                parts.append(self._header(key, six.text_type(value)))
+        if not headers or 'content-type' not in headers:
+            parts.append(self._content_type)
+        parts.append(('content-length:%i\n\n' % len(body)).encode('ascii'))
+        parts.append(body)
+        parts.append(b'\x00\n')
+        return b''.join(parts)
@@ -0,0 +1,199 @@
+# This file is part of Moksha.
+# Copyright (C) 2008-2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Several STOMP connections used at once.
+
+With ``stomp_connections = N`` the hub keeps N connections open, spread over
+the addresses in ``stomp_uri`` (or all to the same broker, if it only lists
+one).  Publishes are handed out round-robin over the connections that are up,
+and every subscription is owned by exactly one of them.  When a connection is
+lost, its subscriptions and any frames it still had to send move to the
+remaining connections right away; the lost connection reconnects in the
+background and picks up work again once it is back.
+"""
+
+import logging
+
+from moksha.hub.messaging import MessagingHubExtension
+from moksha.hub.stomp.stomp import StompHubExtension
+
+log = logging.getLogger('moksha.hub')
+
+
+class StompConnection(StompHubExtension):
+    """ One of the connections of a :class:`MultiStompHubExtension`. """
+
+    def __init__(self, owner, index, uri, topics, spool_path):
+        self.owner = owner
+        self.index = index
+        self.live = False
+        # Whether our last attempt to talk to the broker failed, as opposed
+        # to still connecting for the first time.
+        self.down = False
+        super(StompConnection, self).__init__(
+            owner.hub, owner.config, uri=uri, topics=topics,
+            spool_path=spool_path)
+
+    def connected(self, *args, **kw):
+        super(StompConnection, self).connected(*args, **kw)
+        self.live, self.down = True, False
+        self.owner.connection_made(self)
+
+    def clientConnectionLost(self, connector, reason):
+        self.live, self.down = False, True
+        super(StompConnection, self).clientConnectionLost(connector, reason)
+        self.owner.connection_lost(self)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.live, self.down = False, True
+        super(StompConnection, self).clientConnectionFailed(connector, reason)
+        self.owner.connection_lost(self)
+
+    def __repr__(self):
+        return '<StompConnection %i>' % self.index
+
+
+class MultiStompHubExtension(MessagingHubExtension):
+    """ Spreads publishes and subscriptions over several STOMP connections.
+    """
+    name = 'stomp'
+    carries_headers = True
+
+    def __init__(self, hub, config):
+        self.hub = hub
+        self.config = config
+        self.settings = settings = hub.settings
+
+        uri = settings.stomp_uri
+        if not uri:
+            uri = "%s:%i" % (settings.stomp_broker, settings.stomp_port)
+        addresses = uri.split(',')
+
+        # {topic: the connection subscribed to it}
+        self.owners = {}
+        self._next = 0
+
+        queue = settings.stomp_queue
+        self.connections = []
+        for i in range(settings.stomp_connections):
+            # Every connection prefers its own broker, but fails over to the
+            # others like a single connection would.
+            j = i % len(addresses)
+            spool_path = None
+            if settings.stomp_spool_path:
+                spool_path = '%s.%i' % (settings.stomp_spool_path, i)
+            self.connections.append(StompConnection(
+                self, i, ','.join(addresses[j:] + addresses[:j]),
+                # With a stomp_queue, all connections consume from it.
+                [queue] if queue else [],
+                spool_path))
+
+        for topic in hub.topics.keys():
+            self.subscribe(topic, None)
+
+        super(MultiStompHubExtension, self).__init__()
+
+    @property
+    def live(self):
+        return [c for c in self.connections if c.live]
+
+    def _least_loaded(self, connections):
+        load = dict((c, 0) for c in connections)
+        for owner in self.owners.values():
+            if owner in load:
+                load[owner] += 1
+        return min(connections, key=lambda c: (load[c], c.index))
+
+    def next_connection(self):
+        live = self.live
+        if live:
+            connection = live[self._next % len(live)]
+        else:
+            # Spool on any of them until one comes back.
+            connection = self.connections[self._next % len(self.connections)]
+        self._next += 1
+        return connection
+
+    def send_message(self, topic, message, **headers):
+        self.next_connection().send_message(topic, message, **headers)
+
+        super(MultiStompHubExtension, self).send_message(
+            topic, message, **headers)
+
+    def send_messages(self, messages):
+        # A batch stays together, so it is still written at once.
+        self.next_connection().send_messages(messages)
+
+    def subscribe(self, topic, callback):
+        if self.settings.stomp_queue:
+            # Every connection already consumes the queue.
+            return
+
+        if topic not in self.owners:
+            live = self.live
+            owner = self._least_loaded(live or self.connections)
+            self.owners[topic] = owner
+            owner.subscribe(topic, callback)
+
+        super(MultiStompHubExtension, self).subscribe(topic, callback)
+
+    def move(self, topic, connection):
+        """ Hand the subscription to topic over to connection. """
+        previous = self.owners.get(topic)
+        if previous is not None and topic in previous._topics:
+            previous._topics.remove(topic)
+        self.owners[topic] = connection
+        connection.subscribe(topic, None)
+
+    def connection_made(self, connection):
+        # Take over whatever no live connection is looking after.
+        for topic, owner in list(self.owners.items()):
+            if owner is not connection and owner.down:
+                log.info("%r takes over %r from %r" % (
+                    connection, topic, owner))
+                self.move(topic, connection)
+
+        for other in self.connections:
+            if other is not connection and other.down and other.spool:
+                self.hand_over_spool(other, connection)
+
+    def connection_lost(self, connection):
+        live = self.live
+        if not live:
+            log.warning("All %i stomp connections are down" %
+                        len(self.connections))
+            return
+
+        for topic, owner in list(self.owners.items()):
+            if owner is connection:
+                target = self._least_loaded(live)
+                log.info("Moving %r from %r to %r" % (
+                    topic, connection, target))
+                self.move(topic, target)
+
+        if connection.spool:
+            self.hand_over_spool(connection, self._least_loaded(live))
+
+    def hand_over_spool(self, source, target):
+        log.info("Moving %i spooled frames from %r to %r" % (
+            len(source.spool), source, target))
+        while source.spool:
+            target.spool.extend(source.spool.pop(1000))
+        target.start_replay()
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
@@ -19,12 +19,13 @@
 # (c) Oisin Mulvihill, 2007-07-26.
 # License: http://www.apache.org/licenses/LICENSE-2.0
 
+import functools
 import logging
+import threading
+import time
 
 from distutils.version import LooseVersion
 
-from moksha.common.lib.converters import asbool
-
 try:
     # stomper is not ready for py3
     try:
@@ -36,13 +37,16 @@ try:
             import stomper
         except ImportError:
             pass
-    from stomper.stompbuffer import StompBuffer
     from twisted.internet.protocol import Protocol
     class Base(Protocol, stomper.Engine):
         pass
 except ImportError:
     Base = object
 
+from moksha.hub.messaging import Acknowledgement
+from moksha.hub.reactor import Handoff
+from moksha.hub.stomp.frame import FrameParser, FrameError
+
 log = logging.getLogger(__name__)
 
 class StompProtocol(Base):
@@ -53,7 +57,18 @@ class StompProtocol(Base):
         self.password = password
         self.counter = 1
         self.client = client
-        self.buffer = StompBuffer()
+        self.buffer = FrameParser(
+            unescape_headers=client.hub.settings.stomp_unescape_headers)
+
+        # Replies collected while handling one read, if we are in one, and
+        # the thread doing that.
+        self._responses = None
+        self._reading = None
+        # Replies for messages that workers finished on their own threads.
+        self._acks = Handoff(self.send_acks)
+
+        # When we last heard anything, heart-beats included, from the broker.
+        self.last_received = time.time()
 
     def connected(self, msg):
         """Once connected, subscribe to message queues """
@@ -63,21 +78,26 @@ class StompProtocol(Base):
 
         # https://stomp.github.io/stomp-specification-1.1.html#Heart-beating
         server_heartbeat = msg['headers'].get('heart-beat', 0)
+        server_sends = 0
         if server_heartbeat:
             log.debug("(server wants heart-beat (%s))" % server_heartbeat)
             sx, sy = server_heartbeat.split(',')
-            server_heartbeat = int(sy)
+            server_heartbeat, server_sends = int(sy), int(sx)
 
-        self.client.connected(server_heartbeat)
+        self.client.connected(server_heartbeat, server_sends)
 
     def subscribe(self, dest, **headers):
         f = stomper.Frame()
         # https://stomp.github.io/stomp-specification-1.2.html#SUBSCRIBE_ack_Header
-        ack = self.client.hub.config.get('stomp_ack_mode', 'auto')
+        ack = self.client.hub.settings.stomp_ack_mode
         if stomper.STOMP_VERSION != '1.0':
             f.unpack(stomper.subscribe(dest, dest, ack=ack))
         else:
             f.unpack(stomper.subscribe(dest, ack=ack))
+        prefetch = self.client.hub.settings.stomp_prefetch
+        if prefetch and ack != 'auto':
+            header = self.client.hub.settings.stomp_prefetch_header
+            f.headers[header] = str(prefetch)
         f.headers.update(headers)
         cmd = f.pack()
         log.debug(cmd)
@@ -88,7 +108,11 @@ class StompProtocol(Base):
         log.debug("Connecting with stomp-%s" % stomper.STOMP_VERSION)
         if stomper.STOMP_VERSION != '1.0':
             host, port = self.client.addresses[self.client.address_index]
-            interval = (self.client.client_heartbeat, 0)
+            # Ask for heart-beats from the broker too, if we watch them.
+            receive = 0
+            if self.client.hub.settings.stomp_heartbeat_grace:
+                receive = self.client.client_heartbeat
+            interval = (self.client.client_heartbeat, receive)
             log.debug("(proposing heartbeat of (%i,%i))" % interval)
             cmd = stomper.connect(self.username, self.password, host, interval)
         else:
@@ -103,54 +127,149 @@ class StompProtocol(Base):
         # every message, regardless of the mode.  However, if the mode is
         # 'auto', then we should *not* send acks.  Here, make sure we don't
         # send an ack in that mode.
-        if self.client.hub.config.get('stomp_ack_mode', 'auto') == 'auto':
+        if self.client.hub.settings.stomp_ack_mode == 'auto':
             return stomper.NO_REPONSE_NEEDED
 
         # Otherwise, do what stomper do if the mode is *not* auto.
         return super(StompProtocol, self).ack(msg)
 
     def dataReceived(self, data):
-        """Data received, react to it and respond if needed """
-        self.buffer.appendData(data.decode('utf-8'))
-        while True:
-           msg = self.buffer.getOneMessage()
-           if msg is None:
-               break
-
-           handled = self.client.hub.consume_stomp_message(msg)
-
-           # See if stomper thinks we need to send anything back.
-           response = self.react(msg)
-
-           # If this kind of message doesn't need any response, then quit.
-           if not response:
-               log.debug("StompProtocol sending no response to broker.")
-               return
-
-           # Otherwise, see if we need to turn a naive 'ack' from stomper into
-           # a 'nack' if our consumers failed to do their jobs.
-           if handled is False and response.startswith("ACK\n"):
-
-               send_nacks = asbool(self.client.hub.config.get('stomp_send_explicit_nacks', True))
-               if not send_nacks:
-                   log.warn("Message handling failed.  stomp_send_explicit_nacks=%r.  "
-                            "Sending no reply to the broker.", send_nacks)
-                   # Return, so as not to send an erroneous ack.
-                   return
-
-               if LooseVersion(stomper.STOMP_VERSION) < LooseVersion('1.1'):
-                   log.error("Unable to NACK stomp %r" % stomper.STOMP_VERSION)
-                   # Also, not sending an erroneous ack.
-                   return
-
-               message_id = msg['headers']['message-id']
-               subscription = msg['headers']['subscription']
-               transaction_id = msg['headers'].get('transaction-id')
-               response = stomper.nack(message_id, subscription, transaction_id)
-
-           # Finally, send our response (ACK or NACK) back to the broker.
-           if not handled:
-               log.warn("handled=%r.  Responding with %s" % (handled, response))
-           else:
-               log.debug("handled=%r.  Responding with %s" % (handled, response))
-           self.transport.write(response.encode('utf-8'))
+        """Data received, react to every complete frame and respond if needed.
+
+        All of the responses for one read are written to the transport at
+        once, rather than with one write per frame.
+        """
+        self.last_received = time.time()
+        try:
+            frames = self.buffer.feed(data)
+        except FrameError as e:
+            log.error("Dropping the connection to the broker: %s" % e)
+            self.transport.loseConnection()
+            return
+
+        deferred = self.client.hub.settings.stomp_ack_mode != 'auto'
+        responses = self._responses = []
+        self._reading = threading.current_thread()
+        try:
+            for msg in frames:
+                if deferred and msg['cmd'] == 'MESSAGE':
+                    # Reply once every consumer is done with the message,
+                    # which may be later on a worker thread.
+                    ack = Acknowledgement(
+                        functools.partial(self.acknowledge, msg))
+                    ack.release(
+                        self.client.hub.consume_stomp_message(msg, ack))
+                    continue
+
+                handled = self.client.hub.consume_stomp_message(msg)
+                response = self.respond(msg, handled)
+                if response:
+                    responses.append(response)
+        finally:
+            self._responses = None
+
+        if responses:
+            self.flush(responses)
+
+    def acknowledge(self, msg, handled):
+        """ Reply to msg, now that every consumer is done with it. """
+        response = self.respond(msg, handled)
+        if not response:
+            return
+
+        if self._responses is not None and \
+           self._reading is threading.current_thread():
+            # Still handling the read that brought msg in.
+            self._responses.append(response)
+            return
+
+        self._acks.put(response)
+
+    def flush_acks(self):
+        """ Send the replies that workers queued up since the last call. """
+        self._acks.drain()
+
+    def send_acks(self, responses):
+        if self.client.proto is not self:
+            # The broker will redeliver these anyway.
+            log.warning("Lost the connection before replying to %i "
+                        "messages" % len(responses))
+            return
+        self.flush(responses)
+
+    def react(self, msg):
+        """ Dispatch a parsed frame to the handler for its command.
+
+        stomper's own react() only accepts plain dicts and strings.
+        """
+        handler = self.states.get(msg['cmd'])
+        if handler is None:
+            return stomper.NO_REPONSE_NEEDED
+        return handler(msg)
+
+    def respond(self, msg, handled):
+        """ Return a ``(command, subscription, frame)`` reply to msg, or None.
+        """
+        # See if stomper thinks we need to send anything back.
+        response = self.react(msg)
+
+        # If this kind of message doesn't need any response, then quit.
+        if not response:
+            log.debug("StompProtocol sending no response to broker.")
+            return None
+
+        command = response.split("\n", 1)[0]
+        subscription = msg['headers'].get('subscription')
+
+        # Otherwise, see if we need to turn a naive 'ack' from stomper into
+        # a 'nack' if our consumers failed to do their jobs.
+        if handled is False and command == "ACK":
+
+            send_nacks = self.client.hub.settings.stomp_send_explicit_nacks
+            if not send_nacks:
+                log.warn("Message handling failed.  stomp_send_explicit_nacks=%r.  "
+                         "Sending no reply to the broker.", send_nacks)
+                # Return, so as not to send an erroneous ack.
+                return None
+
+            if LooseVersion(stomper.STOMP_VERSION) < LooseVersion('1.1'):
+                log.error("Unable to NACK stomp %r" % stomper.STOMP_VERSION)
+                # Also, not sending an erroneous ack.
+                return None
+
+            message_id = msg['headers']['message-id']
+            transaction_id = msg['headers'].get('transaction-id')
+            response = stomper.nack(message_id, subscription, transaction_id)
+            command = "NACK"
+
+        if not handled:
+            log.warn("handled=%r.  Responding with %s" % (handled, response))
+        else:
+            log.debug("handled=%r.  Responding with %s" % (handled, response))
+        return command, subscription, response
+
+    def flush(self, responses):
+        """ Send our responses (ACKs or NACKs) back to the broker. """
+        settings = self.client.hub.settings
+        if settings.stomp_cumulative_ack and settings.stomp_ack_mode == 'client':
+            responses = coalesce_acks(responses)
+        self.transport.writeSequence([
+            response.encode('utf-8') for _, _, response in responses])
+
+
+def coalesce_acks(responses):
+    """ Collapse each run of ACKs on one subscription into its last ACK.
+
+    In the 'client' ack mode an ACK is cumulative: it acknowledges the
+    message it names and every earlier message on the same subscription.
+    A NACK, or an ACK for another subscription, ends a run.
+    """
+    coalesced = []
+    for command, subscription, response in responses:
+        if command == "ACK" and coalesced:
+            last_command, last_subscription, _ = coalesced[-1]
+            if last_command == "ACK" and last_subscription == subscription:
+                coalesced[-1] = (command, subscription, response)
+                continue
+        coalesced.append((command, subscription, response))
+    return coalesced
@@ -0,0 +1,180 @@
+# This file is part of Moksha.
+# Copyright (C) 2008-2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A bounded spool for the frames we publish while the broker is unreachable.
+
+Up to ``size`` frames are kept in memory.  If a ``path`` is given, frames
+beyond that are appended to a file of length-prefixed records, up to
+``max_bytes`` of them (0 keeps everything in memory).  The file starts with
+the offset of the oldest record not popped yet, updated as frames are popped,
+so a hub that restarts in the middle of replaying picks up where it left off
+rather than sending everything again.  The records before that offset are
+dropped once they take up more room than the ones after it, or would push the
+file past ``max_bytes``.
+"""
+
+import collections
+import logging
+import os
+import struct
+
+log = logging.getLogger('moksha.hub')
+
+_header = struct.Struct('>Q')
+_record = struct.Struct('>I')
+
+
+class Spool(object):
+    """ A FIFO of encoded frames, in memory and then on disk. """
+
+    def __init__(self, size=10000, path=None, max_bytes=104857600):
+        self.size = size
+        self.path = path if max_bytes else None
+        self.max_bytes = max_bytes
+        self.memory = collections.deque()
+
+        # Records in the file that have not been popped yet, and their size.
+        self.on_disk = 0
+        self.disk_bytes = 0
+        # Where the oldest of those starts, and where the file ends.
+        self._start = self._end = _header.size
+        self._file = None
+        if self.path:
+            self._open()
+
+    def _open(self):
+        mode = 'r+b' if os.path.exists(self.path) else 'w+b'
+        self._file = f = open(self.path, mode)
+
+        header = f.read(_header.size)
+        if len(header) == _header.size:
+            self._start, = _header.unpack(header)
+        else:
+            self._mark(_header.size)
+
+        # Count what a previous run left behind.  A record cut short by a
+        # crash is dropped.
+        end = self._start
+        f.seek(end)
+        while True:
+            header = f.read(_record.size)
+            if len(header) < _record.size:
+                break
+            length, = _record.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+            end += _record.size + length
+            self.on_disk += 1
+
+        if end != os.path.getsize(self.path):
+            log.warning("Discarding a partial record at the end of %r" %
+                        self.path)
+            f.truncate(end)
+        self._end = end
+        self.disk_bytes = end - self._start
+
+        if self.on_disk:
+            log.info("Found %i spooled frames in %r" % (
+                self.on_disk, self.path))
+
+    def _mark(self, start):
+        """ Record that everything before `start` has been popped. """
+        self._start = start
+        self._file.seek(0)
+        self._file.write(_header.pack(start))
+        self._file.flush()
+
+    def _compact(self):
+        """ Drop the records that were popped already from the file. """
+        tmp = self.path + '.tmp'
+        self._file.seek(self._start)
+        with open(tmp, 'wb') as f:
+            f.write(_header.pack(_header.size))
+            while True:
+                data = self._file.read(65536)
+                if not data:
+                    break
+                f.write(data)
+        os.rename(tmp, self.path)
+        self._file.close()
+        self._file = open(self.path, 'r+b')
+        self._start = _header.size
+        self._end = self._start + self.disk_bytes
+
+    def __len__(self):
+        return len(self.memory) + self.on_disk
+
+    @property
+    def full(self):
+        if len(self.memory) < self.size:
+            return False
+        if not self.path:
+            return True
+        return self.disk_bytes >= self.max_bytes
+
+    def append(self, frame):
+        # Once anything is on disk, everything newer goes there too, to keep
+        # the frames in order.
+        if self.path and (self.on_disk or len(self.memory) >= self.size):
+            size = _record.size + len(frame)
+            if self._start > _header.size and \
+               self._end - _header.size + size > self.max_bytes:
+                self._compact()
+            self._file.seek(self._end)
+            self._file.write(_record.pack(len(frame)) + frame)
+            self._file.flush()
+            self.on_disk += 1
+            self.disk_bytes += size
+            self._end += size
+        else:
+            self.memory.append(frame)
+
+    def extend(self, frames):
+        for frame in frames:
+            self.append(frame)
+
+    def pop(self, count):
+        """ Remove and return up to ``count`` of the oldest frames. """
+        frames = []
+        while self.memory and len(frames) < count:
+            frames.append(self.memory.popleft())
+
+        if self.on_disk and len(frames) < count:
+            start = self._start
+            self._file.seek(start)
+            while self.on_disk and len(frames) < count:
+                length, = _record.unpack(self._file.read(_record.size))
+                frames.append(self._file.read(length))
+                self.on_disk -= 1
+                self.disk_bytes -= _record.size + length
+                start += _record.size + length
+
+            if not self.on_disk:
+                # Everything on disk has been popped; start the file over.
+                self._file.truncate(_header.size)
+                self._end = _header.size
+                self._mark(_header.size)
+            else:
+                self._mark(start)
+                if start - _header.size > self.disk_bytes:
+                    self._compact()
+
+        return frames
+
+    def close(self):
+        if self._file:
+            self._file.close()
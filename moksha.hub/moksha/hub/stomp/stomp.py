@@ -27,80 +27,239 @@ except ImportError:
         pass
 
 import logging
+import time
 
-import six
+from twisted.internet import error
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
 from twisted.internet.protocol import ClientFactory
+from twisted.internet.task import LoopingCall
+from zope.interface import implementer
 
+from moksha.common.exc import SpoolFull
+
+from moksha.hub.stomp.frame import SendEncoder
 from moksha.hub.stomp.protocol import StompProtocol
+from moksha.hub.stomp.spool import Spool
 from moksha.hub.messaging import MessagingHubExtension
-from moksha.hub.reactor import reactor
+from moksha.hub.reactor import reactor, Handoff
 
 log = logging.getLogger('moksha.hub')
 
 
+@implementer(IOpenSSLClientConnectionCreator)
+class _ResumingTLS(object):
+    """ Opens TLS connections to one broker with the shared context, and
+    resumes the session last established with it.
+    """
+
+    def __init__(self, options, sessions, address):
+        self.options = options
+        self.sessions = sessions
+        self.address = address
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        from OpenSSL import SSL
+
+        connection = SSL.Connection(self.options.getContext(), None)
+        connection.set_app_data(tlsProtocol)
+        session = self.sessions.get(self.address)
+        if session is not None:
+            connection.set_session(session)
+        return connection
+
+
 class StompHubExtension(MessagingHubExtension, ClientFactory):
+    name = 'stomp'
+    carries_headers = True
     username = None
     password = None
     proto = None
-    frames = None
 
-    def __init__(self, hub, config):
+    def __init__(self, hub, config, uri=None, topics=None, spool_path=None):
         self.config = config
         self.hub = hub
-        self._topics = list(hub.topics.keys())
-        self._frames = []
+        if topics is None:
+            topics = hub.topics.keys()
+        self._topics = list(topics)
 
-        uri = self.config.get('stomp_uri', None)
+        # Frames published since the last flush, written out together once
+        # per reactor iteration.
+        self._outgoing = Handoff(self.write)
+
+        self.settings = settings = hub.settings
+
+        # Frames published while we are not connected, replayed at a limited
+        # rate once we are.
+        self.spool = Spool(settings.stomp_spool_size,
+                           spool_path or settings.stomp_spool_path,
+                           settings.stomp_spool_max_bytes)
+        self._replayer = None
+
+        uri = uri or settings.stomp_uri
         if not uri:
-            port = int(self.config.get('stomp_port', 61613))
-            host = self.config.get('stomp_broker')
-            uri = "%s:%i" % (host, port)
+            uri = "%s:%i" % (settings.stomp_broker, settings.stomp_port)
 
         # A list of addresses over which we emulate failover()
         self.addresses = [pair.split(":") for pair in uri.split(',')]
         self.address_index = 0
 
         # An exponential delay used to back off if we keep failing.
-        self._delay = float(self.config.get('stomp_delay', '0.1'))
-
-        self.username = self.config.get('stomp_user', 'guest')
-        self.password = self.config.get('stomp_pass', 'guest')
-
-        self.key = self.config.get('stomp_ssl_key', None)
-        self.crt = self.config.get('stomp_ssl_crt', None)
-
-        self.client_heartbeat = int(self.config.get('stomp_heartbeat', 0))
-
-        self.connect(self.addresses[self.address_index], self.key, self.crt)
+        self._delay = settings.stomp_delay
+
+        self.username = settings.stomp_user
+        self.password = settings.stomp_pass
+
+        self.key = settings.stomp_ssl_key
+        self.crt = settings.stomp_ssl_crt
+        self.ssl_context = None
+        # {(host, port): the TLS session to resume with that broker}
+        self.tls_sessions = {}
+        if self.key and self.crt:
+            self.ssl_context = self.load_ssl_context(self.key, self.crt)
+        self._attempts = []
+        self._stagger = None
+        self._tried = 0
+        self._watchdog = None
+        self._heartbeat = None
+        self._reconnect = None
+        self._closing = False
+
+        self.client_heartbeat = settings.stomp_heartbeat
+
+        # Messages are acknowledged when a worker finishes them.  In 'client'
+        # mode each ACK also covers every earlier message, including ones
+        # that other workers have not finished yet.
+        if settings.stomp_ack_mode == 'client' and \
+           not settings.moksha_blocking_mode and \
+           settings.moksha_workers_per_consumer > 1:
+            log.warning("stomp_ack_mode=client with %i workers per consumer "
+                        "may acknowledge messages before they are consumed.  "
+                        "Use client-individual instead." %
+                        settings.moksha_workers_per_consumer)
+
+        # STOMP 1.0 has no header value encoding.
+        self.encoder = SendEncoder(escape_headers=(
+            settings.stomp_unescape_headers and
+            stomper.STOMP_VERSION != '1.0'))
+
+        self.start_connecting()
         super(StompHubExtension, self).__init__()
 
-    def connect(self, address, key=None, crt=None):
+    def load_ssl_context(self, key, crt):
+        """ Read the client key and certificate once, for every connection.
+        """
+        from twisted.internet import ssl
+
+        with open(key) as key_file:
+            with open(crt) as cert_file:
+                client_cert = ssl.PrivateCertificate.loadPEM(
+                    key_file.read() + cert_file.read())
+
+        return client_cert.options()
+
+    def save_tls_session(self):
+        """ Keep the TLS session of the connection just made, to resume it
+        when we connect to that broker again. """
+        if self.ssl_context is None or self.proto is None:
+            return
+        handle = self.proto.transport.getHandle()
+        session = getattr(handle, 'get_session', lambda: None)()
+        if session is not None:
+            host, port = self.addresses[self.address_index]
+            self.tls_sessions[(host, port)] = session
+
+    def start_connecting(self):
+        """ Try the addresses, starting at the current one.
+
+        The next address is tried whenever an attempt fails, or once
+        ``stomp_connect_stagger`` seconds pass without the attempts so far
+        succeeding.  The first connection that is established wins and the
+        other attempts are abandoned.
+        """
+        self._attempts = []
+        self._tried = 0
+        self.connect_next()
+
+    def connect_next(self):
+        self._stagger = None
+        if self._closing or self.proto or \
+           self._tried >= len(self.addresses):
+            return
+
+        index = (self.address_index + self._tried) % len(self.addresses)
+        self._tried += 1
+        self.connect(self.addresses[index], index=index)
+
+        stagger = self.settings.stomp_connect_stagger
+        if stagger and self._tried < len(self.addresses):
+            self._stagger = reactor.callLater(stagger, self.connect_next)
+
+    def connect(self, address, index=None):
         host, port = address
-        if key and crt:
+        if index is None:
+            index = self.address_index
+        attempt = _ConnectionAttempt(self, index)
+        self._attempts.append(attempt)
+
+        if self.ssl_context is not None:
             log.info("connecting encrypted to %r %r %r" % (
                 host, int(port), self))
-
-            from twisted.internet import ssl
-
-            with open(key) as key_file:
-                with open(crt) as cert_file:
-                    client_cert = ssl.PrivateCertificate.loadPEM(
-                        key_file.read() + cert_file.read())
-
-            ssl_context = client_cert.options()
-            reactor.connectSSL(host, int(port), self, ssl_context)
+            attempt.connector = reactor.connectSSL(
+                host, int(port), attempt, _ResumingTLS(
+                    self.ssl_context, self.tls_sessions, (host, port)))
         else:
             log.info("connecting unencrypted to %r %r %r" % (
                 host, int(port), self))
-            reactor.connectTCP(host, int(port), self)
+            attempt.connector = reactor.connectTCP(host, int(port), attempt)
+
+    def attempt_succeeded(self, attempt, addr):
+        if self.proto is not None:
+            # Another address beat this one to it.
+            return None
+
+        # Claim the win before abandoning the others: stopping them calls
+        # attempt_failed right away, which must not try another address.
+        self.address_index = attempt.index
+        proto = self.buildProtocol(addr)
+        self.cancel_attempts(attempt)
+        return proto
+
+    def attempt_failed(self, attempt, connector, reason):
+        if attempt in self._attempts:
+            self._attempts.remove(attempt)
+        if self.proto is not None or self._closing:
+            return
+
+        log.info('Connection to %r failed.  Reason: %s' % (
+            self.addresses[attempt.index], reason))
+        if self._tried < len(self.addresses):
+            # Don't wait for the stagger; try the next one right away.
+            if self._stagger is not None and self._stagger.active():
+                self._stagger.cancel()
+            self.connect_next()
+        elif not self._attempts:
+            self.clientConnectionFailed(connector, reason)
+
+    def cancel_attempts(self, winner=None):
+        if self._stagger is not None and self._stagger.active():
+            self._stagger.cancel()
+        self._stagger = None
+        for attempt in list(self._attempts):
+            if attempt is not winner and attempt.connector is not None:
+                try:
+                    attempt.connector.stopConnecting()
+                except error.NotConnectingError:
+                    pass
+        self._attempts = [winner] if winner else []
 
     def buildProtocol(self, addr):
-        self._delay = float(self.config.get('stomp_delay', '0.1'))
+        self._delay = self.settings.stomp_delay
         log.debug("build protocol was called with %r" % addr)
         self.proto = StompProtocol(self, self.username, self.password)
         return self.proto
 
-    def connected(self, server_heartbeat):
+    def connected(self, server_heartbeat, server_sends=0):
+        self.save_tls_session()
         if server_heartbeat and self.client_heartbeat:
             interval = max(self.client_heartbeat, server_heartbeat)
             log.debug("Heartbeat of %ims negotiated from (%i,%i); starting." % (
@@ -109,12 +268,16 @@ class StompHubExtension(MessagingHubExtension, ClientFactory):
         else:
             log.debug("Skipping heartbeat initialization")
 
+        if server_sends and self.client_heartbeat and \
+           self.settings.stomp_heartbeat_grace:
+            self.start_watchdog(max(self.client_heartbeat, server_sends))
+
         # Sometimes, a stomp consumer may wish to be subscribed to a queue
         # which is composed of messages from many different topics.  In this
         # case, the hub hands dispatching messages to the right consumers.
         # This extension is only concerned with the queue, and negotiating that
         # with the broker.
-        stomp_queue = self.config.get('stomp_queue', None)
+        stomp_queue = self.settings.stomp_queue
         if stomp_queue and self._topics and self._topics != [stomp_queue]:
             log.info('Discarding consumer-specified topics in favor of '
                      'stomp_queue=%s: %r' % (stomp_queue, self._topics))
@@ -125,65 +288,184 @@ class StompHubExtension(MessagingHubExtension, ClientFactory):
             log.info('Subscribing to %s topic' % topic)
             self.subscribe(topic, callback=lambda msg: None)
 
-        for frame in self._frames:
-            log.debug('Flushing queued frame')
-            self.proto.transport.write(frame.pack().encode('utf-8'))
-        self._frames = []
+        self.start_replay()
+
+    def start_replay(self):
+        if not self.spool or (self._replayer and self._replayer.running):
+            return
+
+        rate = self.settings.stomp_spool_replay_rate
+        if rate:
+            interval = 0.1
+            batch = max(1, int(rate * interval))
+        else:
+            # As fast as we can, but still a bounded chunk per iteration.
+            interval, batch = 0, 1000
+
+        log.info('Replaying %i spooled frames' % len(self.spool))
+        self._replayer = LoopingCall(self.replay, batch)
+        self._replayer.start(interval)
+
+    def stop_replay(self):
+        if self._replayer and self._replayer.running:
+            self._replayer.stop()
+
+    def replay(self, batch):
+        if not self.proto:
+            self.stop_replay()
+            return
+
+        frames = self.spool.pop(batch)
+        if frames:
+            self.proto.transport.writeSequence(frames)
+        if not self.spool:
+            log.info('Done replaying spooled frames')
+            self.stop_replay()
 
     def clientConnectionLost(self, connector, reason):
         log.info('Lost connection.  Reason: %s' % reason)
+        self.proto = None
+        self._attempts = []
+        self.stop_replay()
         self.stop_heartbeat()
+        self.stop_watchdog()
         self.failover()
 
     def clientConnectionFailed(self, connector, reason):
         log.error('Connection failed. Reason: %s' % reason)
         self.stop_heartbeat()
+        self.stop_watchdog()
         self.failover()
 
     def failover(self):
+        if self._closing:
+            return
         self.address_index = (self.address_index + 1) % len(self.addresses)
-        args = (self.addresses[self.address_index], self.key, self.crt,)
         self._delay = min(60.0, self._delay * (1 + (2.0 / len(self.addresses))))
         log.info('(failover) reconnecting in %f seconds.' % self._delay)
-        reactor.callLater(self._delay, self.connect, *args)
+        self._reconnect = reactor.callLater(self._delay, self.start_connecting)
+
+    def start_watchdog(self, interval):
+        """ Drop the connection if the broker goes quiet for too long. """
+        timeout = interval / 1000.0 * self.settings.stomp_heartbeat_grace
+        log.debug("Expecting heart-beats from the broker every %ims" % interval)
+        self._watchdog = LoopingCall(self.check_heartbeat, timeout)
+        self._watchdog.start(interval / 1000.0, now=False)
+
+    def check_heartbeat(self, timeout):
+        if not self.proto:
+            self.stop_watchdog()
+            return
+
+        silence = time.time() - self.proto.last_received
+        if silence > timeout:
+            log.warning("Heard nothing from the broker for %.1f seconds.  "
+                        "Dropping the connection." % silence)
+            self.stop_watchdog()
+            transport = self.proto.transport
+            if hasattr(transport, 'abortConnection'):
+                transport.abortConnection()
+            else:
+                transport.loseConnection()
+
+    def stop_watchdog(self):
+        if self._watchdog and self._watchdog.running:
+            self._watchdog.stop()
+        self._watchdog = None
 
     def start_heartbeat(self, interval):
-        self._heartbeat_enabled = True
-        reactor.callLater(interval / 1000.0, self.heartbeat, interval)
+        self._heartbeat = reactor.callLater(
+            interval / 1000.0, self.heartbeat, interval)
 
     def heartbeat(self, interval):
-        if self._heartbeat_enabled:
-            self.proto.transport.write(chr(0x0A).encode('utf-8'))  # Lub-dub
-            reactor.callLater(interval / 1000.0, self.heartbeat, interval)
-        else:
-            log.debug("(heartbeat stopped)")
+        self.proto.transport.write(chr(0x0A).encode('utf-8'))  # Lub-dub
+        self._heartbeat = reactor.callLater(
+            interval / 1000.0, self.heartbeat, interval)
 
     def stop_heartbeat(self):
         log.debug("stopping heartbeat")
-        self._heartbeat_enabled = False
+        if self._heartbeat is not None and self._heartbeat.active():
+            self._heartbeat.cancel()
+        self._heartbeat = None
 
     def send_message(self, topic, message, **headers):
-        # Convert any utf-8 encoded payloads back to unicode.  stomper can't handle bytestrings
-        topic = topic.decode('utf-8') if isinstance(topic, six.binary_type) else topic
-        message = message.decode('utf-8') if isinstance(message, six.binary_type) else message
-        f = stomper.Frame()
-        f.unpack(stomper.send(topic, message))
-        if not self.proto:
-            log.info("Queueing stomp frame for later delivery")
-            self._frames.append(f)
-        else:
-            self.proto.transport.write(f.pack().encode('utf-8'))
+        if self.spool.full:
+            raise SpoolFull("%i stomp frames are waiting for the broker" %
+                            len(self.spool))
+
+        # Publishes may come from consumer threads; the transport belongs to
+        # the reactor.
+        self._outgoing.put(self.encoder.encode(topic, message, headers))
 
         super(StompHubExtension, self).send_message(topic, message, **headers)
 
+    def send_messages(self, messages):
+        if self.spool.full:
+            raise SpoolFull("%i stomp frames are waiting for the broker" %
+                            len(self.spool))
+
+        encode = self.encoder.encode
+        self._outgoing.extend([
+            encode(topic, message, headers)
+            for topic, message, headers in messages])
+
+    def flush(self):
+        """ Write every frame published since the last flush at once. """
+        self._outgoing.drain()
+
+    def write(self, frames):
+        if not self.proto or self.spool:
+            # Stay behind whatever is still waiting to be replayed.
+            log.debug("Spooling %i stomp frames for later delivery" %
+                      len(frames))
+            self.spool.extend(frames)
+        else:
+            self.proto.transport.writeSequence(frames)
+
+    def close(self):
+        self._closing = True
+        if self._reconnect is not None and self._reconnect.active():
+            self._reconnect.cancel()
+        self._reconnect = None
+        self.cancel_attempts()
+        self.stop_replay()
+        self.stop_heartbeat()
+        self.stop_watchdog()
+        self.spool.close()
+
     def subscribe(self, topic, callback):
         # FIXME -- note, the callback is just thrown away here.
+        # Remember the topic, so that we subscribe again after reconnecting.
+        if topic not in self._topics:
+            self._topics.append(topic)
+
         if not self.proto:
             log.info("queuing topic for later subscription %r." % topic)
-            if topic not in self._topics:
-                self._topics.append(topic)
         else:
             log.debug("sending subscription to the protocol")
             self.proto.subscribe(topic)
 
         super(StompHubExtension, self).subscribe(topic, callback)
+
+
+class _ConnectionAttempt(ClientFactory):
+    """ One of possibly several concurrent attempts to reach the broker. """
+
+    connector = None
+
+    def __init__(self, extension, index):
+        self.extension = extension
+        self.index = index
+        self.won = False
+
+    def buildProtocol(self, addr):
+        proto = self.extension.attempt_succeeded(self, addr)
+        self.won = proto is not None
+        return proto
+
+    def clientConnectionFailed(self, connector, reason):
+        self.extension.attempt_failed(self, connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        if self.won:
+            self.extension.clientConnectionLost(connector, reason)
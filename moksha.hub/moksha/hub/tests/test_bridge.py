@@ -0,0 +1,196 @@
+# This file is part of Moksha.
+# Copyright (C) 2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Test forwarding messages between hub extensions. """
+
+import threading
+import zlib
+from collections import defaultdict
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import mock
+from nose.tools import eq_
+
+from moksha.hub.bridge import Bridge, Rule, HOPS, ORIGIN, MESSAGE_ID
+from moksha.hub.messaging import Envelope, MessagingHubExtension
+from moksha.hub.serialization import decode
+
+
+class FakeExtension(MessagingHubExtension):
+    def __init__(self, name, carries_headers=False):
+        self.name = name
+        self.carries_headers = carries_headers
+        self.sent = []
+        self.subscriptions = []
+        self.block = None
+
+    def send_message(self, topic, message, **headers):
+        if self.block:
+            self.block.wait()
+        self.sent.append((topic, message, headers))
+
+    def subscribe(self, topic, callback):
+        self.subscriptions.append((topic, callback))
+
+
+class FakeMessage(object):
+    def __init__(self, topic, body):
+        self.topic = topic
+        self.body = body
+
+
+class FakeHub(object):
+    def __init__(self):
+        self.topics = defaultdict(list)
+        self.zmq = FakeExtension('zmq')
+        self.stomp = FakeExtension('stomp', carries_headers=True)
+        self.extensions = [self.zmq, self.stomp]
+
+
+class TestRule(unittest.TestCase):
+
+    def test_parse(self):
+        rule = Rule.parse('zmq:stomp+amqp:org.fedoraproject.*')
+        eq_(rule.source, 'zmq')
+        eq_(rule.destinations, ['stomp', 'amqp'])
+        eq_(rule.topic, 'org.fedoraproject.*')
+
+    def test_topic_with_colons(self):
+        eq_(Rule.parse('stomp:zmq:/topic/a:b').topic, '/topic/a:b')
+
+    def test_bad_rule(self):
+        self.assertRaises(ValueError, Rule.parse, 'zmq-stomp')
+
+
+class TestBridge(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = FakeHub()
+
+    def bridge(self, *rules, **kw):
+        bridge = Bridge(self.hub, rules, **kw)
+        self.addCleanup(bridge.close)
+        return bridge
+
+    def drain(self, bridge):
+        bridge.close()
+        for outlet in bridge.outlets.values():
+            outlet.thread.join(5)
+
+    def test_forward(self):
+        bridge = self.bridge('zmq:stomp:org.test')
+        topic, callback = self.hub.zmq.subscriptions[0]
+        eq_(topic, 'org.test')
+
+        callback(FakeMessage('org.test', '{"a": 1}'))
+        self.drain(bridge)
+        eq_(len(self.hub.stomp.sent), 1)
+        topic, body, headers = self.hub.stomp.sent[0]
+        eq_((topic, body), ('org.test', '{"a": 1}'))
+        eq_(headers[HOPS], 1)
+        eq_(headers[ORIGIN], bridge.origin)
+
+    def test_headers_only_where_supported(self):
+        bridge = self.bridge('stomp:zmq:/topic/test')
+        eq_(len(self.hub.topics['/topic/test']), 1)
+        callback = self.hub.topics['/topic/test'][0]
+
+        callback(Envelope(topic='/topic/test', body={'a': 1}, headers={}))
+        self.drain(bridge)
+        eq_(self.hub.zmq.sent, [('/topic/test', '{"a": 1}', {})])
+
+    def test_compressed(self):
+        """ Compressed STOMP messages reach zeromq as they were sent. """
+        bridge = self.bridge('stomp:zmq:/topic/test')
+        callback = self.hub.topics['/topic/test'][0]
+        headers = {'content-type': 'text/plain',
+                   'content-encoding': 'deflate'}
+
+        envelope = Envelope.lazy(lambda: {'x': 1}, topic='/topic/test',
+                                 headers=headers)
+        envelope.raw = zlib.compress(b'{"x": 1}')
+        callback(envelope)
+        # Without the wire body, it is encoded again, and isn't compressed.
+        callback(Envelope(topic='/topic/test', body={'x': 2},
+                          headers=headers))
+        self.drain(bridge)
+
+        eq_([decode(body) for topic, body, headers in self.hub.zmq.sent],
+            [{'x': 1}, {'x': 2}])
+
+    def test_duplicates(self):
+        bridge = self.bridge('zmq:stomp:org.test')
+        callback = self.hub.zmq.subscriptions[0][1]
+        callback(FakeMessage('org.test', 'body'))
+        callback(FakeMessage('org.test', 'body'))
+        callback(FakeMessage('org.test', 'other'))
+        self.drain(bridge)
+        eq_([m[1] for m in self.hub.stomp.sent], ['body', 'other'])
+        eq_(bridge.duplicates, 1)
+
+    def test_repeats(self):
+        """ Identical messages sent again later are not duplicates. """
+        bridge = self.bridge('zmq:stomp:org.test', dedupe_ttl=5)
+        callback = self.hub.zmq.subscriptions[0][1]
+        with mock.patch('moksha.hub.bridge.time.time', return_value=100):
+            callback(FakeMessage('org.test', 'heartbeat'))
+        with mock.patch('moksha.hub.bridge.time.time', return_value=104):
+            callback(FakeMessage('org.test', 'heartbeat'))
+        with mock.patch('moksha.hub.bridge.time.time', return_value=110):
+            callback(FakeMessage('org.test', 'heartbeat'))
+        self.drain(bridge)
+        eq_(len(self.hub.stomp.sent), 2)
+        eq_(bridge.duplicates, 1)
+
+    def test_loops(self):
+        bridge = self.bridge('stomp:zmq:/topic/test', max_hops=3)
+        # Back where it entered the bridge.
+        bridge.forward('stomp', '/topic/test', 'a', {
+            HOPS: '2', ORIGIN: bridge.origin, MESSAGE_ID: '1'})
+        # Gone around too often.
+        bridge.forward('stomp', '/topic/test', 'b', {
+            HOPS: '3', ORIGIN: 'elsewhere', MESSAGE_ID: '2'})
+        bridge.forward('stomp', '/topic/test', 'c', {
+            HOPS: '2', ORIGIN: 'elsewhere', MESSAGE_ID: '3'})
+        self.drain(bridge)
+        eq_([m[1] for m in self.hub.zmq.sent], ['c'])
+        eq_(bridge.looped, 2)
+
+    def test_websocket(self):
+        bridge = self.bridge('websocket:zmq:org.test.*')
+        bridge.forward('websocket', 'org.test.a', 'a')
+        bridge.forward('websocket', 'org.other', 'b')
+        self.drain(bridge)
+        eq_([m[1] for m in self.hub.zmq.sent], ['a'])
+
+    def test_slow_destination(self):
+        """ A stuck broker loses messages instead of blocking others. """
+        self.hub.zmq.block = threading.Event()
+        bridge = self.bridge('websocket:zmq+stomp:*', queue_size=2)
+        for i in range(10):
+            bridge.forward('websocket', 'org.test', str(i))
+
+        eq_(bridge.outlets['zmq'].dropped >= 7, True)
+        self.hub.zmq.block.set()
+        self.drain(bridge)
+        eq_(len(self.hub.stomp.sent) + bridge.outlets['stomp'].dropped, 10)
+
+    def test_unknown_extension(self):
+        self.assertRaises(ValueError, Bridge, self.hub, ['zmq:amqp:#'])
+        self.assertRaises(ValueError, Bridge, self.hub, ['zmq:websocket:#'])
@@ -0,0 +1,132 @@
+# This file is part of Moksha.
+# Copyright (C) 2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Test publishing large bodies by reference. """
+
+import json
+import os
+import shutil
+import tempfile
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import mock
+from nose.tools import eq_
+
+from moksha.hub.claimcheck import (
+    CLAIM_CONTENT_TYPE, ClaimCheck, DirectoryStore, open_store)
+from moksha.hub.compression import Compression
+from moksha.hub.hub import MokshaHub
+from moksha.hub.serialization import CONTENT_TYPE, get, inline
+from moksha.hub.stomp.frame import FrameParser, SendEncoder
+
+
+class TestDirectoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.store = DirectoryStore(self.path)
+
+    def test_content_addressed(self):
+        key = self.store.put(b'body')
+        eq_(self.store.put(b'body'), key)
+        eq_(self.store.get(key), b'body')
+        eq_(os.listdir(os.path.join(self.path, key[:2])), [key])
+
+    def test_bad_key(self):
+        self.assertRaises(ValueError, self.store.get, '../../etc/passwd')
+
+    def test_open(self):
+        eq_(open_store('file://' + self.path).path, self.path)
+        eq_(open_store(self.path).path, self.path)
+        self.assertRaises(ValueError, open_store, 'nope://claims')
+
+
+class TestClaimCheck(unittest.TestCase):
+
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.store = DirectoryStore(path)
+        self.claims = ClaimCheck(self.store, threshold=100,
+                                 summary=['id', 'user'], cache_size=1)
+        self.message = {'id': 1, 'user': 'ralph', 'diff': 'x' * 200}
+        self.body = json.dumps(self.message)
+
+    def test_small(self):
+        eq_(self.claims.check({}, '{}', {}), None)
+
+    def test_reference(self):
+        reference = json.loads(self.claims.check(
+            self.message, self.body, {CONTENT_TYPE: 'application/json'}))
+        eq_(reference['summary'], {'id': 1, 'user': 'ralph'})
+        eq_(reference['size'], len(self.body))
+        eq_(self.store.get(reference['claim']), self.body.encode('utf-8'))
+
+    def test_fetch_is_cached(self):
+        reference = json.loads(self.claims.check(
+            self.message, self.body, {CONTENT_TYPE: 'application/json'}))
+        with mock.patch.object(self.store, 'get', wraps=self.store.get) as get:
+            for i in range(3):
+                eq_(self.claims.fetch(reference, None), self.message)
+            eq_(get.call_count, 1)
+
+
+class TestHubClaimCheck(unittest.TestCase):
+    """ From publishing a large message to a consumer reading it. """
+
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.hub = MokshaHub.__new__(MokshaHub)
+        self.hub.compression = Compression('zlib', threshold=100)
+        self.hub.claims = ClaimCheck(DirectoryStore(path), threshold=100,
+                                     summary=['id'])
+        self.message = {'id': 1, 'diff': [str(i) for i in range(1000)]}
+
+    def test_round_trip(self):
+        body, headers = self.hub.encode(get('json'), 'org.test', self.message)
+        eq_(headers, {CONTENT_TYPE: CLAIM_CONTENT_TYPE})
+
+        # Over a broker without headers, too.
+        for raw, received in [(body, headers), (inline(body, headers), {})]:
+            with mock.patch.object(self.hub.claims, 'fetch',
+                                   wraps=self.hub.claims.fetch) as fetch:
+                envelope = self.hub.envelope('org.test', raw, received)
+                eq_(envelope['summary'], {'id': 1})
+                eq_(fetch.call_count, 0)
+                eq_(envelope['body'], self.message)
+                eq_(fetch.call_count, 1)
+
+    def test_over_stomp(self):
+        body, headers = self.hub.encode(get('json'), 'org.test', self.message)
+        frame, = FrameParser().feed(
+            SendEncoder().encode('/topic/org.test', body, headers))
+        envelope = self.hub.envelope('org.test', frame.raw_body,
+                                     frame.headers)
+        eq_(envelope['summary'], {'id': 1})
+        eq_(envelope['body'], self.message)
+
+    def test_no_store(self):
+        """ Hubs that can't fetch the body still get the summary. """
+        body, headers = self.hub.encode(get('json'), 'org.test', self.message)
+        self.hub.claims = None
+        envelope = self.hub.envelope('org.test', body, headers)
+        eq_(envelope['summary'], {'id': 1})
+        eq_(envelope['body'], body)
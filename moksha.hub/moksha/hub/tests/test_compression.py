@@ -0,0 +1,75 @@
+# This file is part of Moksha.
+# Copyright (C) 2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Test compressing large message bodies. """
+
+import json
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from nose.tools import eq_
+
+from moksha.hub.compression import CONTENT_ENCODING, Compression
+from moksha.hub.serialization import (
+    CONTENT_TYPE, compressed, decode, framed, inline)
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.compression = Compression('zlib', threshold=100)
+        self.body = json.dumps({'diff': ['line %i' % i for i in range(100)]})
+
+    def test_threshold(self):
+        eq_(self.compression.compress('org.test', '{}'), ('{}', None))
+        eq_(Compression().compress('org.test', self.body), (self.body, None))
+
+        body, encoding = self.compression.compress('org.test', self.body)
+        eq_(encoding, 'deflate')
+        assert len(body) < len(self.body)
+
+    def test_headers(self):
+        body, encoding = self.compression.compress('org.test', self.body)
+        headers = {CONTENT_TYPE: 'application/json', CONTENT_ENCODING: encoding}
+        assert compressed(body, headers)
+        eq_(decode(body, 'application/json', encoding), json.loads(self.body))
+
+    def test_inline(self):
+        """ Brokers without headers get the encoding in front of the body. """
+        body, encoding = self.compression.compress('org.test', self.body)
+        body = inline(body, {CONTENT_ENCODING: encoding})
+        assert framed(body)
+        assert compressed(body)
+        eq_(decode(body), json.loads(self.body))
+
+    def test_stats(self):
+        for i in range(2):
+            body, encoding = self.compression.compress('org.test', self.body)
+        self.compression.decompress(b'org.test', body, encoding)
+        self.compression.compress('org.small', '{}')
+
+        stats = self.compression.__json__()
+        eq_(list(stats), ['org.test'])
+        eq_(stats['org.test']['compressed'], 2)
+        eq_(stats['org.test']['decompressed'], 1)
+        assert stats['org.test']['ratio'] > 1
+        eq_(self.compression.__json__(), {})
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, Compression, 'nope')
+        self.assertRaises(ValueError, decode, b'x', None, 'nope')
@@ -94,6 +94,28 @@ class TestHub:
 
         eq_(messages_received, [secret])
 
+    @testutils.crosstest
+    def test_hub_send_recv_batch(self):
+        "Test that we can send several messages at once."
+
+        messages_received = []
+
+        def callback(json):
+            messages_received.append(json.body[1:-1])
+
+        self.hub.subscribe(topic=self.topic, callback=callback)
+        sleep(sleep_duration)
+
+        self.hub.send_messages([
+            (self.topic, secret),
+            (self.topic, secret + '2', {'a': 'b'}),
+        ])
+
+        simulate_reactor(sleep_duration)
+        sleep(sleep_duration)
+
+        eq_(messages_received, [secret, secret + '2'])
+
     @testutils.crosstest
     def test_hub_no_subscription(self):
         "Test that we don't receive messages we're not subscribed for."
@@ -594,3 +616,238 @@ class TestMonitoring:
             eq_(d['producers'][0]['name'], 'MonitoringProducer')
         finally:
             shutil.rmtree(tmpdir)
+
+
+class TestConsumerGroups(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        endpoint = 'ipc://' + self.tmpdir + '/groups'
+        config = {
+            "zmq_enabled": True,
+            "zmq_publish_endpoints": "tcp://*:6543",
+            "zmq_subscribe_endpoints": "tcp://127.0.0.1:6543",
+            "zmq_strict": True,
+            "zmq_group_bind_endpoint": endpoint,
+            "zmq_group_endpoint": endpoint,
+            "zmq_group_credit": 1,
+            "moksha.blocking_mode": True,
+        }
+        self.hub = MokshaHub(config=config)
+        self.topic = str(uuid4())
+
+    def tearDown(self):
+        self.hub.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_group_splits_work(self):
+        """ Messages for a group are handled once, by one of its members. """
+
+        received = []
+
+        class TestConsumer(moksha.hub.api.consumer.Consumer):
+            topic = self.topic
+            group = 'workers'
+
+            def consume(self, message):
+                received.append(('consumer', message['body']))
+
+        TestConsumer(self.hub)
+
+        # A second member of the same group, as another hub would have.
+        from moksha.hub.zeromq.group import GroupMember
+        ext = self.hub.extensions[0]
+        other = GroupMember(ext, ext.twisted_zmq_factory,
+                            self.hub.config['zmq_group_endpoint'])
+        other.subscribe('workers', self.topic, lambda message: received.append(
+            ('other', json.loads(message.body))))
+
+        simulate_reactor(sleep_duration)
+        sleep(sleep_duration)
+
+        for i in range(10):
+            self.hub.send_message(topic=self.topic, message=i)
+
+        simulate_reactor(sleep_duration * 4)
+        other.close()
+
+        eq_(sorted(body for member, body in received), list(range(10)))
+        members = set(member for member, body in received)
+        eq_(members, set(['consumer', 'other']))
+
+    def test_group_credit(self):
+        """ A member is never handed more messages than it has credit for. """
+
+        from moksha.hub.zeromq.group import GroupMember
+        ext = self.hub.extensions[0]
+        member = GroupMember(ext, ext.twisted_zmq_factory,
+                             self.hub.config['zmq_group_endpoint'], credit=2)
+
+        held = []
+        member.subscribe('slow', self.topic, lambda message: (
+            message.ack.hold(), held.append(message)))
+
+        simulate_reactor(sleep_duration)
+        sleep(sleep_duration)
+
+        for i in range(5):
+            self.hub.send_message(topic=self.topic, message=i)
+
+        simulate_reactor(sleep_duration * 2)
+        eq_(len(held), 2)
+
+        # Finishing one message earns exactly one more.
+        held[0].ack.release()
+        simulate_reactor(sleep_duration * 2)
+        eq_(len(held), 3)
+
+        member.close()
+
+    def test_dead_member(self):
+        """ What a member that went away had in flight goes to another. """
+
+        from moksha.hub.zeromq.group import GroupMember
+        ext = self.hub.extensions[0]
+        endpoint = self.hub.config['zmq_group_endpoint']
+        dead = GroupMember(ext, ext.twisted_zmq_factory, endpoint)
+        held = []
+        dead.subscribe('slow', self.topic, lambda message: (
+            message.ack.hold(), held.append(message)))
+
+        simulate_reactor(sleep_duration)
+        sleep(sleep_duration)
+        self.hub.send_message(topic=self.topic, message='work')
+        simulate_reactor(sleep_duration * 2)
+        eq_(len(held), 1)
+
+        # It stops announcing itself, and is not heard from for a while.
+        dead.close()
+        group = ext.group_distributor.groups['slow']
+        for member in group.seen:
+            group.seen[member] -= 60
+
+        received = []
+        other = GroupMember(ext, ext.twisted_zmq_factory, endpoint)
+        other.subscribe('slow', self.topic, lambda message: received.append(
+            json.loads(message.body)))
+        simulate_reactor(sleep_duration)
+        eq_(received, [])
+
+        ext.group_distributor.expire()
+        simulate_reactor(sleep_duration * 2)
+        eq_(received, ['work'])
+        eq_(len(group.members), 1)
+        other.close()
+
+    def test_dead_member_finished_out_of_order(self):
+        """ Only what a member had not finished goes to another. """
+
+        from moksha.hub.zeromq.group import GroupMember
+        ext = self.hub.extensions[0]
+        endpoint = self.hub.config['zmq_group_endpoint']
+        dead = GroupMember(ext, ext.twisted_zmq_factory, endpoint, credit=2)
+        held = []
+        dead.subscribe('slow', self.topic, lambda message: (
+            message.ack.hold(), held.append(message)))
+
+        simulate_reactor(sleep_duration)
+        sleep(sleep_duration)
+        for body in ['first', 'second']:
+            self.hub.send_message(topic=self.topic, message=body)
+        simulate_reactor(sleep_duration * 2)
+        eq_(len(held), 2)
+
+        # The second one is done before the first, and then it dies.
+        held[1].ack.release()
+        simulate_reactor(sleep_duration * 2)
+        dead.close()
+        group = ext.group_distributor.groups['slow']
+        for member in group.seen:
+            group.seen[member] -= 60
+
+        received = []
+        other = GroupMember(ext, ext.twisted_zmq_factory, endpoint)
+        other.subscribe('slow', self.topic, lambda message: received.append(
+            json.loads(message.body)))
+        simulate_reactor(sleep_duration)
+        ext.group_distributor.expire()
+        simulate_reactor(sleep_duration * 2)
+        eq_(received, ['first'])
+        other.close()
+
+
+class TestPartitionedConsumer(unittest.TestCase):
+
+    def setUp(self):
+        config = {
+            "zmq_enabled": True,
+            "zmq_publish_endpoints": "tcp://*:6543",
+            "zmq_subscribe_endpoints": "tcp://127.0.0.1:6543",
+            "zmq_strict": True,
+            "moksha.workers_per_consumer": 4,
+        }
+        self.hub = MokshaHub(config=config)
+
+    def tearDown(self):
+        self.hub.close()
+
+    def test_same_key_same_worker(self):
+        """ Messages sharing a partition key queue up for a single worker. """
+
+        class TestConsumer(moksha.hub.api.consumer.Consumer):
+            topic = str(uuid4())
+
+            def partition_key(self, message):
+                return message['body']['key']
+
+            def consume(self, message):
+                pass
+
+        cons = TestConsumer(self.hub)
+        eq_(len(cons._queues), 4)
+
+        keys = ['key-%i' % i for i in range(20)]
+        for i in range(5):
+            for key in keys:
+                cons._consume({'body': {'key': key, 'seq': i}})
+
+        queued = dict((key, []) for key in keys)
+        for index, q in enumerate(cons._queues):
+            while not q.empty():
+                body = q.get()['body']
+                queued[body['key']].append((index, body['seq']))
+
+        for key, items in queued.items():
+            eq_(len(set(index for index, seq in items)), 1)
+            eq_([seq for index, seq in items], list(range(5)))
+
+        # ...while different keys are spread over the workers.
+        assert_true(len(set(items[0][0] for items in queued.values())) > 1)
+
+    def test_unhashable_key(self):
+        """ Messages whose key can't be used still go to a worker. """
+
+        class TestConsumer(moksha.hub.api.consumer.Consumer):
+            topic = str(uuid4())
+
+            def partition_key(self, message):
+                return message['body']['keys']
+
+            def consume(self, message):
+                pass
+
+        cons = TestConsumer(self.hub)
+        cons._consume({'body': {'keys': ['a', 'b']}})
+        eq_(sum(q.qsize() for q in cons._queues), 1)
+
+    def test_no_key_shares_queue(self):
+        """ Without a partition key, the workers share one queue. """
+
+        class TestConsumer(moksha.hub.api.consumer.Consumer):
+            topic = str(uuid4())
+
+            def consume(self, message):
+                pass
+
+        cons = TestConsumer(self.hub)
+        eq_(cons._queues, [cons.incoming])
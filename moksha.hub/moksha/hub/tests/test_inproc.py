@@ -0,0 +1,104 @@
+# This file is part of Moksha.
+# Copyright (C) 2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Test delivering messages within a hub process. """
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import mock
+from nose.tools import eq_
+
+from moksha.hub.hub import MokshaHub
+from moksha.hub.inproc import InprocHubExtension, ORIGIN
+
+
+class TestInprocExtension(unittest.TestCase):
+
+    def setUp(self):
+        self.extension = InprocHubExtension(None, {})
+        self.received = []
+
+    def test_wildcards(self):
+        self.extension.subscribe('org.test.*', self.received.append)
+        self.extension.subscribe('org.test.a', self.received.append)
+        self.extension.send_message(b'org.test.a', '{}')
+        self.extension.send_message('org.other', '{}')
+        eq_([m.topic for m in self.received], ['org.test.a', 'org.test.a'])
+
+        self.extension.unsubscribe(self.received.append)
+        self.extension.send_message('org.test.a', '{}')
+        eq_(len(self.received), 2)
+
+    def test_objects(self):
+        """ Subscribers get the very object that was published. """
+        self.extension.subscribe('org.test', self.received.append)
+        body = {'a': 1}
+        self.extension.send_objects([('org.test', body, {})])
+        assert self.received[0].body is body
+        assert self.received[0].decoded
+
+    def test_from_a_thread(self):
+        self.extension.subscribe('org.test', self.received.append)
+        with mock.patch('moksha.hub.inproc.reactor') as reactor, \
+                mock.patch('moksha.hub.reactor.reactor', reactor), \
+                mock.patch('moksha.hub.inproc.isInIOThread',
+                           return_value=False):
+            reactor.running = True
+            self.extension.send_message('org.test', '1')
+            self.extension.send_message('org.test', '2')
+            eq_(self.received, [])
+            eq_(reactor.callFromThread.call_count, 1)
+        self.extension._outgoing.drain()
+        eq_([m.body for m in self.received], ['1', '2'])
+
+    def test_failing_subscriber(self):
+        def fail(message):
+            raise ValueError()
+
+        self.extension.subscribe('org.test', fail)
+        self.extension.subscribe('org.test', self.received.append)
+        self.extension.send_message('org.test', '{}')
+        eq_(len(self.received), 1)
+
+
+class TestInprocHub(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = MokshaHub({'moksha.inproc': 'True'})
+        self.addCleanup(self.hub.close)
+        self.received = []
+        self.hub.subscribe('org.test.*', self.received.append)
+
+    def test_alone(self):
+        eq_([ext.name for ext in self.hub.extensions], ['inproc'])
+        eq_(self.hub.origin, None)
+
+        body = {'a': [1, 2]}
+        self.hub.send_message('org.test.a', body)
+        self.hub.send_message('org.test.b', '"raw"', jsonify=False)
+        self.hub.send_messages([('org.test.c', 1), ('org.test.d', 2, {})])
+        assert self.received[0].body is body
+        eq_([(m.body, m.decoded) for m in self.received[1:]],
+            [('"raw"', False), (1, True), (2, True)])
+
+    def test_echo(self):
+        self.hub.origin = 'me'
+        assert self.hub.echo({ORIGIN: 'me'})
+        assert not self.hub.echo({ORIGIN: 'someone else'})
+        assert not self.hub.echo({})
+        assert not self.hub.echo(None)
@@ -0,0 +1,200 @@
+# This file is part of Moksha.
+# Copyright (C) 2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Test the pieces shared by every messaging extension. """
+
+import json
+import threading
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import mock
+from nose.tools import eq_
+
+from moksha.common.exc import SpoolFull
+from moksha.hub.hub import MokshaHub
+from moksha.hub.messaging import Envelope, MessagingHubExtension, Outbox
+from moksha.hub.reactor import Handoff
+
+
+class FakeExtension(MessagingHubExtension):
+    def __init__(self):
+        self.sent = []
+        self.block = threading.Event()
+        self.block.set()
+
+    def send_message(self, topic, message, **headers):
+        self.block.wait()
+        if message == 'fail':
+            raise IOError("broker went away")
+        self.sent.append((topic, message, headers))
+
+
+class FullExtension(FakeExtension):
+    def send_message(self, topic, message, **headers):
+        raise SpoolFull("no room")
+
+
+class TestSendMessages(unittest.TestCase):
+
+    def test_default(self):
+        """ Extensions without a batch write send one at a time. """
+        extension = FakeExtension()
+        extension.send_messages([('a', 'one', {}), ('b', 'two', {'c': 'd'})])
+        eq_(extension.sent, [('a', 'one', {}), ('b', 'two', {'c': 'd'})])
+
+    def test_one_broker_full(self):
+        """ A broker that is full doesn't keep the message from the rest. """
+        hub = MokshaHub({'moksha.inproc': 'True'})
+        self.addCleanup(hub.close)
+        extension = FakeExtension()
+        hub.brokers = [FullExtension(), extension]
+
+        self.assertRaises(SpoolFull, hub.send_message, 'a', 'one',
+                          jsonify=False)
+        self.assertRaises(SpoolFull, hub.send_messages, [('b', 'two')],
+                          jsonify=False)
+        eq_([(topic, message) for topic, message, headers in extension.sent],
+            [(b'a', 'one'), (b'b', 'two')])
+
+
+class TestEnvelope(unittest.TestCase):
+
+    def test_lazy(self):
+        """ The body is only worked out once, when first asked for. """
+        loads = []
+
+        def load():
+            loads.append(1)
+            return {'a': 1}
+
+        envelope = Envelope.lazy(load, topic='org.test')
+        assert 'body' in envelope
+        eq_(envelope['topic'], 'org.test')
+        eq_(loads, [])
+
+        eq_(envelope['body'], {'a': 1})
+        eq_(envelope.get('body'), {'a': 1})
+        eq_(json.loads(json.dumps(envelope)),
+            {'topic': 'org.test', 'body': {'a': 1}})
+        eq_(loads, [1])
+
+    def test_plain(self):
+        envelope = Envelope(body=1)
+        eq_(envelope, {'body': 1})
+        self.assertRaises(KeyError, lambda: envelope['topic'])
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.extension = FakeExtension()
+
+    def test_send(self):
+        outbox = Outbox('fake', self.extension)
+        for i in range(3):
+            outbox.put('topic', 'message %i' % i)
+        outbox.close()
+        eq_([m[1] for m in self.extension.sent],
+            ['message 0', 'message 1', 'message 2'])
+
+    def test_headers(self):
+        """ Only extensions that can send headers are given them. """
+        outbox = Outbox('fake', self.extension)
+        outbox.put('topic', 'message', {'a': 'b'})
+        outbox.close()
+        eq_(self.extension.sent, [('topic', 'message', {})])
+
+        self.extension.carries_headers = True
+        outbox = Outbox('fake', self.extension)
+        outbox.put('topic', 'message', {'a': 'b'})
+        outbox.close()
+        eq_(self.extension.sent[-1], ('topic', 'message', {'a': 'b'}))
+
+    def test_content_type_without_headers(self):
+        """ Bodies that aren't JSON say so inline where headers can't. """
+        outbox = Outbox('fake', self.extension)
+        outbox.put('topic', b'\x81', {'content-type': 'application/msgpack'})
+        outbox.close()
+        eq_(self.extension.sent,
+            [('topic', b'\x00application/msgpack\x00\x81', {})])
+
+    def test_full(self):
+        """ A stuck extension doesn't hold up the publisher. """
+        self.extension.block.clear()
+        outbox = Outbox('fake', self.extension, size=2)
+        for i in range(5):
+            outbox.put('topic', 'message %i' % i)
+        self.extension.block.set()
+        outbox.close()
+        eq_(outbox.dropped + len(self.extension.sent), 5)
+        assert outbox.dropped >= 2
+
+    def test_stats(self):
+        outbox = Outbox('fake', self.extension)
+        outbox.put('topic', 'fail')
+        outbox.put('topic', 'message')
+        outbox.close()
+
+        stats = outbox.__json__()
+        eq_(stats['name'], 'fake')
+        eq_(stats['sent'], 1)
+        eq_(stats['errors'], 1)
+        eq_(len(stats['times']), 2)
+        eq_(outbox.__json__()['sent'], 0)
+
+
+class TestHandoff(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('moksha.hub.reactor.reactor')
+        self.reactor = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.batches = []
+        self.handoff = Handoff(self.batches.append)
+
+    def test_one_wakeup(self):
+        """ Items put before the reactor gets to them share a wakeup. """
+        threads = [threading.Thread(target=self.handoff.put, args=(i,))
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(self.reactor.callFromThread.call_count, 1)
+        eq_(self.reactor.callFromThread.call_args[0][0], self.handoff.drain)
+
+        self.handoff.drain()
+        eq_(len(self.batches), 1)
+        eq_(sorted(self.batches[0]), list(range(10)))
+
+        self.handoff.put(10)
+        eq_(self.reactor.callFromThread.call_count, 2)
+
+    def test_extend(self):
+        self.handoff.extend([])
+        eq_(self.reactor.callFromThread.call_count, 0)
+        self.handoff.extend(range(3))
+        self.handoff.put(3)
+        eq_(self.reactor.callFromThread.call_count, 1)
+        self.handoff.drain()
+        eq_(self.batches, [[0, 1, 2, 3]])
+
+    def test_empty(self):
+        self.handoff.drain()
+        eq_(self.batches, [])
@@ -0,0 +1,98 @@
+# This file is part of Moksha.
+# Copyright (C) 2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Test choosing, marking and decoding message serializers. """
+
+import json
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from nose.tools import eq_
+
+from moksha.hub import serialization
+from moksha.hub.serialization import (
+    CONTENT_TYPE, Codec, Serializers, decode, framed, inline)
+
+
+def reverse(data):
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return data[::-1]
+
+
+class TestSerializers(unittest.TestCase):
+
+    def setUp(self):
+        self.codecs = dict(serialization.codecs)
+        self.decoders = dict(serialization.decoders)
+        serialization.register(Codec(
+            'reverse', 'application/x-reverse',
+            lambda obj: json.dumps(obj)[::-1].encode('utf-8'),
+            lambda data: json.loads(reverse(data)),
+            binary=True))
+
+    def tearDown(self):
+        serialization.codecs.clear()
+        serialization.codecs.update(self.codecs)
+        serialization.decoders.clear()
+        serialization.decoders.update(self.decoders)
+
+    def test_rules(self):
+        serializers = Serializers(
+            ['/topic/a:b.*:reverse', 'org.test.*:json'], default='reverse')
+        eq_(serializers.for_topic('/topic/a:b.c').name, 'reverse')
+        eq_(serializers.for_topic(u'org.test.a').name, 'json')
+        eq_(serializers.for_topic(b'org.test.a').name, 'json')
+        eq_(serializers.for_topic('org.other').name, 'reverse')
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, Serializers, [], default='nope')
+        self.assertRaises(ValueError, Serializers, ['org.test'])
+
+    def test_headers(self):
+        body = serialization.get('reverse').encode({'a': 1})
+        eq_(decode(body, 'application/x-reverse'), {'a': 1})
+
+    def test_inline(self):
+        """ Brokers without headers get the content type in the body. """
+        headers = {CONTENT_TYPE: 'application/x-reverse'}
+        body = inline(serialization.get('reverse').encode([1]), headers)
+        assert framed(body)
+        eq_(decode(body), [1])
+
+    def test_json_is_unchanged(self):
+        """ Old hubs still understand JSON from brokers without headers. """
+        headers = {CONTENT_TYPE: 'application/json'}
+        eq_(inline('{"a": 1}', headers), '{"a": 1}')
+        assert not framed(b'{"a": 1}')
+
+    def test_old_hubs(self):
+        """ Bodies without a content type are JSON. """
+        eq_(decode('{"a": 1}'), {'a': 1})
+        eq_(decode(b'[1, 2]', None), [1, 2])
+        eq_(decode('"x"', 'application/json; charset=utf-8'), 'x')
+        eq_(decode('"x"', 'text/plain'), 'x')
+
+    def test_binary_needs_bytes(self):
+        self.assertRaises(ValueError, decode, u'1', 'application/x-reverse')
+
+    def test_installed_codecs(self):
+        """ Every registered codec round-trips its own output. """
+        message = {'a': [1, 2, {'b': u'☃'}]}
+        for name, codec in self.codecs.items():
+            eq_(decode(codec.encode(message), codec.content_type), message)
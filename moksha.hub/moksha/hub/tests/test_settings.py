@@ -0,0 +1,78 @@
+# This file is part of Moksha.
+# Copyright (C) 2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Test the typed hub settings. """
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from nose.tools import eq_, raises
+
+from moksha.hub.settings import Settings
+
+
+class TestSettings(unittest.TestCase):
+
+    def test_defaults(self):
+        """ Options missing from the config get their defaults. """
+        settings = Settings({})
+        eq_(settings.moksha_blocking_mode, False)
+        eq_(settings.moksha_workers_per_consumer, 1)
+        eq_(settings.stomp_ack_mode, 'auto')
+        eq_(settings.stomp_unescape_headers, True)
+        eq_(settings.zmq_publish_endpoints, [])
+
+    def test_conversion(self):
+        """ Strings from config files are converted to their types. """
+        settings = Settings({
+            'moksha.blocking_mode': 'True',
+            'moksha.workers_per_consumer': '4',
+            'moksha.monitoring.socket.mode': '770',
+            'stomp_delay': '0.5',
+            'stomp_send_explicit_nacks': 'no',
+            'zmq_subscribe_endpoints': 'tcp://127.0.0.1:6543, tcp://10.0.0.1:6543',
+        })
+        eq_(settings.moksha_blocking_mode, True)
+        eq_(settings.moksha_workers_per_consumer, 4)
+        eq_(settings.moksha_monitoring_socket_mode, 0o770)
+        eq_(settings.stomp_delay, 0.5)
+        eq_(settings.stomp_send_explicit_nacks, False)
+        eq_(settings.zmq_subscribe_endpoints,
+            ['tcp://127.0.0.1:6543', 'tcp://10.0.0.1:6543'])
+
+    def test_case_insensitive_choice(self):
+        """ The livesocket backend is matched as the WSGI side matches it. """
+        settings = Settings({'moksha.livesocket.backend': 'WebSocket'})
+        eq_(settings.moksha_livesocket_backend, 'websocket')
+
+    def test_native_values(self):
+        """ Values that already have the right type are left alone. """
+        settings = Settings({'zmq_strict': True, 'stomp_heartbeat': 1000})
+        eq_(settings.zmq_strict, True)
+        eq_(settings.stomp_heartbeat, 1000)
+
+    @raises(ValueError)
+    def test_invalid_bool(self):
+        Settings({'moksha.blocking_mode': 'sometimes'})
+
+    @raises(ValueError)
+    def test_invalid_int(self):
+        Settings({'moksha.workers_per_consumer': 'many'})
+
+    @raises(ValueError)
+    def test_invalid_choice(self):
+        Settings({'stomp_ack_mode': 'whenever'})
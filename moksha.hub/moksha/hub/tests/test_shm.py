@@ -0,0 +1,194 @@
+# This file is part of Moksha.
+# Copyright (C) 2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Test passing messages between hubs through shared memory. """
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import mock
+from nose.tools import eq_
+
+from moksha.hub.hub import MokshaHub
+from moksha.hub.shm import (
+    DATA, HEADER, MAGIC, POSITION, RECORD, RESERVED, VERSION, Cursor, Ring,
+    ShmHubExtension)
+
+
+def records(n, start=0):
+    return [(b'org.test', b'', ('m%i' % i).encode('ascii'))
+            for i in range(start, start + n)]
+
+
+class TestRing(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        # Room for five and a half records of 40 bytes, so they wrap around
+        # unevenly.
+        self.ring = Ring.create(self.path, 64 + 220)
+        self.addCleanup(self.ring.close)
+        self.reader = Ring.open(self.ring.filename)
+        self.addCleanup(self.reader.close)
+
+    def test_wrap_around(self):
+        cursor = Cursor(self.reader)
+        received = []
+        for i in range(0, 30, 3):
+            self.ring.write(records(3, start=i))
+            received.extend(body for _, _, body in cursor.read())
+        eq_(received, [('m%i' % i).encode('ascii') for i in range(30)])
+        eq_(cursor.lost, 0)
+
+    def test_lapped(self):
+        """ Readers that fall a ring behind skip to the newest messages. """
+        cursor = Cursor(self.reader)
+        self.ring.write(records(10))
+        eq_(cursor.read(), [])
+        assert cursor.lost
+
+        self.ring.write(records(1, start=10))
+        eq_(cursor.read(), records(1, start=10))
+
+    def test_overwritten_while_reading(self):
+        cursor = Cursor(self.reader)
+        self.ring.write(records(2))
+        POSITION.pack_into(self.ring.buf, RESERVED, 10 ** 6)
+        eq_(cursor.read(), [])
+        assert cursor.lost
+
+    def test_stores_seen_out_of_order(self):
+        """ Readers wait for records that are not all there yet. """
+        cursor = Cursor(self.reader)
+        self.ring.write(records(3))
+        stamped = self.ring.buf[DATA:DATA + 3 * 40]
+
+        # Other CPUs may see the written position before the records, or
+        # records before their contents.
+        self.ring.buf[DATA + 40:DATA + 3 * 40] = b'\0' * 2 * 40
+        eq_(cursor.read(), records(1))
+        self.ring.buf[DATA + 40:DATA + 80] = stamped[40:80]
+        self.ring.buf[DATA + 80 + RECORD.size:DATA + 3 * 40] = \
+            b'x' * (40 - RECORD.size)
+        self.ring.buf[DATA + 80:DATA + 80 + RECORD.size] = \
+            stamped[80:80 + RECORD.size]
+        eq_(cursor.read(), records(1, start=1))
+
+        self.ring.buf[DATA:DATA + 3 * 40] = stamped
+        eq_(cursor.read(), records(1, start=2))
+        eq_(cursor.lost, 0)
+
+    def test_limit(self):
+        cursor = Cursor(self.reader)
+        self.ring.write(records(5))
+        eq_(len(cursor.read(limit=2)), 2)
+        eq_(len(cursor.read()), 3)
+
+    def test_not_a_ring(self):
+        filename = os.path.join(self.path, 'junk.ring')
+        with open(filename, 'wb') as f:
+            f.write(b'x' * 100)
+        self.assertRaises(ValueError, Ring.open, filename)
+
+
+class TestShmHubs(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        patcher = mock.patch('moksha.hub.shm.reactor')
+        self.reactor = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.reactor.running = False
+
+    def hub(self, **config):
+        config['moksha.shm'] = 'True'
+        config['moksha.shm.path'] = self.path
+        hub = MokshaHub(config)
+        self.addCleanup(hub.close)
+        return hub
+
+    def shm(self, hub):
+        return [ext for ext in hub.extensions
+                if isinstance(ext, ShmHubExtension)][0]
+
+    def test_between_hubs(self):
+        sender, receiver = self.hub(), self.hub()
+        received = []
+        receiver.subscribe('org.test.*', received.append)
+        self.shm(receiver).poll()
+
+        sender.send_message('org.test.a', {'a': 1})
+        sender.send_message('org.other', {'a': 2})
+        self.shm(receiver).poll()
+        eq_([(m.topic, m.body) for m in received],
+            [('org.test.a', '{"a": 1}')])
+        eq_(received[0].headers, {'content-type': 'application/json'})
+
+    def test_echoes_are_dropped(self):
+        """ With moksha.inproc, local subscribers hear each message once. """
+        hub = self.hub(**{'moksha.inproc': 'True'})
+        received = []
+        hub.subscribe('org.test', received.append)
+        self.shm(hub).poll()
+
+        hub.send_message('org.test', {'a': 1})
+        self.shm(hub).poll()
+        eq_([m.body for m in received], [{'a': 1}])
+
+    def test_back_off(self):
+        hub = self.hub(**{'moksha.shm.poll_interval': '0.001',
+                          'moksha.shm.idle_interval': '0.004'})
+        hub.subscribe('org.test', lambda message: None)
+        ext = self.shm(hub)
+        for i in range(4):
+            ext.poll()
+        hub.send_message('org.test', {})
+        ext.poll()
+        eq_([c[0][0] for c in self.reactor.callLater.call_args_list],
+            [0, 0.001, 0.002, 0.004, 0.004, 0.001])
+
+    def test_dead_hubs_are_cleaned_up(self):
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        ring = Ring.create(self.path, 1024)
+        HEADER.pack_into(ring.buf, 0, MAGIC, VERSION, dead.pid,
+                         ring.capacity, 0, 0)
+        ring.close()
+
+        ext = self.shm(self.hub())
+        ext.scan()
+        assert not os.path.exists(ring.filename)
+        eq_(list(ext.cursors), [ext.ring.filename])
+
+    def test_too_large(self):
+        hub = self.hub(**{'moksha.shm.size': '1024'})
+        self.assertRaises(ValueError, self.shm(hub).send_message,
+                          'org.test', 'x' * 1024)
+
+    def test_close(self):
+        hub = self.hub()
+        filename = self.shm(hub).ring.filename
+        assert os.path.exists(filename)
+        hub.close()
+        assert not os.path.exists(filename)
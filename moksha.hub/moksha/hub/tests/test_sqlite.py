@@ -0,0 +1,222 @@
+# This file is part of Moksha.
+# Copyright (C) 2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Test keeping messages in an SQLite database. """
+
+import os
+import shutil
+import tempfile
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import mock
+from nose.tools import eq_
+
+from moksha.common.exc import SpoolFull
+from moksha.hub.api.consumer import Consumer
+from moksha.hub.hub import MokshaHub
+from moksha.hub.sqlite import SQLiteHubExtension, connect
+
+
+class Recorder(object):
+    """ A consumer that finishes its messages only when told to. """
+
+    def __init__(self, defer=False):
+        self.defer = defer
+        self.messages = []
+
+    def consume(self, message):
+        if self.defer:
+            message.ack.hold()
+        self.messages.append(message)
+
+    @property
+    def bodies(self):
+        return [m.body for m in self.messages]
+
+
+class RecordingConsumer(Recorder, Consumer):
+    """ A :class:`Recorder` that is a consumer, so it gets a saved cursor. """
+    topic = 'org.test'
+    jsonify = False
+
+    def __init__(self, hub, defer=False):
+        Recorder.__init__(self, defer)
+        Consumer.__init__(self, hub)
+
+
+class TestSQLite(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.filename = os.path.join(self.path, 'messages.db')
+        patcher = mock.patch('moksha.hub.sqlite.reactor')
+        self.reactor = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def hub(self, **config):
+        config['moksha.sqlite'] = self.filename
+        hub = MokshaHub(config)
+        self.addCleanup(hub.close)
+        self.ext = hub.extensions[0]
+        assert isinstance(self.ext, SQLiteHubExtension)
+        return hub
+
+    def poll(self):
+        self.ext.flush()
+        self.ext.poll()
+
+    def test_round_trip(self):
+        hub = self.hub()
+        recorder = Recorder()
+        hub.subscribe('org.test.*', recorder.consume)
+        for i in range(3):
+            hub.send_message('org.test.a', {'i': i})
+            hub.send_message('org.other', {'i': i})
+        self.poll()
+
+        eq_(recorder.bodies, ['{"i": 0}', '{"i": 1}', '{"i": 2}'])
+        eq_(recorder.messages[0].topic, 'org.test.a')
+        eq_(recorder.messages[0].headers,
+            {'content-type': 'application/json'})
+
+    def test_new_consumers_start_at_the_end(self):
+        hub = self.hub()
+        hub.send_message('org.test', 'old', jsonify=False)
+        self.ext.flush()
+
+        recorder = Recorder()
+        hub.subscribe('org.test', recorder.consume)
+        hub.send_message('org.test', 'new', jsonify=False)
+        self.poll()
+        eq_(recorder.bodies, ['new'])
+
+    def test_at_least_once(self):
+        """ Messages a consumer didn't finish are handed out again. """
+        config = {'moksha.blocking_mode': 'True'}
+        hub = self.hub(**config)
+        consumer = RecordingConsumer(hub, defer=True)
+        for body in ['a', 'b', 'c']:
+            hub.send_message('org.test', body, jsonify=False)
+        self.poll()
+        consumer.messages[0].ack.release()
+        consumer.messages[2].ack.release()
+        hub.close()
+
+        hub = self.hub(**config)
+        consumer = RecordingConsumer(hub)
+        self.poll()
+        eq_(consumer.bodies, ['b', 'c'])
+
+        hub.close()
+        hub = self.hub(**config)
+        consumer = RecordingConsumer(hub)
+        self.poll()
+        eq_(consumer.bodies, [])
+
+    def test_cursor_per_consumer(self):
+        config = {'moksha.blocking_mode': 'True'}
+        hub = self.hub(**config)
+        first, second = RecordingConsumer(hub), RecordingConsumer(hub, True)
+        hub.send_message('org.test', 'a', jsonify=False)
+        self.poll()
+        eq_((first.bodies, second.bodies), (['a'], ['a']))
+        hub.close()
+
+        hub = self.hub(**config)
+        first, second = RecordingConsumer(hub), RecordingConsumer(hub)
+        self.poll()
+        eq_((first.bodies, second.bodies), ([], ['a']))
+
+    def test_other_subscribers_are_not_saved(self):
+        """ Websocket clients and the like only see what is sent while they
+        are subscribed. """
+        hub = self.hub()
+        recorder = Recorder()
+        hub.subscribe('org.test', recorder.consume)
+        hub.send_message('org.test', 'a', jsonify=False)
+        self.poll()
+        hub.unsubscribe(recorder.consume)
+        hub.send_message('org.test', 'gap', jsonify=False)
+        self.poll()
+
+        recorder = Recorder()
+        hub.subscribe('org.test', recorder.consume)
+        hub.send_message('org.test', 'b', jsonify=False)
+        self.poll()
+        eq_(recorder.bodies, ['b'])
+        eq_(self.ext.db.execute('SELECT COUNT(*) FROM cursors').fetchone(),
+            (0,))
+
+    def test_prefetch(self):
+        hub = self.hub(**{'moksha.sqlite.prefetch': '2'})
+        recorder = Recorder(defer=True)
+        hub.subscribe('org.test', recorder.consume)
+        for body in ['a', 'b', 'c']:
+            hub.send_message('org.test', body, jsonify=False)
+        self.poll()
+        eq_(recorder.bodies, ['a', 'b'])
+
+        recorder.messages[0].ack.release()
+        self.poll()
+        eq_(recorder.bodies, ['a', 'b', 'c'])
+
+    def test_prefetch_wakes_up(self):
+        """ Finishing a message ends the back-off a full prefetch caused. """
+        patcher = mock.patch('moksha.hub.reactor.reactor', self.reactor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        hub = self.hub(**{'moksha.sqlite.prefetch': '1',
+                          'moksha.sqlite.poll_interval': '0.01',
+                          'moksha.sqlite.idle_interval': '0.5'})
+        recorder = Recorder(defer=True)
+        hub.subscribe('org.test', recorder.consume)
+        for body in ['a', 'b']:
+            hub.send_message('org.test', body, jsonify=False)
+        for i in range(4):
+            self.poll()
+        eq_(self.reactor.callLater.call_args[0][0], 0.04)
+
+        # A worker thread finishes the message.
+        recorder.messages[0].ack.release()
+        eq_(self.reactor.callFromThread.call_count, 1)
+        self.reactor.callFromThread.call_args[0][0]()
+        eq_(self.reactor.callLater.call_args[0][0], 0)
+        self.poll()
+        eq_(recorder.bodies, ['a', 'b'])
+
+    def test_backlog(self):
+        hub = self.hub(**{'moksha.sqlite.backlog': '2'})
+        self.ext.check_backlog(2)
+        self.assertRaises(SpoolFull, self.ext.check_backlog, 3)
+
+    def test_compact(self):
+        self.hub(**{'moksha.sqlite.max_messages': '2'})
+        self.ext.send_messages([('org.test', str(i), {}) for i in range(5)])
+        self.ext.flush()
+
+        db = connect(self.filename)
+        self.addCleanup(db.close)
+        self.ext.compact(db)
+        eq_(db.execute('SELECT body FROM messages').fetchall(),
+            [(b'3',), (b'4',)])
+
+        self.ext.settings.moksha_sqlite_retention = -1
+        self.ext.compact(db)
+        eq_(db.execute('SELECT COUNT(*) FROM messages').fetchone(), (0,))
@@ -0,0 +1,703 @@
+# This file is part of Moksha.
+# Copyright (C) 2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Test the STOMP protocol without a broker. """
+
+import functools
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import mock
+from nose.tools import eq_
+from twisted.test.proto_helpers import StringTransport
+
+from moksha.common.exc import SpoolFull
+from moksha.hub import serialization
+from moksha.hub.settings import Settings
+from moksha.hub.stomp.frame import FrameParser, SendEncoder
+from moksha.hub.stomp.multi import MultiStompHubExtension
+from moksha.hub.stomp.protocol import StompProtocol
+from moksha.hub.stomp.spool import Spool
+from moksha.hub.stomp.stomp import StompHubExtension
+
+
+def message(message_id, subscription='sub-0', body='{}'):
+    return ('MESSAGE\ndestination:/topic/foo\nmessage-id:%s\n'
+            'subscription:%s\n\n%s\x00\n' % (message_id, subscription, body))
+
+
+class FakeHub(object):
+    def __init__(self, config):
+        self.settings = Settings(config)
+        self.topics = {}
+        self.consumed = []
+        self.results = {}
+        self.held = {}
+
+    def consume_stomp_message(self, msg, ack=None):
+        message_id = msg['headers']['message-id']
+        self.consumed.append(message_id)
+        if message_id in self.held:
+            # Like a consumer that queues the message for a worker.
+            ack.hold()
+            self.held[message_id] = ack
+            return None
+        return self.results.get(message_id, True)
+
+
+class FakeClient(object):
+    proto = None
+
+    def __init__(self, config):
+        self.hub = FakeHub(config)
+
+
+class CountingTransport(StringTransport):
+    def __init__(self):
+        StringTransport.__init__(self)
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        StringTransport.write(self, data)
+
+    def writeSequence(self, data):
+        self.writes += 1
+        StringTransport.write(self, b''.join(data))
+
+
+class TestStompProtocol(unittest.TestCase):
+
+    def protocol(self, **config):
+        client = FakeClient(config)
+        proto = client.proto = StompProtocol(client)
+        proto.transport = CountingTransport()
+        return proto
+
+    def frames(self, proto):
+        return [frame.strip() for frame in
+                proto.transport.value().decode('utf-8').split('\x00')
+                if frame.strip()]
+
+    def test_every_frame_in_a_read(self):
+        """ Frames behind one that needs no reply are not left waiting. """
+        proto = self.protocol()
+        proto.dataReceived((message('1') + message('2')).encode('utf-8'))
+        eq_(proto.client.hub.consumed, ['1', '2'])
+        eq_(proto.transport.writes, 0)
+
+    def test_one_write_per_read(self):
+        """ All of the ACKs for a read go out in a single write. """
+        proto = self.protocol(stomp_ack_mode='client-individual')
+        data = ''.join(message(str(i)) for i in range(5))
+        proto.dataReceived(data.encode('utf-8'))
+        eq_(proto.client.hub.consumed, ['0', '1', '2', '3', '4'])
+        eq_(proto.transport.writes, 1)
+        frames = self.frames(proto)
+        eq_(len(frames), 5)
+        eq_([f.split('\n')[0] for f in frames], ['ACK'] * 5)
+
+    def test_nack_in_a_batch(self):
+        proto = self.protocol(stomp_ack_mode='client-individual')
+        proto.client.hub.results['1'] = False
+        data = ''.join(message(str(i)) for i in range(3))
+        proto.dataReceived(data.encode('utf-8'))
+        eq_([f.split('\n')[0] for f in self.frames(proto)],
+            ['ACK', 'NACK', 'ACK'])
+
+    def test_cumulative_ack(self):
+        """ Runs of ACKs on one subscription collapse into the last one. """
+        proto = self.protocol(stomp_ack_mode='client',
+                              stomp_cumulative_ack='true')
+        proto.client.hub.results['2'] = False
+        data = (message('0') + message('1') + message('2') +
+                message('3') + message('4', subscription='sub-1') +
+                message('5'))
+        proto.dataReceived(data.encode('utf-8'))
+        frames = self.frames(proto)
+        eq_([f.split('\n')[0] for f in frames],
+            ['ACK', 'NACK', 'ACK', 'ACK', 'ACK'])
+        ids = [line.split(':')[1] for f in frames
+               for line in f.split('\n') if line.startswith('message-id:')]
+        eq_(ids, ['1', '2', '3', '4', '5'])
+
+    def test_deferred_ack(self):
+        """ Messages are only acked once their workers are done. """
+        proto = self.protocol(stomp_ack_mode='client-individual')
+        proto.client.hub.held = {'1': None, '2': None}
+        data = ''.join(message(str(i)) for i in range(3))
+        with mock.patch('moksha.hub.reactor.reactor') as reactor:
+            proto.dataReceived(data.encode('utf-8'))
+            eq_(self.frames(proto), [
+                'ACK\nsubscription:sub-0\nmessage-id:0'])
+
+            # Workers finish on their own threads, out of order.
+            for message_id, handled in (('2', False), ('1', True)):
+                worker = threading.Thread(
+                    target=proto.client.hub.held[message_id].release,
+                    args=(handled,))
+                worker.start()
+                worker.join()
+            eq_(reactor.callFromThread.call_count, 1)
+
+        proto.flush_acks()
+        eq_(proto.transport.writes, 2)
+        eq_([f.split('\n')[0] for f in self.frames(proto)],
+            ['ACK', 'NACK', 'ACK'])
+
+    def test_prefetch(self):
+        proto = self.protocol(stomp_ack_mode='client-individual',
+                              stomp_prefetch='10')
+        proto.subscribe('/topic/foo')
+        self.assertTrue(b'activemq.prefetchSize:10\n' in
+                        proto.transport.value())
+
+        proto = self.protocol(stomp_ack_mode='client',
+                              stomp_prefetch='10',
+                              stomp_prefetch_header='prefetch-count')
+        proto.subscribe('/topic/foo')
+        self.assertTrue(b'prefetch-count:10\n' in proto.transport.value())
+
+    def test_cumulative_ack_needs_client_mode(self):
+        """ client-individual ACKs are never collapsed. """
+        proto = self.protocol(stomp_ack_mode='client-individual',
+                              stomp_cumulative_ack='true')
+        data = ''.join(message(str(i)) for i in range(3))
+        proto.dataReceived(data.encode('utf-8'))
+        eq_(len(self.frames(proto)), 3)
+
+
+class TestFrameParser(unittest.TestCase):
+
+    def feed_bytewise(self, parser, data):
+        frames = []
+        for i in range(len(data)):
+            frames.extend(parser.feed(data[i:i + 1]))
+        return frames
+
+    def test_split_multibyte_character(self):
+        """ A character split over two reads is decoded whole. """
+        parser = FrameParser()
+        data = message('1', body='{"name": "\u00e9t\u00e9"}').encode('utf-8')
+        frames = self.feed_bytewise(parser, data)
+        eq_(len(frames), 1)
+        eq_(frames[0]['body'], u'{"name": "\u00e9t\u00e9"}')
+        eq_(frames[0]['headers']['message-id'], '1')
+
+    def test_content_length(self):
+        """ Bodies with a content-length may contain NUL bytes. """
+        parser = FrameParser()
+        data = (b'MESSAGE\ndestination:/topic/foo\ncontent-length:3\n\n'
+                b'a\x00b\x00\n' + message('2').encode('utf-8'))
+        frames = parser.feed(data)
+        eq_(len(frames), 2)
+        eq_(frames[0].raw_body, b'a\x00b')
+        eq_(frames[1]['headers']['message-id'], '2')
+
+    def test_crlf_and_heartbeats(self):
+        parser = FrameParser()
+        data = b'\n\r\nMESSAGE\r\nmessage-id:7\r\n\r\nhi\x00\r\n\n'
+        frames = self.feed_bytewise(parser, data)
+        eq_([(f.cmd, f.headers, f.body) for f in frames],
+            [('MESSAGE', {'message-id': '7'}, 'hi')])
+        eq_(parser.heartbeats, 4)
+        eq_(len(parser.buffer), 0)
+
+    def test_unescape_single_pass(self):
+        """ An escaped backslash followed by 'n' is not a newline. """
+        parser = FrameParser()
+        frames = parser.feed(
+            b'MESSAGE\ndestination:/topic/a\\cb\nx:one\\\\ntwo\n\n\x00')
+        eq_(frames[0].headers['destination'], '/topic/a:b')
+        eq_(frames[0].headers['x'], 'one\\ntwo')
+
+    def test_no_unescape(self):
+        parser = FrameParser(unescape_headers=False)
+        frames = parser.feed(b'MESSAGE\ndestination:/topic/a\\cb\n\n\x00')
+        eq_(frames[0].headers['destination'], '/topic/a\\cb')
+
+    def test_first_repeated_header_wins(self):
+        parser = FrameParser()
+        frames = parser.feed(b'MESSAGE\nfoo:1\nfoo:2\n\n\x00')
+        eq_(frames[0].headers['foo'], '1')
+
+
+class TestSendEncoder(unittest.TestCase):
+
+    def test_round_trip(self):
+        """ Encoded frames parse back into the same message. """
+        encoder = SendEncoder()
+        data = encoder.encode(u'/topic/caf\u00e9', u'{"a": "\u00e9\u0000"}')
+        frame, = FrameParser().feed(data)
+        eq_(frame.cmd, 'SEND')
+        eq_(frame.headers['destination'], u'/topic/caf\u00e9')
+        eq_(frame.headers['content-type'], 'text/plain')
+        eq_(frame.headers['content-length'], str(len(frame.raw_body)))
+        eq_(frame.body, u'{"a": "\u00e9\u0000"}')
+
+    def test_content_type(self):
+        """ Bodies in other formats keep their own content type. """
+        codec = serialization.Codec(
+            'reverse', 'application/x-reverse',
+            lambda obj: json.dumps(obj)[::-1].encode('utf-8'),
+            lambda data: json.loads(data.decode('utf-8')[::-1]),
+            binary=True)
+        with mock.patch.dict(serialization.decoders,
+                             {codec.content_type: codec}):
+            data = SendEncoder().encode(
+                '/topic/a', codec.encode({'a': 1}),
+                {'content-type': codec.content_type})
+            frame, = FrameParser().feed(data)
+            eq_(data.count(b'content-type:'), 1)
+            eq_(frame.headers['content-type'], 'application/x-reverse')
+            eq_(serialization.decode(frame.raw_body,
+                                     frame.headers['content-type']),
+                {'a': 1})
+
+    def test_prefix_is_cached(self):
+        encoder = SendEncoder()
+        encoder.encode('/topic/a', 'one')
+        prefix = encoder.prefix('/topic/a')
+        encoder.encode('/topic/a', 'two')
+        self.assertTrue(encoder.prefix('/topic/a') is prefix)
+
+    def test_escaping(self):
+        encoder = SendEncoder()
+        data = encoder.encode('/topic/a:b', 'x', {'note': 'one\ntwo'})
+        self.assertTrue(b'destination:/topic/a\\cb\n' in data)
+        self.assertTrue(b'note:one\\ntwo\n' in data)
+        frame, = FrameParser().feed(data)
+        eq_(frame.headers['destination'], '/topic/a:b')
+
+        data = SendEncoder(escape_headers=False).encode('/topic/a:b', 'x')
+        self.assertTrue(b'destination:/topic/a:b\n' in data)
+
+
+class TestStompSend(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('moksha.hub.stomp.stomp.reactor')
+        self.reactor = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('moksha.hub.reactor.reactor', self.reactor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        hub = FakeHub({'stomp_uri': 'localhost:61613'})
+        self.extension = StompHubExtension(hub, {})
+
+    def test_one_write_per_tick(self):
+        """ Publishes in the same reactor iteration share a write. """
+        self.extension.buildProtocol(None)
+        self.extension.proto.transport = CountingTransport()
+        for i in range(3):
+            self.extension.send_message('/topic/foo', '{"i": %i}' % i)
+        eq_(self.reactor.callFromThread.call_count, 1)
+        eq_(self.extension.proto.transport.writes, 0)
+
+        self.extension.flush()
+        eq_(self.extension.proto.transport.writes, 1)
+        frames = FrameParser().feed(self.extension.proto.transport.value())
+        eq_([f.body for f in frames], ['{"i": 0}', '{"i": 1}', '{"i": 2}'])
+
+        self.extension.send_message('/topic/foo', '{}')
+        eq_(self.reactor.callFromThread.call_count, 2)
+
+    def test_batch_is_one_write(self):
+        self.extension.buildProtocol(None)
+        self.extension.proto.transport = CountingTransport()
+        self.extension.send_messages([
+            ('/topic/foo', '{"i": %i}' % i, {'i': str(i)}) for i in range(3)])
+        eq_(self.reactor.callFromThread.call_count, 1)
+
+        self.extension.flush()
+        eq_(self.extension.proto.transport.writes, 1)
+        frames = FrameParser().feed(self.extension.proto.transport.value())
+        eq_([f.headers['i'] for f in frames], ['0', '1', '2'])
+
+    def test_spooled_until_connected(self):
+        self.extension.send_message('/topic/foo', '{}')
+        self.extension.flush()
+        eq_(len(self.extension.spool), 1)
+
+        self.extension.buildProtocol(None)
+        self.extension.proto.transport = CountingTransport()
+        self.extension.replay(10)
+        frames = FrameParser().feed(self.extension.proto.transport.value())
+        eq_([f.cmd for f in frames], ['SEND'])
+        eq_(len(self.extension.spool), 0)
+
+    def test_spool_full(self):
+        """ Producers are told to back off once the spool is full. """
+        self.extension.spool.size = 2
+        for i in range(2):
+            self.extension.send_message('/topic/foo', '{}')
+            self.extension.flush()
+        self.assertRaises(SpoolFull, self.extension.send_message,
+                          '/topic/foo', '{}')
+
+    def test_replay_in_order(self):
+        """ New publishes wait behind frames still being replayed. """
+        for i in range(5):
+            self.extension.send_message('/topic/foo', '{"i": %i}' % i)
+        self.extension.flush()
+
+        self.extension.buildProtocol(None)
+        self.extension.proto.transport = CountingTransport()
+        self.extension.replay(2)
+        self.extension.send_message('/topic/foo', '{"i": 5}')
+        self.extension.flush()
+        self.extension.replay(10)
+        frames = FrameParser().feed(self.extension.proto.transport.value())
+        eq_([f.body for f in frames], ['{"i": %i}' % i for i in range(6)])
+
+
+class TestStompConnect(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('moksha.hub.stomp.stomp.reactor')
+        self.reactor = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('moksha.hub.reactor.reactor', self.reactor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def extension(self, **config):
+        hub = FakeHub(dict(config, stomp_uri='a:1,b:2,c:3'))
+        return StompHubExtension(hub, {})
+
+    def hosts(self):
+        return [c[0][0] for c in self.reactor.connectTCP.call_args_list]
+
+    def test_happy_eyeballs(self):
+        extension = self.extension()
+        eq_(self.hosts(), ['a'])
+        eq_(self.reactor.callLater.call_args[0],
+            (0.25, extension.connect_next))
+
+        # The stagger timer fires; b is tried alongside a.
+        extension.connect_next()
+        eq_(self.hosts(), ['a', 'b'])
+
+        # a fails, so c is tried without waiting.
+        first, second = extension._attempts
+        first.clientConnectionFailed(first.connector, 'refused')
+        eq_(self.hosts(), ['a', 'b', 'c'])
+
+        # b wins; c is abandoned.
+        third = extension._attempts[-1]
+        proto = second.buildProtocol(None)
+        self.assertTrue(proto is extension.proto)
+        eq_(extension.address_index, 1)
+        eq_(third.connector.stopConnecting.call_count, 1)
+
+        # If c connects anyway, it is turned away.
+        self.assertTrue(third.buildProtocol(None) is None)
+        third.clientConnectionLost(third.connector, 'closed')
+        self.assertTrue(extension.proto is proto)
+
+    def test_abandoned_attempts_fail_quietly(self):
+        """ Stopping the losers reports them failed; nothing more is tried.
+        """
+        self.reactor.connectTCP.side_effect = lambda *args: mock.Mock()
+        extension = self.extension()
+        extension.connect_next()
+        eq_(self.hosts(), ['a', 'b'])
+        for attempt in extension._attempts:
+            attempt.connector.stopConnecting.side_effect = \
+                functools.partial(attempt.clientConnectionFailed,
+                                  attempt.connector, 'stopped')
+
+        first, second = extension._attempts
+        proto = second.buildProtocol(None)
+        self.assertTrue(proto is extension.proto)
+        # c is never tried.
+        eq_(self.hosts(), ['a', 'b'])
+        eq_(first.connector.stopConnecting.call_count, 1)
+        eq_(extension._attempts, [second])
+
+    def test_close_stops_timers(self):
+        self.reactor.callLater.side_effect = lambda *args: mock.Mock()
+        extension = self.extension(stomp_heartbeat='1000')
+        stagger = extension._stagger
+        extension.buildProtocol(None)
+        extension.start_heartbeat(1000)
+        heartbeat = extension._heartbeat
+        extension.clientConnectionLost(None, 'gone')
+        reconnect = extension._reconnect
+        extension.close()
+
+        for call in (stagger, heartbeat, reconnect):
+            eq_(call.cancel.call_count, 1)
+        extension.clientConnectionFailed(None, 'gone')
+        self.assertTrue(extension._reconnect is None)
+
+    def test_all_attempts_fail(self):
+        extension = self.extension(stomp_connect_stagger='0')
+        for i in range(3):
+            attempt = extension._attempts[-1]
+            attempt.clientConnectionFailed(attempt.connector, 'refused')
+        eq_(self.hosts(), ['a', 'b', 'c'])
+        # Only now do we back off, and start over from b.
+        eq_(self.reactor.callLater.call_args[0][1],
+            extension.start_connecting)
+        eq_(extension.address_index, 1)
+
+    def test_ssl_context_is_reused(self):
+        extension = self.extension()
+        extension.ssl_context = context = object()
+        extension.start_connecting()
+        eq_(self.reactor.connectSSL.call_args[0][3].options, context)
+
+    def test_tls_session_is_resumed(self):
+        """ Reconnecting to a broker resumes the last TLS session with it. """
+        extension = self.extension()
+        extension.ssl_context = object()
+        extension.start_connecting()
+        eq_(self.reactor.connectSSL.call_args[0][3].sessions.get(('a', '1')),
+            None)
+
+        extension.buildProtocol(None)
+        extension.proto.transport = transport = mock.Mock()
+        transport.getHandle.return_value.get_session.return_value = 'session'
+        extension.connected(0)
+        eq_(extension.tls_sessions, {('a', '1'): 'session'})
+
+        extension.proto = None
+        extension.start_connecting()
+        creator = self.reactor.connectSSL.call_args[0][3]
+        eq_(creator.address, ('a', '1'))
+        eq_(creator.sessions.get(creator.address), 'session')
+
+    def test_heartbeat_watchdog(self):
+        extension = self.extension(stomp_heartbeat='1000')
+        extension.buildProtocol(None)
+        extension.proto.transport = transport = CountingTransport()
+
+        extension.check_heartbeat(2.0)
+        self.assertFalse(transport.disconnecting)
+
+        extension.proto.last_received -= 3
+        extension.check_heartbeat(2.0)
+        self.assertTrue(transport.disconnecting)
+
+    def test_heartbeat_negotiation(self):
+        proto = StompProtocol(FakeClient({'stomp_heartbeat': '1000'}))
+        proto.client.client_heartbeat = 1000
+        proto.client.addresses = [('localhost', '61613')]
+        proto.client.address_index = 0
+        proto.makeConnection(CountingTransport())
+        self.assertTrue(b'heart-beat:1000,1000' in proto.transport.value())
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_memory_only(self):
+        spool = Spool(size=2)
+        spool.extend([b'a', b'b'])
+        self.assertTrue(spool.full)
+        eq_(spool.pop(10), [b'a', b'b'])
+        self.assertFalse(spool.full)
+
+    def test_overflow_to_disk(self):
+        spool = Spool(size=2, path=self.path)
+        spool.extend([b'a', b'b', b'c', b'd'])
+        eq_(len(spool.memory), 2)
+        eq_(spool.on_disk, 2)
+        self.assertFalse(spool.full)
+        eq_(spool.pop(3), [b'a', b'b', b'c'])
+        # Once something is on disk, newer frames queue up behind it.
+        spool.append(b'e')
+        eq_(spool.pop(10), [b'd', b'e'])
+        eq_(os.path.getsize(self.path), 8)
+        spool.close()
+
+    def test_max_bytes(self):
+        spool = Spool(size=1, path=self.path, max_bytes=10)
+        spool.extend([b'a', b'bbbbbbbb'])
+        self.assertTrue(spool.full)
+        spool.close()
+
+    def test_no_disk_spool(self):
+        spool = Spool(size=1, path=self.path, max_bytes=0)
+        spool.append(b'a')
+        self.assertTrue(spool.full)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_compaction(self):
+        """ Popped records don't stay in the file for long. """
+        spool = Spool(size=0, path=self.path)
+        spool.extend([b'%02i' % i for i in range(10)])
+        eq_(os.path.getsize(self.path), 8 + 10 * 6)
+        eq_(spool.pop(4), [b'%02i' % i for i in range(4)])
+        eq_(os.path.getsize(self.path), 8 + 10 * 6)
+        eq_(spool.pop(2), [b'04', b'05'])
+        eq_(os.path.getsize(self.path), 8 + 4 * 6)
+        spool.append(b'10')
+        eq_(spool.pop(10), [b'%02i' % i for i in range(6, 11)])
+        spool.close()
+
+    def test_max_bytes_compacts(self):
+        """ Popped records make room for new ones under max_bytes. """
+        spool = Spool(size=0, path=self.path, max_bytes=3 * 6)
+        spool.extend([b'00', b'01', b'02'])
+        self.assertTrue(spool.full)
+        eq_(spool.pop(1), [b'00'])
+        spool.append(b'03')
+        eq_(os.path.getsize(self.path), 8 + 3 * 6)
+        eq_(spool.pop(10), [b'01', b'02', b'03'])
+        spool.close()
+
+    def test_replay_survives_restart(self):
+        """ Frames popped before a crash are not sent again. """
+        spool = Spool(size=1, path=self.path)
+        spool.extend([b'a', b'b', b'c', b'd', b'e'])
+        eq_(spool.pop(2), [b'a', b'b'])
+        spool.close()
+
+        spool = Spool(size=1, path=self.path)
+        eq_(len(spool), 3)
+        eq_(spool.pop(10), [b'c', b'd', b'e'])
+        spool.close()
+
+    def test_survives_restart(self):
+        spool = Spool(size=1, path=self.path)
+        spool.extend([b'a', b'b', b'c'])
+        spool.close()
+
+        # Simulate a crash in the middle of writing a record.
+        with open(self.path, 'ab') as f:
+            f.write(b'\x00\x00\x00\x09abc')
+
+        spool = Spool(size=1, path=self.path)
+        eq_(len(spool), 2)
+        eq_(spool.pop(10), [b'b', b'c'])
+        spool.close()
+
+
+class TestMultiStomp(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('moksha.hub.stomp.stomp.reactor')
+        self.reactor = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('moksha.hub.reactor.reactor', self.reactor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.hub = FakeHub({
+            'stomp_uri': 'broker-a:61613,broker-b:61613',
+            'stomp_connections': '3',
+        })
+        self.hub.topics = {'/topic/one': [], '/topic/two': []}
+        self.extension = MultiStompHubExtension(self.hub, {})
+
+    def connect(self, connection):
+        connection.buildProtocol(None)
+        connection.proto.transport = CountingTransport()
+        connection.connected(0)
+
+    def sent(self, connection):
+        return FrameParser().feed(connection.proto.transport.value())
+
+    def test_connections(self):
+        eq_(len(self.extension.connections), 3)
+        hosts = [c[0][0] for c in self.reactor.connectTCP.call_args_list]
+        eq_(hosts, ['broker-a', 'broker-b', 'broker-a'])
+        eq_(self.extension.connections[1].addresses,
+            [['broker-b', '61613'], ['broker-a', '61613']])
+
+    def test_subscriptions_are_sharded(self):
+        self.extension.subscribe('/topic/three', None)
+        owners = self.extension.owners
+        eq_(sorted(c.index for c in owners.values()), [0, 1, 2])
+
+        for connection in self.extension.connections:
+            self.connect(connection)
+            eq_([f.headers['destination'] for f in self.sent(connection)],
+                connection._topics)
+            eq_(len(connection._topics), 1)
+
+    def test_publishes_round_robin(self):
+        for connection in self.extension.connections:
+            self.connect(connection)
+        for i in range(6):
+            self.extension.send_message('/topic/foo', '{"i": %i}' % i)
+        for connection in self.extension.connections:
+            connection.flush()
+
+        for i, connection in enumerate(self.extension.connections):
+            bodies = [f.body for f in self.sent(connection) if f.cmd == 'SEND']
+            eq_(bodies, ['{"i": %i}' % i, '{"i": %i}' % (i + 3)])
+
+    def test_batch_stays_together(self):
+        for connection in self.extension.connections:
+            self.connect(connection)
+        self.extension.send_messages([
+            ('/topic/foo', '{"i": %i}' % i, {}) for i in range(3)])
+        for connection in self.extension.connections:
+            connection.flush()
+
+        sent = [[f.body for f in self.sent(c) if f.cmd == 'SEND']
+                for c in self.extension.connections]
+        eq_(sent, [['{"i": 0}', '{"i": 1}', '{"i": 2}'], [], []])
+
+    def test_failover_is_immediate(self):
+        first, second, third = self.extension.connections
+        for connection in self.extension.connections:
+            self.connect(connection)
+        topic = first._topics[0]
+        first.spool.append(b'SEND\ndestination:/topic/foo\n\n{}\x00')
+
+        first.clientConnectionLost(None, None)
+        self.assertFalse(first.live)
+        self.assertTrue(self.extension.owners[topic] in (second, third))
+        eq_(first._topics, [])
+        eq_(len(first.spool), 0)
+
+        frames = self.sent(second) + self.sent(third)
+        eq_(len([f for f in frames if f.cmd == 'SUBSCRIBE' and
+                 f.headers['destination'] == topic]), 1)
+        eq_(len([f for f in frames if f.cmd == 'SEND']), 1)
+
+        # Nothing is published on the lost connection any more.
+        for i in range(4):
+            self.extension.send_message('/topic/foo', '{}')
+        eq_(len(first._outgoing), 0)
+
+    def test_everything_down(self):
+        """ Topics stay put until some connection comes back. """
+        first, second, third = self.extension.connections
+        for connection in self.extension.connections:
+            self.connect(connection)
+        for connection in self.extension.connections:
+            connection.clientConnectionLost(None, None)
+
+        self.connect(third)
+        eq_(set(self.extension.owners.values()), set([third]))
+        eq_(sorted(third._topics), ['/topic/one', '/topic/two'])
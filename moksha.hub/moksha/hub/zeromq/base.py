@@ -23,6 +23,7 @@ class BaseZMQHubExtension(MessagingHubExtension):
     This allows us to bounce between different zeromq modules without too much
     pain and suffering.
     """
+    name = 'zmq'
 
     def __init__(self):
         super(BaseZMQHubExtension, self).__init__()
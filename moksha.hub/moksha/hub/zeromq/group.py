@@ -0,0 +1,290 @@
+# This file is part of Moksha.
+# Copyright (C) 2008-2014  Red Hat, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Consumer groups over zeromq.
+
+With plain pub/sub every hub that runs a consumer receives every message on
+that consumer's topics.  Consumers that declare a ``group`` instead join a
+:class:`GroupDistributor` over a DEALER socket.  The distributor subscribes to
+the group's topics on behalf of all of its members and hands each message to
+exactly one member that still has credit.  Members give a credit back once
+their consumer is done with a message, so no member ever has more than
+``zmq_group_credit`` messages in flight.
+
+The wire protocol is a handful of multipart messages::
+
+    member -> distributor:  JOIN  <group> <topic> <credit>
+                            READY <group> <credit> <sequence>...
+    distributor -> member:  MSG   <group> <topic subscribed> <topic> <body>
+                                  <sequence>
+
+Every message handed out has a sequence number, and ``READY`` lists those of
+the messages that were finished, in whatever order they finished.
+
+``JOIN`` is idempotent and is re-sent periodically, so a distributor that
+restarts (or a hub that takes the role over) learns about its members again.
+A member that has not been heard from for three of those periods is taken to
+be gone: it is dropped from its groups, and the messages it had in flight are
+handed to the other members again.
+"""
+
+import collections
+import functools
+import logging
+import time
+
+import six
+import txzmq
+
+from twisted.internet.task import LoopingCall
+
+from moksha.hub.messaging import Acknowledgement
+from moksha.hub.reactor import Handoff
+from moksha.hub.serialization import framed
+
+log = logging.getLogger('moksha.hub')
+
+JOIN, READY, MESSAGE = b'JOIN', b'READY', b'MSG'
+
+
+def _bytes(value):
+    if isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
+
+
+def _text(value):
+    if isinstance(value, six.binary_type):
+        return value.decode('utf-8')
+    return value
+
+
+class _Group(object):
+    def __init__(self, backlog):
+        self.topics = set()
+        self.members = collections.deque()
+        self.credits = {}
+        # When each member was last heard from, and what it has in flight.
+        self.seen = {}
+        self.in_flight = {}
+        self.backlog = collections.deque(maxlen=backlog)
+
+    def add_member(self, member, credit):
+        self.seen[member] = time.time()
+        if member not in self.credits:
+            self.members.append(member)
+            self.credits[member] = credit
+            self.in_flight[member] = collections.OrderedDict()
+            return True
+        return False
+
+    def remove_member(self, member):
+        """ Drop `member`, and put what it had in flight back in front of
+        the backlog. """
+        self.members.remove(member)
+        del self.credits[member], self.seen[member]
+        in_flight = self.in_flight.pop(member)
+        self.backlog.extendleft(reversed(list(in_flight.values())))
+        return len(in_flight)
+
+    def next_member(self):
+        """ Round-robin over the members that still have credit. """
+        for i in range(len(self.members)):
+            member = self.members[0]
+            self.members.rotate(-1)
+            if self.credits[member] > 0:
+                return member
+        return None
+
+
+class GroupDistributor(object):
+    """ Load-balances the messages of every consumer group over a ROUTER. """
+
+    def __init__(self, extension, factory, endpoint, backlog=1000,
+                 heartbeat=5):
+        self.extension = extension
+        self.backlog = backlog
+        self.groups = {}
+        self.timeout = heartbeat * 3
+        self._sequence = 0
+
+        self.connection = txzmq.ZmqRouterConnection(
+            factory, txzmq.ZmqEndpoint('bind', endpoint))
+        self.connection.gotMessage = self.gotMessage
+        log.info("Distributing consumer groups on '%s'" % endpoint)
+
+        self.reaper = None
+        if heartbeat:
+            self.reaper = LoopingCall(self.expire)
+            self.reaper.start(heartbeat, now=False)
+
+    def _group(self, name):
+        if name not in self.groups:
+            self.groups[name] = _Group(self.backlog)
+        return self.groups[name]
+
+    def gotMessage(self, member, command, *args):
+        if command == JOIN:
+            name, topic, credit = args
+            self.join(member, _text(name), _text(topic), int(credit))
+        elif command == READY:
+            name, credit = args[:2]
+            self.ready(member, _text(name), int(credit),
+                       [int(sequence) for sequence in args[2:]])
+        else:
+            log.warning("Unknown consumer group command %r" % command)
+
+    def join(self, member, name, topic, credit):
+        group = self._group(name)
+        if group.add_member(member, credit):
+            log.info("%r joined consumer group %r" % (member, name))
+        if topic not in group.topics:
+            group.topics.add(topic)
+            self.extension.subscribe(
+                topic, functools.partial(self.distribute, name, topic))
+        self.drain(group, name)
+
+    def ready(self, member, name, credit, sequences):
+        group = self._group(name)
+        if not group.add_member(member, credit):
+            group.credits[member] += credit
+            in_flight = group.in_flight[member]
+            for sequence in sequences:
+                in_flight.pop(sequence, None)
+        self.drain(group, name)
+
+    def expire(self):
+        """ Drop the members that stopped announcing themselves, so that
+        the work they were due goes to the others instead. """
+        cutoff = time.time() - self.timeout
+        for name, group in self.groups.items():
+            for member in [member for member, seen in group.seen.items()
+                           if seen < cutoff]:
+                lost = group.remove_member(member)
+                log.warning("%r left consumer group %r with %i messages "
+                            "in flight" % (member, name, lost))
+            self.drain(group, name)
+
+    def distribute(self, name, subscription, message):
+        group = self.groups[name]
+        if len(group.backlog) == group.backlog.maxlen:
+            log.warning("Consumer group %r backlog is full.  "
+                        "Dropping the oldest message." % name)
+        group.backlog.append((subscription, message))
+        self.drain(group, name)
+
+    def drain(self, group, name):
+        while group.backlog:
+            member = group.next_member()
+            if member is None:
+                return
+            subscription, message = group.backlog.popleft()
+            group.credits[member] -= 1
+            self._sequence += 1
+            group.in_flight[member][self._sequence] = (subscription, message)
+            self.connection.sendMultipart(member, [
+                MESSAGE, _bytes(name), _bytes(subscription),
+                _bytes(message.topic), _bytes(message.body),
+                _bytes(str(self._sequence)),
+            ])
+
+    def close(self):
+        if self.reaper and self.reaper.running:
+            self.reaper.stop()
+        self.connection.shutdown()
+
+
+class GroupMember(object):
+    """ Receives this hub's share of the messages for its consumer groups. """
+
+    def __init__(self, extension, factory, endpoint, credit=1, heartbeat=5):
+        self.extension = extension
+        self.credit = credit
+        self.callbacks = collections.defaultdict(list)
+        self.available = {}
+        # Consumers finish their work on worker threads, but the socket
+        # belongs to the reactor.
+        self._done = Handoff(self.ready)
+
+        self.connection = txzmq.ZmqDealerConnection(
+            factory, txzmq.ZmqEndpoint('connect', endpoint))
+        self.connection.gotMessage = self.gotMessage
+
+        self.announcer = None
+        if heartbeat:
+            self.announcer = LoopingCall(self.announce)
+            self.announcer.start(heartbeat, now=False)
+
+    def subscribe(self, group, topic, callback):
+        if group not in self.available:
+            self.available[group] = self.credit
+        first = not self.callbacks[(group, topic)]
+        self.callbacks[(group, topic)].append(callback)
+        if first:
+            log.info("Joining consumer group %r for %r" % (group, topic))
+            self.join(group, topic)
+
+    def join(self, group, topic):
+        self.connection.sendMultipart([
+            JOIN, _bytes(group), _bytes(topic),
+            _bytes(str(self.available[group])),
+        ])
+
+    def announce(self):
+        for group, topic in list(self.callbacks.keys()):
+            self.join(group, topic)
+
+    def unsubscribe(self, callback):
+        for callbacks in self.callbacks.values():
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+    def gotMessage(self, command, group, subscription, topic, body,
+                   sequence):
+        from moksha.hub.zeromq.zeromq import ZMQMessage
+
+        group, subscription = _text(group), _text(subscription)
+        self.available[group] -= 1
+
+        if not framed(body):
+            body = _text(body)
+        message = ZMQMessage(_text(topic), body)
+        message.ack = Acknowledgement(
+            functools.partial(self.done, group, sequence))
+        try:
+            for callback in self.callbacks[(group, subscription)]:
+                callback(message)
+        finally:
+            message.ack.release()
+
+    def done(self, group, sequence, handled):
+        self._done.put((group, sequence))
+
+    def ready(self, finished):
+        """ Give back the credit for every message finished since last time,
+        in one READY per group. """
+        sequences = collections.defaultdict(list)
+        for group, sequence in finished:
+            sequences[group].append(sequence)
+        for group, done in sequences.items():
+            self.available[group] += len(done)
+            self.connection.sendMultipart([
+                READY, _bytes(group), _bytes(str(len(done)))] + done)
+
+    def close(self):
+        if self.announcer and self.announcer.running:
+            self.announcer.stop()
+        self.connection.shutdown()
@@ -23,10 +23,16 @@ import time
 import txzmq
 import zmq
 
+from twisted.internet.task import LoopingCall
+from twisted.python.threadable import isInIOThread
+
 from kitchen.text.converters import to_bytes
 
 from moksha.common.lib.converters import asbool
 from moksha.hub.zeromq.base import BaseZMQHubExtension
+from moksha.hub.reactor import reactor, Handoff
+from moksha.hub.serialization import framed
+from moksha.hub.zeromq.group import GroupDistributor, GroupMember
 
 log = logging.getLogger('moksha.hub')
 
@@ -34,6 +40,8 @@ log = logging.getLogger('moksha.hub')
 # TODO -- is there a better thing to use in this thing's place?  A dict-like
 # object that also supports __getattr__ access would be ideal.
 class ZMQMessage(object):
+    ack = None
+
     def __init__(self, topic, body):
         self.topic = topic
         self.body = body
@@ -67,32 +75,30 @@ class ZMQHubExtension(BaseZMQHubExtension):
     def __init__(self, hub, config):
         self.config = config
         self.validate_config(self.config)
-        self.strict = asbool(self.config.get('zmq_strict', False))
+        self.settings = settings = hub.settings
+        self.strict = settings.zmq_strict
         self.subscriber_factories = {}
 
         self.context = zmq.Context(1)
 
         # Configure txZMQ to use our highwatermark and keepalive if we have 'em
         self.connection_cls = txzmq.ZmqSubConnection
-        self.connection_cls.highWaterMark = \
-            config.get('high_water_mark', 0)
-        self.connection_cls.tcpKeepalive = \
-            config.get('zmq_tcp_keepalive', 0)
-        self.connection_cls.tcpKeepaliveCount = \
-            config.get('zmq_tcp_keepalive_cnt', 0)
-        self.connection_cls.tcpKeepaliveIdle = \
-            config.get('zmq_tcp_keepalive_idle', 0)
+        self.connection_cls.highWaterMark = settings.high_water_mark
+        self.connection_cls.tcpKeepalive = settings.zmq_tcp_keepalive
+        self.connection_cls.tcpKeepaliveCount = settings.zmq_tcp_keepalive_cnt
+        self.connection_cls.tcpKeepaliveIdle = settings.zmq_tcp_keepalive_idle
         self.connection_cls.tcpKeepaliveInterval = \
-            config.get('zmq_tcp_keepalive_intvl', 0)
-        self.connection_cls.reconnectInterval = \
-            config.get('zmq_reconnect_ivl', 100)
+            settings.zmq_tcp_keepalive_intvl
+        self.connection_cls.reconnectInterval = settings.zmq_reconnect_ivl
         self.connection_cls.reconnectIntervalMax = \
-            config.get('zmq_reconnect_ivl_max', 100)
+            settings.zmq_reconnect_ivl_max
 
-        # Set up the publishing socket
+        # Set up the publishing socket.  zeromq sockets must not be shared
+        # between threads, so once the reactor runs, other threads hand
+        # their messages to it.
         self.pub_socket = self.context.socket(zmq.PUB)
-        _endpoints = self.config.get('zmq_publish_endpoints', '').split(',')
-        for endpoint in (e for e in _endpoints if e):
+        self._outgoing = Handoff(self.publish)
+        for endpoint in settings.zmq_publish_endpoints:
             log.info("Binding publish socket to '%s'" % endpoint)
             try:
                 self.pub_socket.bind(endpoint)
@@ -103,8 +109,8 @@ class ZMQHubExtension(BaseZMQHubExtension):
         self.twisted_zmq_factory = txzmq.ZmqFactory()
 
         # Establish a list of subscription endpoints for later use
-        _endpoints = self.config['zmq_subscribe_endpoints'].split(',')
-        method = self.config.get('zmq_subscribe_method', 'connect')
+        _endpoints = settings.zmq_subscribe_endpoints
+        method = settings.zmq_subscribe_method
 
         if method == 'bind':
             _endpoints = sum(map(list, map(hostname2ipaddr, _endpoints)), [])
@@ -116,6 +122,18 @@ class ZMQHubExtension(BaseZMQHubExtension):
             txzmq.ZmqEndpoint(method, ep) for ep in _endpoints
         ]
 
+        # Consumer groups.  Whichever hub manages to bind the distributor
+        # endpoint hands out the work for every group; the others keep trying
+        # so that one of them takes over if it goes away.
+        self.group_member = self.group_distributor = None
+        self._group_election = None
+        if settings.zmq_group_bind_endpoint:
+            if not self.elect_group_distributor():
+                self._group_election = LoopingCall(
+                    self.elect_group_distributor)
+                self._group_election.start(
+                    settings.zmq_group_heartbeat, now=False)
+
         # This is required so that the publishing socket can fully set itself
         # up before we start trying to send messages on it.  This is a
         # documented zmq issue that they do not plan to fix.
@@ -144,14 +162,68 @@ class ZMQHubExtension(BaseZMQHubExtension):
             topic = topic.encode('utf-8')
         if isinstance(message, six.text_type):
             message = message.encode('utf-8')
+        if reactor.running and not isInIOThread():
+            self._outgoing.put([topic, message])
+        else:
+            self.publish([[topic, message]])
+
+        super(ZMQHubExtension, self).send_message(topic, message, **headers)
+
+    def send_messages(self, messages):
+        batch = []
+        for topic, message, headers in messages:
+            if isinstance(topic, six.text_type):
+                topic = topic.encode('utf-8')
+            if isinstance(message, six.text_type):
+                message = message.encode('utf-8')
+            batch.append([topic, message])
+        if reactor.running and not isInIOThread():
+            self._outgoing.extend(batch)
+        else:
+            self.publish(batch)
+
+    def publish(self, messages):
+        for frames in messages:
+            try:
+                self.pub_socket.send_multipart(frames)
+            except zmq.ZMQError as e:
+                log.warning("Couldn't send message: %r" % e)
+
+    def elect_group_distributor(self):
+        endpoint = self.settings.zmq_group_bind_endpoint
         try:
-            self.pub_socket.send_multipart([topic, message])
+            self.group_distributor = GroupDistributor(
+                self, self.twisted_zmq_factory, endpoint,
+                backlog=self.settings.zmq_group_backlog,
+                heartbeat=self.settings.zmq_group_heartbeat)
         except zmq.ZMQError as e:
-            log.warning("Couldn't send message: %r" % e)
+            log.debug("Not distributing consumer groups on %r: %r" % (
+                endpoint, e))
+            return False
 
-        super(ZMQHubExtension, self).send_message(topic, message, **headers)
+        if self._group_election and self._group_election.running:
+            self._group_election.stop()
+        return True
+
+    def subscribe_group(self, group, topic, callback):
+        endpoint = self.settings.zmq_group_endpoint
+        if not endpoint:
+            log.warning("No 'zmq_group_endpoint' set.  Consumer group %r "
+                        "falls back to receiving every message." % group)
+            return self.subscribe(topic, callback)
+
+        if not self.group_member:
+            self.group_member = GroupMember(
+                self, self.twisted_zmq_factory, endpoint,
+                credit=self.settings.zmq_group_credit,
+                heartbeat=self.settings.zmq_group_heartbeat)
+
+        self.group_member.subscribe(group, topic, callback)
 
     def unsubscribe(self, callback):
+        if self.group_member:
+            self.group_member.unsubscribe(callback)
+
         for endpoint, factory in self.subscriber_factories.items():
             kill_list = []
             for intercept_func in factory._moksha_callbacks:
@@ -191,7 +263,8 @@ class ZMQHubExtension(BaseZMQHubExtension):
 
                     if isinstance(_topic, six.binary_type):
                         _topic = _topic.decode('utf-8')
-                    if isinstance(_body, six.binary_type):
+                    if isinstance(_body, six.binary_type) and \
+                       not framed(_body):
                         _body = _body.decode('utf-8')
                     for f in s._moksha_callbacks:
                         f(_body, _topic)
@@ -230,5 +303,12 @@ class ZMQHubExtension(BaseZMQHubExtension):
         super(ZMQHubExtension, self).subscribe(original_topic, callback)
 
     def close(self):
+        if self._group_election and self._group_election.running:
+            self._group_election.stop()
+        if self.group_member:
+            self.group_member.close()
+        if self.group_distributor:
+            self.group_distributor.close()
+
         self.pub_socket.close()
         self.context.term()
@@ -40,6 +40,10 @@ tests_require = [
     'websocket-client',
 ]
 
+extras_require = {
+    'amqp': ['pika'],
+}
+
 if sys.version_info[0] == 2 and sys.version_info[1] <= 6:
     tests_require.extend([
         'unittest2',
@@ -55,6 +59,7 @@ setup(
     author_email='',
     url='https://mokshaproject.net',
     install_requires=install_requires,
+    extras_require=extras_require,
     packages=find_packages(exclude=['ez_setup']),
     include_package_data=True,
     test_suite='nose.collector',
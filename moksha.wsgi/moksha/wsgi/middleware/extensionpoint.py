@@ -16,11 +16,11 @@
 # Authors: John (J5) Palmieri <johnp@redhat.com>
 
 import logging
-import pkg_resources
 
 from webob import Request, Response
 
 from moksha.common.exc import ApplicationNotFound, MokshaException
+from moksha.common.lib.entrypoints import iter_entry_points
 
 log = logging.getLogger(__name__)
 
@@ -96,7 +96,7 @@ class MokshaExtensionPointMiddleware(object):
         if test_dir:
             self.load_extension_dir(test_dir)
 
-        for ep in pkg_resources.iter_entry_points(entry_point):
+        for ep in iter_entry_points(entry_point):
             mod = ep.load()
             dir = os.path.dirname(mod.__file__)
             self.load_extension_dir(dir)
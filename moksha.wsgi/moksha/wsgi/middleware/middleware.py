@@ -18,7 +18,6 @@
 import os
 import moksha.common.utils
 import logging
-import pkg_resources
 import warnings
 import types
 
@@ -30,6 +29,7 @@ from sqlalchemy import create_engine
 from moksha.common.exc import MokshaException
 from moksha.common.lib.helpers import get_moksha_config_path
 from moksha.common.lib.helpers import appconfig
+from moksha.common.lib.entrypoints import iter_entry_points
 
 log = logging.getLogger(__name__)
 
@@ -100,7 +100,7 @@ class MokshaMiddleware(object):
         ensure that we parse and load each of their configuration files
         beforehand.
         """
-        for app_entry in pkg_resources.iter_entry_points(APPS):
+        for app_entry in iter_entry_points(APPS):
             if app_entry.name in moksha.common.utils._apps:
                 raise MokshaException('Duplicate application name: %s' %
                                       app_entry.name)
@@ -110,7 +110,7 @@ class MokshaMiddleware(object):
                     'project_name': app_entry.dist.project_name,
                     'path': app_path,
                     }
-        for widget_entry in pkg_resources.iter_entry_points(WIDGETS):
+        for widget_entry in iter_entry_points(WIDGETS):
             if widget_entry.name in moksha.common.utils._widgets:
                 raise MokshaException('Duplicate widget name: %s' %
                                       widget_entry.name)
@@ -123,7 +123,7 @@ class MokshaMiddleware(object):
 
     def load_applications(self):
         log.info('Loading moksha applications')
-        for app_entry in pkg_resources.iter_entry_points(APPS):
+        for app_entry in iter_entry_points(APPS):
             log.info('Loading %s application' % app_entry.name)
             app_class = app_entry.load()
             app_path = app_entry.dist.location
@@ -157,7 +157,7 @@ class MokshaMiddleware(object):
         def is_live(widget):
             return isinstance(widget, LiveWidgetMeta)
 
-        for widget_entry in pkg_resources.iter_entry_points(WIDGETS):
+        for widget_entry in iter_entry_points(WIDGETS):
             log.info('Loading %s widget' % widget_entry.name)
 
             widget_class = widget_entry.load()
@@ -174,7 +174,7 @@ class MokshaMiddleware(object):
 
     def load_menus(self):
         log.info('Loading moksha menus')
-        for menu_entry in pkg_resources.iter_entry_points(MENUS):
+        for menu_entry in iter_entry_points(MENUS):
             log.info('Loading %s menu' % menu_entry.name)
             menu_class = menu_entry.load()
             menu_path = menu_entry.dist.location
@@ -276,7 +276,7 @@ class MokshaMiddleware(object):
 
         """
         root = None
-        for root_entry in pkg_resources.iter_entry_points(ROOT):
+        for root_entry in iter_entry_points(ROOT):
             log.info('Loading the root of the project: %r' %
                      root_entry.dist.project_name)
             if root_entry.name == 'root':
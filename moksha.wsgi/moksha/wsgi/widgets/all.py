@@ -20,7 +20,7 @@ This is currently used by the `archive_tw_resources` setuptools command,
 which archives all of the resources used by all ToscaWidgets.
 """
 
-import pkg_resources
+from moksha.common.lib.entrypoints import iter_entry_points
 
 from tw2.core.widgets import WidgetMeta
 from inspect import isclass
@@ -28,7 +28,7 @@ from inspect import isclass
 __all__ = []
 
 for entry_point in ('moksha.widget', 'moksha.menu', 'moksha.global'):
-    for widget_entry in pkg_resources.iter_entry_points(entry_point):
+    for widget_entry in iter_entry_points(entry_point):
         widget_class = widget_entry.load()
         if isclass(widget_class) and not isinstance(widget_class, WidgetMeta):
             widget = widget_class(widget_entry.name)
@@ -14,7 +14,6 @@
 # limitations under the License.
 
 import logging
-import pkg_resources
 import types
 
 from paste.deploy.converters import asbool
@@ -22,6 +21,7 @@ from paste.deploy.converters import asbool
 import tw2.core as twc
 import tw2.core.widgets
 
+from moksha.common.lib.entrypoints import iter_entry_points
 from moksha.wsgi.widgets.moksha_js import (
     moksha_js, moksha_extension_points_js,
 )
@@ -73,7 +73,7 @@ class GlobalResourceInjectionWidget(twc.Widget):
 
         live = asbool(self.config.get('moksha.livesocket', True))
 
-        for widget_entry in pkg_resources.iter_entry_points('moksha.global'):
+        for widget_entry in iter_entry_points('moksha.global'):
             log.info('Loading global resource: %s' % widget_entry.name)
             loaded = widget_entry.load()
             if isinstance(loaded, types.FunctionType):